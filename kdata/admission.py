@@ -0,0 +1,163 @@
+"""Admission control for the data-receiving (urls_data) views.
+
+When many clients sync at the same moment (AWARE syncs on fixed
+clock boundaries), workers saturate and every request gets slow.
+This middleware rejects ingest requests early with "503 Service
+Unavailable" and a Retry-After header when:
+
+- this worker already has KOOTA_INGEST_MAX_CONCURRENT ingest requests
+  in progress (only matters for threaded workers), or
+- the device has used up its token bucket: KOOTA_INGEST_DEVICE_RATE
+  requests per second on average, with bursts of up to
+  KOOTA_INGEST_DEVICE_BURST.
+
+Both are disabled by default (None).  AWARE and PurpleRobot both treat
+a non-200 response as a failed upload, keep the data, and retry
+later, so nothing is lost.  Counters of admitted and rejected
+requests are per process and shown on the stats page.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+
+from .cache import LRUCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+    def take(self):
+        """Take one token if available.  Returns True if taken."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionController(object):
+    def __init__(self, max_concurrent=None, device_rate=None, device_burst=10):
+        self.max_concurrent = max_concurrent
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # Idle buckets can be forgotten: a new bucket starts full.
+        self._buckets = LRUCache(maxsize=100000, ttl=3600)
+        self.counters = collections.Counter()
+    def admit(self, device_id=None):
+        """Try to admit one request.  Returns None if admitted, else reason.
+
+        If admitted, release() must be called when the request is done.
+        """
+        with self._lock:
+            if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+                self.counters['rejected_concurrency'] += 1
+                return 'Too many concurrent requests'
+            if self.device_rate is not None and device_id is not None:
+                bucket = self._buckets.get(device_id)
+                if bucket is None:
+                    bucket = TokenBucket(self.device_rate, self.device_burst)
+                    self._buckets.set(device_id, bucket)
+                if not bucket.take():
+                    self.counters['rejected_device_rate'] += 1
+                    return 'Too many requests from device'
+            self.in_flight += 1
+            self.counters['admitted'] += 1
+            return None
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = self.in_flight
+            return stats
+
+
+controller = AdmissionController(
+    max_concurrent=getattr(settings, 'KOOTA_INGEST_MAX_CONCURRENT', None),
+    device_rate=getattr(settings, 'KOOTA_INGEST_DEVICE_RATE', None),
+    device_burst=getattr(settings, 'KOOTA_INGEST_DEVICE_BURST', 10),
+    )
+
+_ingest_url_names = None
+def ingest_url_names():
+    """Names of all URL patterns in kdata.urls_data."""
+    global _ingest_url_names
+    if _ingest_url_names is None:
+        from .urls_data import urls_data
+        names = set()
+        def walk(patterns):
+            for pattern in patterns:
+                if hasattr(pattern, 'url_patterns'):
+                    walk(pattern.url_patterns)
+                elif pattern.name:
+                    names.add(pattern.name)
+        walk(urls_data)
+        _ingest_url_names = names
+    return _ingest_url_names
+
+def request_device_id(request, kwargs):
+    """Device identifier of an ingest request, if it can be found cheaply."""
+    for key in ('secret_id', 'device_id'):
+        if kwargs.get(key):
+            return kwargs[key]
+    if 'HTTP_DEVICE_ID' in request.META:
+        return request.META['HTTP_DEVICE_ID']
+    return request.GET.get('device_id')
+
+
+class AdmissionControlMiddleware(object):
+    # Usable in both WSGI and ASGI (see koota_prj/asgi_ingest.py)
+    # applications without an adapter.
+    sync_capable = True
+    async_capable = True
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            markcoroutinefunction(self)
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        try:
+            return self.get_response(request)
+        finally:
+            if getattr(request, '_kdata_admitted', False):
+                controller.release()
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            if getattr(request, '_kdata_admitted', False):
+                controller.release()
+
+    def process_view(self, request, view_func, args, kwargs):
+        if controller.max_concurrent is None and controller.device_rate is None:
+            return None
+        if request.resolver_match.url_name not in ingest_url_names():
+            return None
+        reason = controller.admit(request_device_id(request, kwargs))
+        if reason is None:
+            request._kdata_admitted = True
+            return None
+        retry_after = getattr(settings, 'KOOTA_INGEST_RETRY_AFTER', 60)
+        response = JsonResponse(dict(ok=False, error=reason, retry_after=retry_after),
+                                status=503, reason=reason)
+        response['Retry-After'] = str(retry_after)
+        return response
@@ -8,8 +8,14 @@ class KdataConfig(AppConfig):
     # register should be defined here.  We have the REGISTER_DEVICES
     # setting to do this.
     def ready(self):
+        from django.db.models.signals import post_save, post_delete
         from .devices import base
+        from . import cache
         from . import util
+        post_save.connect(cache.invalidate_devices,
+                          dispatch_uid='kdata.cache.invalidate_devices')
+        post_delete.connect(cache.invalidate_devices,
+                            dispatch_uid='kdata.cache.invalidate_devices')
         if hasattr(settings, 'REGISTER_DEVICES'):
             for row in settings.REGISTER_DEVICES:
                 row['cls'] = util.import_by_name(row['cls'])
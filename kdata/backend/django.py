@@ -33,18 +33,33 @@ class Backend(object):
     def bytes_total(self):
         return models.Data.objects.filter(device_id=self.device_id).aggregate(sum=Sum(F('data_length')))['sum']
     def __getitem__(self, slc):
+        """One packet (int index), or a queryset of a datetime slice.
+
+        Returns None if there is no such data.  The ts filters are
+        applied before anything is queried, so that on a partitioned
+        table (see kdata/partitions.py) only the partitions of the
+        slice are scanned.
+        """
         qs = models.Data.objects.filter(device_id=self.device_id).order_by('ts')
-        #import IPython ; IPython.embed()
-        if not qs.exists():
-            return None
         if isinstance(slc, int):
             if slc < 0:
                 idx = -slc - 1   # -1=>0, -2=>1, etc
-                return qs.reverse()[idx]
-            return qs[slc]
+                qs = qs.reverse()
+            else:
+                idx = slc
+            try:
+                return qs[idx]
+            except IndexError:
+                # No data at all: None for any index.  Only an index
+                # past the end of existing data is an error.
+                if idx == 0 or not qs.exists():
+                    return None
+                raise
         if isinstance(slc, slice):
             if isinstance(slc.start, datetime):
                 qs = qs.filter(ts__gte=slc.start)
             if isinstance(slc.stop, datetime):
                 qs = qs.filter(ts__lt=slc.stop)
+        if not qs.exists():
+            return None
         return qs
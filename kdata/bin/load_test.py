@@ -0,0 +1,117 @@
+"""Load test of the upload endpoint with slow clients.
+
+This is a stand-alone program (straight Python 3, no dependencies)
+which simulates many phones uploading over slow links at the same
+time: each client sends its request body in small pieces, with
+pauses, like a mobile connection would.  It reports how many uploads
+per second the server completed and their latencies.
+
+Give several URLs to compare deployments, for example the WSGI
+application (koota_prj/wsgi_ingest.py) and the ASGI one
+(koota_prj/asgi_ingest.py) with the same number of workers:
+
+    $ python load_test.py device_id http://localhost:8000/post/ http://localhost:8001/post/
+    $ python load_test.py --clients 200 --rate 20000 --size 100000 device_id URL ...
+
+A synchronous worker is busy for the whole time it takes a client to
+send its body, so with --clients much larger than the number of
+workers, the WSGI throughput is limited to about
+workers * rate / size uploads per second, while an ASGI server only
+needs its workers once the body has arrived.  Bodies smaller than
+what the kernel buffers for a not yet accepted connection (on
+localhost, several hundred kB) hide this, so use a large --size.
+
+The packets are saved into the database as data of device_id: use a
+test device.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import time
+from urllib.parse import urlsplit
+
+
+async def upload(url, device_id, body, rate, chunk_size):
+    """Do one upload, sending about rate bytes/s.  Returns HTTP status."""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port,
+        ssl=ssl.create_default_context() if parts.scheme == 'https' else None)
+    try:
+        path = parts.path + ('?'+parts.query if parts.query else '')
+        writer.write(('POST %s HTTP/1.1\r\n'
+                      'Host: %s\r\n'
+                      'Device-ID: %s\r\n'
+                      'Content-Type: application/octet-stream\r\n'
+                      'Content-Length: %d\r\n'
+                      'Connection: close\r\n'
+                      '\r\n'%(path, parts.netloc, device_id, len(body))).encode('ascii'))
+        for i in range(0, len(body), chunk_size):
+            writer.write(body[i:i+chunk_size])
+            await writer.drain()
+            await asyncio.sleep(chunk_size / rate)
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+async def client(url, device_id, args, deadline, results):
+    """Upload repeatedly until deadline, appending (status, seconds)."""
+    while time.monotonic() < deadline:
+        body = os.urandom(args.size//2).hex().encode('ascii')
+        start = time.monotonic()
+        try:
+            status = await upload(url, device_id, body, args.rate, args.chunk_size)
+        except (OSError, ValueError, IndexError) as e:
+            status = type(e).__name__
+        results.append((status, time.monotonic()-start))
+
+async def run(url, device_id, args):
+    results = [ ]
+    start = time.monotonic()
+    deadline = start + args.duration
+    await asyncio.gather(*(client(url, device_id, args, deadline, results)
+                           for _ in range(args.clients)))
+    return results, time.monotonic() - start
+
+def report(url, results, elapsed):
+    ok = sorted(t for status, t in results if status == 200)
+    errors = { }
+    for status, _ in results:
+        if status != 200:
+            errors[status] = errors.get(status, 0) + 1
+    def percentile(p):
+        return ok[min(len(ok)-1, int(len(ok)*p))] if ok else float('nan')
+    print(json.dumps(dict(url=url,
+                          ok=len(ok),
+                          errors=errors,
+                          uploads_per_s=round(len(ok)/elapsed, 2),
+                          latency_p50=round(percentile(.5), 3),
+                          latency_p95=round(percentile(.95), 3),
+                          latency_max=round(ok[-1], 3) if ok else None)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test koota uploads with slow clients")
+    parser.add_argument('device_id', help='device id to upload to')
+    parser.add_argument('urls', nargs='+', help='upload URLs to test, one after another')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='concurrent clients (default %(default)s)')
+    parser.add_argument('--size', type=int, default=50000,
+                        help='bytes per upload (default %(default)s)')
+    parser.add_argument('--rate', type=int, default=50000,
+                        help='bytes/s sent by each client (default %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=4096,
+                        help='bytes sent at once (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run per URL (default %(default)s)')
+    args = parser.parse_args()
+
+    for url in args.urls:
+        results, elapsed = asyncio.run(run(url, args.device_id, args))
+        report(url, results, elapsed)
@@ -6,12 +6,15 @@ Python.
 
 Usage:
     $ python upload.py device_id data_file
+    $ python upload.py --batch device_id data_file
 
 Data packets should be split into smaller chuckns (ideally ~100 kb),
-and then uploaded separately.  This script should be modified to do
-that, and then upload each chuck in sequence.  Be careful to consider
-the case of errors, so that each chuck will be uploaded once but no
-more than once.
+and then uploaded separately.  With --batch, the file is split at
+line boundaries into packets of about --packet-size bytes, and these
+are sent --batch-size packets per request to the batch endpoint
+(post/batch/).  The server reports the status of each packet, and the
+upload stops at the first failed packet, printing its number, so it
+can be resumed with --start.
 
 TODO: verify SSL certificates and use the pinned endpoint.  (two
 complexities: may need another dependency, may need actual other files
@@ -57,6 +60,47 @@ def post_data(device_id, data, url):
         print('  HTTP error:', e.getcode(), e.reason)
         return 1
 
+def split_packets(data, packet_size):
+    """Split data at line boundaries into packets of about packet_size."""
+    packets = [ ]
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + packet_size)
+        end = len(data) if end == -1 else end + 1
+        packets.append(data[start:end])
+        start = end
+    return packets
+
+def frame(packet):
+    """One frame of the batch format: JSON header line, packet, newline."""
+    header = dict(length=len(packet),
+                  sha256=hashlib.sha256(packet).hexdigest())
+    return json.dumps(header).encode('utf-8') + b'\n' + packet + b'\n'
+
+def post_batch(device_id, packets, url):
+    """Post many packets in one request.  Returns number of packets saved.
+
+    Packets are saved in order until the first one which failed.
+    """
+    _r = Request(url=url,
+                 data=b''.join(frame(p) for p in packets),
+                 headers={'Device-ID': device_id,
+                          'Content-Type': 'application/octet-stream'})
+    try:
+        r = urlopen(_r)
+        try:
+            response = json.loads(r.read().decode('utf-8'))
+        finally:
+            r.close()
+    except HTTPError as e:
+        print('  HTTP error:', e.getcode(), e.reason)
+        return 0
+    for i, item in enumerate(response.get('items', [ ])):
+        if not item.get('ok'):
+            print('  Packet error:', item.get('error'))
+            return i
+    return len(response.get('items', [ ]))
+
 
 
 
@@ -67,11 +111,33 @@ if __name__ == "__main__":
     parser.add_argument('data_filename', help='Data to device id to upload to')
     parser.add_argument('--url', help='URL to post to',
                         default=DEFAULT_URL)
+    parser.add_argument('--batch', action='store_true',
+                        help='Split into packets and use the batch endpoint')
+    parser.add_argument('--packet-size', type=int, default=100000,
+                        help='Approximate packet size with --batch (default %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Packets per request with --batch (default %(default)s)')
+    parser.add_argument('--start', type=int, default=0,
+                        help='With --batch, skip packets before this one')
     args = parser.parse_args()
 
     device_id = args.device_id
     data = open(args.data_filename, 'rb').read()
 
+    if args.batch:
+        url = args.url.rstrip('/') + '/batch/'
+        data_packets = split_packets(data, args.packet_size)
+        i = args.start
+        while i < len(data_packets):
+            batch = data_packets[i:i+args.batch_size]
+            print("Packets %d-%d of %d"%(i, i+len(batch)-1, len(data_packets)))
+            n = post_batch(device_id, batch, url=url)
+            i += n
+            if n < len(batch):
+                print('Packet %s failed, resume with --start=%s'%(i, i))
+                exit(1)
+        exit(0)
+
     # Test the stuff
     #print(device_id)
     #print(data)
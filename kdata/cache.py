@@ -0,0 +1,225 @@
+"""Process-local caches of hot database lookups.
+
+The data-receiving views look up the device by secret_id on every
+request, and the UI looks up devices by public_id several times per
+request.  These lookups are cached here per process, with a TTL.
+
+Invalidation: any save or delete of a Device (or subclass) clears the
+whole device cache of this process (see apps.py).  A save can change
+the ids which we are keyed by, and devices are written rarely, so
+this is simpler than tracking keys.  Other processes only see the
+change when their entries expire, so the TTL should stay short.
+
+Settings:
+KOOTA_DEVICE_CACHE_TTL:           seconds to cache found devices (0 disables)
+KOOTA_DEVICE_CACHE_SIZE:          max entries
+KOOTA_DEVICE_CACHE_NEGATIVE_TTL:  seconds to remember ids which were
+                                  not found (0, default, disables)
+
+Device ID filter: if KOOTA_DEVICE_FILTER is true, the set of all
+device ids is kept in memory, and the ingest views reject ids which
+are not in it before doing any database query.  This is for the
+phones of finished studies which keep uploading to deleted devices.
+The set is rebuilt (one query) after Device saves and deletes.  Since
+other processes don't see those signals, an id which is not found
+also causes a rebuild, but at most once every
+KOOTA_DEVICE_FILTER_REFRESH seconds: a device created in another
+process may be rejected for that long.
+"""
+
+import collections
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with a time-to-live per entry."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def __len__(self):
+        return len(self._data)
+
+
+device_cache = LRUCache(
+    maxsize=getattr(settings, 'KOOTA_DEVICE_CACHE_SIZE', 1000),
+    ttl=getattr(settings, 'KOOTA_DEVICE_CACHE_TTL', 60))
+_NEGATIVE_TTL = getattr(settings, 'KOOTA_DEVICE_CACHE_NEGATIVE_TTL', 0)
+_MISSING = object()
+
+def get_device(model, field, value):
+    """model.objects.get(field=value), cached.
+
+    Returns a new model instance on every call, so callers may modify
+    and save it as usual.  Raises model.DoesNotExist if not found,
+    also when the miss comes from the negative cache.
+    """
+    key = (model, field, value)
+    obj = _cached_device(model, key)
+    if obj is None:
+        obj = _load_device(model, key)
+    return obj
+
+async def aget_device(model, field, value):
+    """get_device() for async views.
+
+    Only a cache miss goes to a worker thread and the database.
+    """
+    from . import util
+    key = (model, field, value)
+    obj = _cached_device(model, key)
+    if obj is None:
+        obj = await util.db_sync_to_async(_load_device)(model, key)
+    return obj
+
+def _cached_device(model, key):
+    """The device from the cache, None if not cached."""
+    cached = device_cache.get(key)
+    if cached is _MISSING:
+        raise model.DoesNotExist("%s matching query does not exist (cached)."
+                                 % model._meta.object_name)
+    if cached is not None:
+        db, values = cached
+        return model.from_db(db, None, values)
+    return None
+
+def _load_device(model, key):
+    """Get the device from the database and cache it."""
+    _, field, value = key
+    try:
+        obj = model.objects.get(**{field: value})
+    except model.DoesNotExist:
+        device_cache.set(key, _MISSING, ttl=_NEGATIVE_TTL)
+        raise
+    values = tuple(getattr(obj, f.attname) for f in model._meta.concrete_fields)
+    device_cache.set(key, (obj._state.db, values))
+    return obj
+
+def invalidate_devices(sender=None, **kwargs):
+    """Signal receiver: clear the device cache on Device save/delete."""
+    from . import models
+    if sender is None or issubclass(sender, models.Device):
+        device_cache.clear()
+        device_filter.invalidate()
+
+
+class DeviceIdFilter(object):
+    """In-memory set of all device_ids and secret_ids.
+
+    check() answers "may this id exist?" without a database query,
+    except when the set needs to be (re)built.
+    """
+    def __init__(self, refresh_interval=10):
+        self.refresh_interval = refresh_interval
+        self._ids = None
+        self._built = None
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+    def _rebuild(self):
+        from . import models
+        ids = set()
+        for device_id, secret_id in models.Device.objects.values_list('device_id', '_secret_id'):
+            ids.add(device_id.lower())
+            if secret_id:
+                ids.add(secret_id.lower())
+        self._ids = frozenset(ids)
+        self._built = time.monotonic()
+        self.counters['rebuilds'] += 1
+    def check(self, device_id, rebuild=True):
+        """False if device_id is definitely not a device.
+
+        With rebuild=False, return None instead of querying the
+        database when the set would have to be (re)built.
+        """
+        device_id = device_id.lower()
+        with self._lock:
+            if self._ids is not None and device_id in self._ids:
+                self.counters['checked'] += 1
+                return True
+            # If not built yet, or the device may have been created in
+            # another process.
+            stale = (self._ids is None
+                     or time.monotonic() - self._built > self.refresh_interval)
+            if stale and not rebuild:
+                return None
+            self.counters['checked'] += 1
+            if stale:
+                self._rebuild()
+                if device_id in self._ids:
+                    return True
+            self.counters['rejected'] += 1
+            return False
+    def invalidate(self):
+        with self._lock:
+            self._ids = None
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self._ids) if self._ids is not None else None
+            return stats
+
+
+device_filter = DeviceIdFilter(
+    refresh_interval=getattr(settings, 'KOOTA_DEVICE_FILTER_REFRESH', 10))
+
+def known_device_id(device_id):
+    """False if the device filter is enabled and device_id is not a device."""
+    if not getattr(settings, 'KOOTA_DEVICE_FILTER', False):
+        return True
+    if device_filter.check(device_id):
+        return True
+    logger.debug("Unknown device_id rejected by filter: %r", device_id)
+    return False
+
+async def aknown_device_id(device_id):
+    """known_device_id() for async views.
+
+    Only goes to a worker thread when the filter has to be rebuilt.
+    """
+    from . import util
+    if not getattr(settings, 'KOOTA_DEVICE_FILTER', False):
+        return True
+    known = device_filter.check(device_id, rebuild=False)
+    if known is None:
+        known = await util.db_sync_to_async(device_filter.check)(device_id)
+    if not known:
+        logger.debug("Unknown device_id rejected by filter: %r", device_id)
+    return known
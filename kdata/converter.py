@@ -143,11 +143,42 @@ class _Converter(object):
     per_page = 25
     header = [ ]
     desc = ""
+    # Names of the probes (PurpleRobot) or tables (AWARE) of the
+    # packets this converter reads.  None: all packets.  Default: from
+    # the table, probe_type or probe_name attribute.  See
+    # select_packets().
+    packet_probes = None
     @classmethod
     def name(cls):
         """Shortcut to return class name on either object or instance"""
         return cls.__name__
     @classmethod
+    def needed_probes(cls):
+        """List of probes whose packets are needed, None for all packets."""
+        if cls.packet_probes is not None:
+            return cls.packet_probes
+        for attr in ('table', 'probe_type', 'probe_name'):
+            name = getattr(cls, attr, None)
+            if isinstance(name, str):
+                return [name]
+        return None
+    @classmethod
+    def select_packets(cls, queryset, device):
+        """Limit a Data queryset of device to the packets we read, in SQL.
+
+        This uses the DataProbe table, so it is only done for device
+        classes which fill it (BaseDevice.probe_meta), and once every
+        packet of the device has its rows there (see DeviceStats).
+        Otherwise all packets are read and filtered in convert().
+        """
+        probes = cls.needed_probes()
+        if probes is None or getattr(device.get_class(), 'probe_meta', None) is None:
+            return queryset
+        if not device.stats.probes_complete:
+            return queryset
+        from . import models
+        return queryset.filter(id__in=models.DataProbe.packets(device.device_id, probes))
+    @classmethod
     def header2(cls):
         """Return header, either dynamic or static."""
         if hasattr(cls, 'header') and cls.header:
@@ -504,6 +535,7 @@ class PRBattery(_Converter):
     header = ['time', 'level', 'plugged']
     desc = "Battery level"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.BatteryProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -517,6 +549,7 @@ class PRScreen(_Converter):
     header = ['time', 'onoff']
     desc = "Screen on/off times"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.ScreenProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -538,6 +571,7 @@ class PRWifi(_Converter):
     desc = "Wifi networks found"
     device_class = 'PurpleRobot'
     safe = False
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.WifiAccessPointsProbe']
     def convert(self, queryset, time=lambda x:x):
         safe = self.safe
         safe_hash = self.safe_hash
@@ -595,6 +629,7 @@ class PRBluetooth(_Converter):
     desc = "Bluetooth devices found"
     device_class = 'PurpleRobot'
     safe = False
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.BluetoothDevicesProbe']
     def convert(self, queryset, time=lambda x:x):
         safe = self.safe
         safe_hash = self.safe_hash
@@ -627,6 +662,8 @@ class PRStepCounter(_Converter):
     header = ['time', 'step_count', 'last_boot']
     desc = "Step counter"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.RobotHealthProbe',
+                     'edu.northwestern.cbits.purple_robot_manager.probes.builtin.StepCounterProbe']
     def convert(self, queryset, time=lambda x:x):
         last_boot = 0
         for ts, data in queryset:
@@ -643,6 +680,7 @@ class PRDeviceInUse(_Converter):
     header = ['time', 'in_use']
     desc = "Purple Robot DeviceInUseFeature"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.features.DeviceInUseFeature']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -653,6 +691,7 @@ class PRDeviceInUse(_Converter):
 class PRLocation(_Converter):
     desc = 'Purple Robot location probe (builtin.LocationProbe)'
     header = ['time', 'provider', 'lat', 'lon', 'accuracy']
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.LocationProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -668,6 +707,7 @@ class PRAccelerometer(_Converter):
     desc = 'Purple Robot Accelerometer (builtin.AccelerometerProbe).  Some metadata is not yet included here.'
     header = ['event_timestamp', 'normalized_timestamp', 'x', 'y', 'z', 'accuracy']
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.AccelerometerProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -687,6 +727,7 @@ class PRLightProbe(_Converter):
     desc = 'Purple Robot Light Probe (builtin.LightProbe).  Some metadata is not yet included here.'
     header = ['event_timestamp', 'lux', 'accuracy']
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.LightProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -716,6 +757,7 @@ class PRRunningSoftware(_Converter):
     header = ['time', 'package_name', 'task_stack_index', 'package_category', ]
     desc = "All software currently running"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.RunningSoftwareProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -736,6 +778,7 @@ class PRSoftwareInformation(_Converter):
               'package_version_code',]
     desc = "All software installed"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.SoftwareInformationProbe']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -758,6 +801,7 @@ class PRCallHistoryFeature(_Converter):
               'acquiantance_count', 'acquaintance_ratio', ]
     desc = "Aggregated call info"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.features.CallHistoryFeature']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -788,6 +832,7 @@ class PRSunriseSunsetFeature(_Converter):
     header = ['time', 'is_day', 'sunrise', 'sunset', 'day_duration']
     desc = "Sunrise and sunset info at current location"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.features.SunriseSunsetFeature']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
             data = loads(data)
@@ -809,6 +854,7 @@ class PRCommunicationEventProbe(_Converter):
     desc = "Communication Event Probe"
     device_class = 'PurpleRobot'
     no_number = False
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.CommunicationEventProbe']
     def convert(self, queryset, time=lambda x:x):
         no_number = self.no_number
         safe_hash = self.safe_hash
@@ -834,6 +880,7 @@ class PRApplicationLaunchesSafe(_Converter):
     header = ['time', 'current_app_pkg']
     desc = "ApplicationLaunchProbe, when software is started"
     device_class = 'PurpleRobot'
+    packet_probes = ['edu.northwestern.cbits.purple_robot_manager.probes.builtin.ApplicationLaunchProbe']
     def convert(self, queryset, time=lambda x:x):
         # TODO: make this configurable
         link = "https://koota.cs.aalto.fi/static/softinfo.txt"
@@ -1869,6 +1916,7 @@ class AwareDayAggregator(DayAggregator, BaseAwareConverter):
             yield ts, self.ts_bin_func(ts), row
 class AwareLocationDay(LocationDayAggregator, AwareDayAggregator):
     desc = "Location, daily features"
+    packet_probes = ['locations']
     def iter_row(self, packet_ts, data):
         data = loads(data)
         if not isinstance(data, dict): return []
@@ -1914,6 +1962,12 @@ class AwareUploads(BaseAwareConverter):
                    len(data['data']),
                    )
 class AwareTimestamps(BaseAwareConverter):
+    """Timestamps of each collected data point.
+
+    study_check rows are app starts, but an unchanged study_check is
+    stored at most once per aware.STUDY_CHECK_WINDOW (one hour by
+    default), so starts closer together than that show as one row.
+    """
     header = ['time', 'packet_time', 'table']
     desc = "Timestamps of each collected data point"
     def convert(self, queryset, time=lambda x:x):
@@ -2221,6 +2275,7 @@ class AwareLog(BaseAwareConverter):
 class AwareCalls(BaseAwareConverter):
     desc = "Calls (incoming=1, outgoing=2, missed=3)"
     header = ['time', 'call_type', 'call_duration', 'trace', ]
+    packet_probes = ['calls']
     def convert(self, queryset, time=lambda x:x):
         safe_hash = self.safe_hash
         types = {"1": "incoming", "2":"outgoing", "3":"missed"}
@@ -2238,6 +2293,7 @@ class AwareCalls(BaseAwareConverter):
 class AwareMessages(BaseAwareConverter):
     desc = "Text messages"
     header = ['time', 'message_type', 'trace', ]
+    packet_probes = ['messages']
     def convert(self, queryset, time=lambda x:x):
         safe_hash = self.safe_hash
         types = {"1": "incoming", "2":"outgoing"}
@@ -2256,6 +2312,7 @@ class AwareRecentDataCounts(BaseDataCounts, BaseAwareConverter):
 class AwareESM(BaseAwareConverter):
     desc = "ESMs"
     header = ['time', 'time_asked', 'id', 'answer', 'type', 'title', 'instructions', 'submit', 'notification_timeout', ]
+    packet_probes = ['esms']
     def convert(self, queryset, time=lambda x:x):
         types = {"1": "incoming", "2":"outgoing"}
         for ts, data in queryset:
@@ -1,6 +1,7 @@
 
 
 from .base import (all_device_choices, standard_device_choices,
-                       device_class_lookup, all_device_classes)
+                       device_class_lookup, all_device_classes,
+                       lazy_device_modules, lazy_ingest_features)
 from .base import (get_choices, register_device,
                    get_class, BaseDevice)
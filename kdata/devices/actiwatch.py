@@ -4,6 +4,7 @@ import textwrap
 import re
 
 from .. import converter
+from .. import hooks
 from ..devices import BaseDevice, register_device
 
 
@@ -27,6 +28,14 @@ to_remove_keys = ["Identity",
 strip_re = re.compile(rb'((%b):?"?,"?)   [^"$]{1,}   ("?($|,))'%('|'.join(to_remove_keys).encode()),
                           re.M|re.I|re.X)
 
+def scrub(data, device_id=None, request=None):
+    """Remove the identifying fields from an uploaded export.
+
+    An inline ingest hook, so that the raw data stored in the database
+    is already scrubbed.
+    """
+    data, n_replacements = strip_re.subn(rb"\1xxxxx\3", data)
+    return data
 
 
 @register_device(default=True, aliases=['kdata.devices.Actiwatch'])
@@ -37,6 +46,10 @@ class Actiwatch(BaseDevice):
         converter.ActiwatchStatistics,
         converter.ActiwatchMarkers,
                   ]
+    # Full exports of a long recording are several MiB.
+    max_upload_size = 64 * 2**20
+    # Privacy: see scrub().  Also listed in devices.lazy_ingest_features.
+    ingest_hooks = [ hooks.Hook(scrub, inline=True) ]
     raw_instructions = textwrap.dedent("""\
     Write down the "device secret ID" you can see above.
 
@@ -46,12 +59,3 @@ class Actiwatch(BaseDevice):
     def configure(cls, device):
         return dict(raw_instructions=cls.raw_instructions.format(device=device),
                     )
-
-    def process_upload(self, data):
-        """When data is uploaded, reprocess it for privacy.
-
-        For Actiwatches, this removes some key identifying fields in the
-        data.
-        """
-        data, n_replacements = strip_re.subn(rb"\1xxxxx\3", data)
-        return data
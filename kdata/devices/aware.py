@@ -15,8 +15,10 @@ import time
 from six.moves.urllib import parse as urlparse
 import yaml
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django import forms
+from django.db import transaction
 from django.urls import reverse
 from django.http import HttpResponse, JsonResponse, UnreadablePostError
 from django.utils import timezone
@@ -29,6 +31,7 @@ from .. import group
 from .. import logs
 from .. import models
 from .. import permissions
+from .. import spool
 from .. import util
 from .. import views as kviews
 from . import aware_esm
@@ -42,6 +45,9 @@ AWARE_CRT_URL = getattr(settings, 'AWARE_CRT_URL', "https://data.koota.cs.aalto.
 AWARE_CRT_PATH = getattr(settings, 'AWARE_CRT_PATH', "/srv/koota/static/server.crt")
 
 PACKET_CHUNK_SIZE = 1000
+# A repeated, unchanged study_check is stored at most once per this
+# many seconds (the rest are only counted), see register().
+STUDY_CHECK_WINDOW = getattr(settings, 'AWARE_STUDY_CHECK_WINDOW', 3600)
 
 # This is a null schedule, that should have no effect in Aware.
 NULL_SCHEDULE = yaml.safe_load("""\
@@ -123,6 +129,10 @@ class Aware(devices.BaseDevice):
         converter.AwareTelephony,
         converter.AwareWifi,
     ]
+    @staticmethod
+    def probe_meta(data):
+        """Table of a packet, see BaseDevice.probe_meta."""
+        return packet_probes(data)
     config_instructions_template = textwrap.dedent("""\
     <ol>
     <li>Install the AWARE app from <a href="{{install_url_local}}">here (koota version)</a> or <a href="{{install_url}}">here (upstream version)</a>.</li>
@@ -574,30 +584,48 @@ def register(request, secret_id, indexphp=None):
     data = request.POST
     if 'study_check' in data:
         # A ping when app starts to see if study is still going on.
-        # If this is false, then it force-quits the study.
-        data_to_save = dict(table="study_check",
-                            data=json.dumps(request.POST),
-                            timestamp=time.time(),
-                            version=1)
-        data_to_save = dumps(data_to_save)
-        kviews.save_data(data_to_save, device_id=device.device_id, request=request)
+        # If this is false, then it force-quits the study.  The app
+        # sends this on every start, so the packet is only stored
+        # when the client metadata changes, or once per
+        # STUDY_CHECK_WINDOW (for the app-start times that
+        # AwareTimestamps shows).  Otherwise we only count.
+        post_json = json.dumps(request.POST, sort_keys=True)
+        post_sha256 = sha256(post_json.encode('utf8')).hexdigest()
+        now = time.time()
+        with device.attrs.buffered():
+            last_stored = float(device.attrs.get('aware-study-check-stored', 0))
+            if (device.attrs.get('aware-study-check-sha256') != post_sha256
+                or now - last_stored >= STUDY_CHECK_WINDOW):
+                data_to_save = dict(table="study_check",
+                                    data=post_json,
+                                    timestamp=now,
+                                    version=1)
+                data_to_save = dumps(data_to_save)
+                kviews.save_data(data_to_save, device_id=device.device_id, request=request,
+                                 device_class=device_cls)
+                device.attrs['aware-study-check-sha256'] = post_sha256
+                device.attrs['aware-study-check-stored'] = now
+            n_checks = int(device.attrs.get('aware-study-check-count', 0))
+            device.attrs['aware-study-check-count'] = n_checks + 1
+            device.attrs['aware-study-check-last'] = now
         config = [{'status':True, 'config': config[0]}]
         return JsonResponse(config, safe=False)
     if 'device_id' in data:
-        passwd = util.hash_mosquitto_password(device.secret_id)
-        device.attrs['aware-device-uuid'] = data['device_id']
-        device.attrs['aware-device-passwd_pbkdf2'] = passwd
-        logs.log(request, 'AWARE device registration',
-                 obj=device.public_id, op='register')
-
-        # Save registration data
-        data_to_save = dict(table="register",
-                            data=json.dumps(request.POST),
-                            timestamp=time.time(),
-                            version=1)
-        data_to_save = dumps(data_to_save)
-        kviews.save_data(data_to_save, device_id=device.device_id, request=request)
-        device.attrs['aware-last-ts-%s'%"register"] = timezone.now().timestamp()*1000
+        with device.attrs.buffered():
+            device.attrs['aware-device-uuid'] = data['device_id']
+            _set_mqtt_password(device)
+            logs.log(request, 'AWARE device registration',
+                     obj=device.public_id, op='register')
+
+            # Save registration data
+            data_to_save = dict(table="register",
+                                data=json.dumps(request.POST),
+                                timestamp=time.time(),
+                                version=1)
+            data_to_save = dumps(data_to_save)
+            kviews.save_data(data_to_save, device_id=device.device_id, request=request,
+                             device_class=device_cls)
+            device.attrs['aware-last-ts-%s'%"register"] = timezone.now().timestamp()*1000
 
         return JsonResponse(config, safe=False)
     # error return.
@@ -605,6 +633,21 @@ def register(request, secret_id, indexphp=None):
                              config=config),
                         status=400, reason="Scan with app")
 
+def _set_mqtt_password(device):
+    """Store the mosquitto hash of the device's MQTT password (secret_id).
+
+    Hashing is slow on purpose (PBKDF2), so an existing hash is kept
+    as long as the password has not changed.  To know that, a sha256
+    of the password is stored with it.  This reveals nothing more
+    than the secret_id column itself.
+    """
+    passwd_sha256 = sha256(device.secret_id.encode('utf8')).hexdigest()
+    if (device.attrs.get('aware-device-passwd_sha256') == passwd_sha256
+        and device.attrs.get('aware-device-passwd_pbkdf2')):
+        return
+    device.attrs['aware-device-passwd_pbkdf2'] = util.hash_mosquitto_password(device.secret_id)
+    device.attrs['aware-device-passwd_sha256'] = passwd_sha256
+
 @csrf_exempt
 def create_table(request, secret_id, table, indexphp=None):
     """AWARE client creating table.  This is nullop for us."""
@@ -639,38 +682,18 @@ def latest(request, secret_id, table, indexphp=None):
     return JsonResponse(response, safe=False)
 
 
-# This was test stuff used for more efficient un-urlquoting
-import re
-FIELDS_MATCH = re.compile('[&;]')
-_hexdig = '0123456789ABCDEFabcdef'
-_hextostr = {('%'+a+b): chr(int(a + b, 16)) for a in _hexdig for b in _hexdig}
-R = re.compile(b'%[0-9A-Fa-f]{2}')
-def unquote(s, _h2s=_hextostr):
-    #return re.sub('%[0-9A-Fa-f]{2}', lambda x: _hextostr[x.group()], s)
-    #return re.sub(b'%[0-9A-Fa-f]{2}', lambda x: _h2s[x.group()], s)
-    return R.sub(lambda x: _hextostr[x.group()], s)
-
-import cProfile
-from django.db import transaction
-# Debugging for urlunquoting speed
-#@csrf_exempt
-#def insert(request, *args, **kwargs):
-#    if 'accel' in request.path:
-#        cProfile.runctx('r = insert2(request, *args, **kwargs)', globals(), locals(), sort='cumul')
-#        return r
-#    else:
-#        return insert2(request, *args, **kwargs)
 @csrf_exempt
+@util.accept_compressed_body
 def insert(request, secret_id, table, indexphp=None):
     """AWARE client requesting data to be saved.
 
-    TODO: this function is slowed down by
-    urllib.parse.unquote_to_bytes.  When creating request.POST, it has
-    to call that, and JSON urlencoded has lots of %nn in it, so this
-    is slow.
+    The body is parsed with _insert_post_data() instead of
+    request.POST: building request.POST calls
+    urllib.parse.unquote_to_bytes, and JSON urlencoded has lots of %nn
+    in it, so that is slow.  See "manage.py benchmark aware-parse".
     """
     # pylint: disable=unused-argument
-   # Here is the profile.  This is for about 2MB of data, for the
+    # Here is the profile (using request.POST).  This is for about 2MB of data, for the
     # 'accelerometer' sensor:
     #    ncalls  tottime  percall  cumtime  percall filename:lineno(function)
     #     1    0.000    0.000    1.439    1.439 {built-in method builtins.exec}
@@ -693,35 +716,52 @@ def insert(request, secret_id, table, indexphp=None):
     # and no data can come out.  Unlike most devices, we must update
     # some internal state on POSTing, thus an unauthenticated getting
     # of a device class.
-
+    upload = _insert_parse(request, device, table)
+    if isinstance(upload, HttpResponse):
+        return upload
+    _insert_save(request, device, table, upload)
+    return _insert_response(upload)
+
+@util.accept_compressed_body
+async def ainsert(request, secret_id, table, indexphp=None):
+    """insert() as an async view, for ASGI deployments.
+
+    The device lookup usually comes from the device cache, the body
+    is parsed in a worker thread, and only the final save uses the
+    database.  See kviews.apost().
+    """
+    # pylint: disable=unused-argument
+    device = await models.Device.aget_by_secret_id(secret_id)
+    upload = await sync_to_async(_insert_parse, thread_sensitive=False)(
+        request, device, table)
+    if isinstance(upload, HttpResponse):
+        return upload
+    await util.db_sync_to_async(_insert_save)(request, device, table, upload)
+    return _insert_response(upload)
+ainsert.csrf_exempt = True
+
+def _insert_parse(request, device, table):
+    """Parse an AWARE insert into packets.  No database use.
+
+    Returns a dict, or an error response.
+    """
     #device_uuid = request.POST['device_id']
     try:
-        POST = request.POST
+        POST = _insert_post_data(request)
     except UnreadablePostError:
         return JsonResponse(dict(error="Data not received"),
                             status=400, reason="Data not received")
     data = POST['data']
+    if isinstance(data, str):
+        data = data.encode('utf8')
     try:
         data_decoded = loads(data)
-    except JSONDecodeError as e:
+    except (JSONDecodeError, UnicodeDecodeError) as e:
         LOGGER.error("Aware JsonDecodeError 1: (%s) (%s): %s %s",
                      str(e), len(data), device.public_id, data[-10:])
         raise
 
-    #body = request.body.decode().encode().decode() # bytes->str
-    #pairs = FIELDS_MATCH.split(body)
-    #POST = { }
-    #for name_value in pairs:
-    #    if not name_value: continue
-    #    nv = name_value.split('=', 1)
-    #    if len(nv) < 2: continue
-    #    name = nv[0].replace('+', ' ')
-    #    name = re.sub('%[0-9A-Fa-f]{2}', lambda x: _hextostr[x.group()], name)
-    #    value = nv[1].replace('+', ' ')
-    #    value = re.sub('%[0-9A-Fa-f]{2}', lambda x: _hextostr[x.group()], value)
-    #    POST[name] = value
-
-    data_sha256 = sha256(data.encode('utf8')).hexdigest()
+    data_sha256 = sha256(data).hexdigest()
 
     timestamp_column_name = 'timestamp'
     if 'double_end_timestamp' in data_decoded[0]:
@@ -735,35 +775,103 @@ def insert(request, secret_id, table, indexphp=None):
     #data_with_probe = dumps(dict(table=table, data=data))
     #kviews.save_data(data_with_probe, device_id=device.device_id, request=request)
 
-    # In this section, store data in chunks of size 500-1000.
+    # In this section, store data in chunks of size 500-1000.  All
+    # chunks are built first, then written with one multi-row INSERT.
+    # max_ts ends up as the max of the last chunk, which is what the
+    # last-ts watermark has always been set to.
     chunk_size = PACKET_CHUNK_SIZE
     data_separated = ( data_decoded[x:x+chunk_size]
                        for x in range(0, len(data_decoded), chunk_size) )
-    with transaction.atomic():
-        for data_chunk in data_separated:
-            max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
-            data_chunk = dumps(data_chunk)
-            # pylint: disable=redefined-variable-type
-            data_to_save = dict(table=table,
-                                data=data_chunk,
-                                timestamp=time.time(),
-                                version=1)
-            data_to_save = dumps(data_to_save)
-            #max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
-            kviews.save_data(data_to_save, device_id=device.device_id, request=request)
-            device.attrs['aware-last-ts-%s'%table] = max_ts
+    packets = [ ]
+    probes = [ ]
+    for data_chunk in data_separated:
+        max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
+        probes.append([_table_meta(table, data_chunk)])
+        data_chunk = dumps(data_chunk)
+        # pylint: disable=redefined-variable-type
+        data_to_save = dict(table=table,
+                            data=data_chunk,
+                            timestamp=time.time(),
+                            version=1)
+        packets.append(dumps(data_to_save))
+    nonce = POST.get('nonce')
+    if isinstance(nonce, bytes):
+        nonce = nonce.decode('utf8', 'replace')
+    return dict(packets=packets, probes=probes, max_ts=max_ts,
+                data_sha256=data_sha256, nonce=nonce)
+
+def _insert_save(request, device, table, upload):
+    """Save the packets of an AWARE insert."""
+    # Important conclusion: we must store the last timestamp, and
+    # atomically with the data itself.  The spool applies the
+    # attribute when the packets are drained.
+    last_ts_attr = 'aware-last-ts-%s'%table
+    if spool.enabled():
+        spool.append(upload['packets'], device_id=device.device_id, request=request,
+                     attrs={last_ts_attr: upload['max_ts']}, probes=upload['probes'])
+    else:
+        with transaction.atomic():
+            kviews.save_data_batch(upload['packets'], device_id=device.device_id,
+                                   request=request,
+                                   device_class=devices.get_class(device.type),
+                                   probes=upload['probes'])
+            device.attrs[last_ts_attr] = upload['max_ts']
 
-    # Important conclusion: we must store the last timestamp.  Really
-    # this and the section above should be an atomic operation!
+def packet_probes(data):
+    """The table of a stored packet, as a DataProbe list.
+
+    Returns [] if the packet can't be parsed.
+    """
+    try:
+        packet = loads(data)
+    except ValueError:
+        return [ ]
+    if not isinstance(packet, dict) or not isinstance(packet.get('table'), str):
+        return [ ]
+    try:
+        rows = loads(packet['data'])
+    except (KeyError, TypeError, ValueError):
+        rows = None
+    return [_table_meta(packet['table'], rows)]
+
+def _table_meta(table, rows):
+    """DataProbe dict of the rows of one table (in unix time)."""
+    if not isinstance(rows, list):
+        return dict(probe=table)
+    timestamps = [ ]
+    for row in rows:
+        try:
+            timestamps.append(float(row['timestamp'])/1000.)
+        except (KeyError, TypeError, ValueError):
+            pass
+    return dict(probe=table,
+                ts_min=min(timestamps, default=None),
+                ts_max=max(timestamps, default=None),
+                n_rows=len(rows))
+
+def _insert_response(upload):
+    max_ts = upload['max_ts']
     response = [dict(timestamp=max_ts,
                      double_end_timestamp=max_ts,
                      double_esm_user_answer_timestamp=max_ts,
-                     data_sha256=data_sha256),]
-    if 'nonce' in POST:
-        response[0]['nonce'] = POST['nonce']
+                     data_sha256=upload['data_sha256']),]
+    if upload['nonce'] is not None:
+        response[0]['nonce'] = upload['nonce']
     #device.attrs['aware-last-ts-%s'%table] = max_ts
     return JsonResponse(response, safe=False)
 
+def _insert_post_data(request):
+    """POST fields of an AWARE insert, as a dict.
+
+    For urlencoded bodies (what the AWARE client sends), parse
+    request.body directly with util.parse_urlencoded.  Values are
+    left as bytes.  Anything else (multipart) goes through the normal
+    request.POST.
+    """
+    if request.content_type == 'application/x-www-form-urlencoded':
+        return util.parse_urlencoded(request.body, encoding=None)
+    return request.POST
+
 @csrf_exempt
 def clear_table(request, secret_id, table, indexphp=None):
     """AWARE client requesting to clear a table.  Nullop for us."""
@@ -847,7 +955,8 @@ urlpatterns = [
         name='aware-create-table'),
     url(r'^v1/(?:1/)?(?P<secret_id>[0-9a-f]+)?/(?P<table>\w+)/latest$', latest,
         name='aware-latest'),
-    url(r'^v1/(?:1/)?(?P<secret_id>[0-9a-f]+)?/(?P<table>\w+)/insert$', insert,
+    url(r'^v1/(?:1/)?(?P<secret_id>[0-9a-f]+)?/(?P<table>\w+)/insert$',
+        ainsert if getattr(settings, 'KOOTA_ASYNC_INGEST', False) else insert,
         name='aware-insert'),
     url(r'^v1/(?:1/)?(?P<table>\w+)/clear_table$', clear_table,
         name='aware-clear-table'),
@@ -1,5 +1,6 @@
 """Base classes for devices.
 """
+import importlib
 import six
 
 from .. import converter
@@ -27,6 +28,34 @@ all_device_choices = [('PurpleRobot', "Purple Robot") ]
 device_class_lookup = { }
 # List with each actual class object.
 all_device_classes = [ ]
+# Device types stored under a name which is not importable, and the
+# module which registers them.  get_class() imports these on first
+# use, so a process does not need to import every device module at
+# startup (see koota_prj/settings_ingest.py).
+lazy_device_modules = {
+    'Aware': 'kdata.devices.aware',
+    'AwareValidCert': 'kdata.devices.aware',
+    'PurpleRobot': 'kdata.devices.purplerobot',
+    'Ios': 'kdata.devices.ios',
+    'Android': 'kdata.devices.android',
+    'MurataBSN': 'kdata.devices.muratabsn',
+    'kdata.devices.Actiwatch': 'kdata.devices.actiwatch',
+    'kdata.funf.FunfJournal': 'kdata.devices.funf',
+    'kdata.facebook.Facebook': 'kdata.devices.facebook',
+    'kdata.instagram.Instagram': 'kdata.devices.instagram',
+    'kdata.twitter.Twitter': 'kdata.devices.twitter',
+    }
+# What the ingest path must know about the classes of the lazy
+# device types without importing them: 'inline_hooks' and
+# 'async_hooks' if the class has such ingest_hooks, 'probe_meta' if
+# it records the probes of packets.  test_ingest_app checks this
+# against the classes.
+lazy_ingest_features = {
+    'Aware': {'probe_meta'},
+    'AwareValidCert': {'probe_meta'},
+    'PurpleRobot': {'probe_meta'},
+    'kdata.devices.Actiwatch': {'inline_hooks'},
+    }
 
 def get_choices(all=False):
     """Get the device classes.
@@ -106,9 +135,12 @@ def get_class(name, default=None):
     """Get a device class by (string) name.
 
     Option 1: from this device_class_lookup
-    Option 2: import it, if it contains a '.'.
-    Option 3: return generic device BaseDevice.
+    Option 2: import its module from lazy_device_modules, then 1.
+    Option 3: import it, if it contains a '.'.
+    Option 4: return generic device BaseDevice.
     """
+    if name not in device_class_lookup and name in lazy_device_modules:
+        importlib.import_module(lazy_device_modules[name])
     if name in device_class_lookup:
         device = device_class_lookup[name]
     else:
@@ -164,6 +196,22 @@ class BaseDevice(object):
     config_instructions_template = None
     # Like above, but a django template filename loaded using the normal means.
     config_instructions_template_file = None
+    # Largest single upload accepted, in bytes.  None means
+    # settings.KOOTA_MAX_UPLOAD_SIZE, see util.max_upload_size().
+    max_upload_size = None
+    # If set, packets longer than max_packet_size bytes are stored as
+    # several smaller packets, split by packet_splitter: a name from
+    # util.PACKET_SPLITTERS ('lines', 'json') or a function
+    # (data, max_size) -> list of pieces.
+    max_packet_size = None
+    packet_splitter = None
+    # Post-ingest hooks: list of kdata.hooks.Hook.
+    ingest_hooks = [ ]
+    # If set, a function (data) -> list of dict(probe=, ts_min=,
+    # ts_max=, n_rows=) of the probes (or tables) with readings in a
+    # stored packet.  These are saved in the DataProbe table at
+    # ingest, and converters then select packets by probe in SQL.
+    probe_meta = None
 
     def __init__(self, dbrow):
         """Bind a DB row to this"""
@@ -1,5 +1,6 @@
 import json
 from json import loads, dumps
+import os
 import sqlite3
 import tempfile
 import textwrap
@@ -62,7 +63,6 @@ def log(request, device_id=None, device_class=None):
 def process_post(request, device_id=None, device_class=None):
     #logger.info('funf data: %r'%request.FILES)
     upload = request.FILES['uploadedfile']
-    import os
     #logger.info(os.getcwd())
     #f = open('funf-data/%s'%upload.name, 'wb')
     #f.write(repr(request.body))
@@ -70,25 +70,39 @@ def process_post(request, device_id=None, device_class=None):
     #f.close()
     #logger.info('file size: %s'%upload.size)
     upload_data = { }
-    with tempfile.NamedTemporaryFile(dir='/tmp', prefix='tmp-funf-db-', delete=False) as tfile:
-        #logger.info(tfile.name)
-        data = upload.read()
-        if b'SQLite' not in data[:20]:
-            data = funf_decrypt.decrypt2(data, '', b'changeme')
-        #logger.info(data[:80])
-        tfile.write(data)
-        tfile.flush()
-        conn = sqlite3.connect(tfile.name)
+    data = upload.read()
+    if b'SQLite' not in data[:20]:
+        data = funf_decrypt.decrypt2(data, None, b'changeme')
+    conn, tmp_name = _open_sqlite_image(data)
+    try:
         upload_data['data'] = conn.execute('select * from data').fetchall()
         upload_data['android_metadata'] = conn.execute('select * from android_metadata').fetchall()
         upload_data['file_info'] = conn.execute('select * from file_info').fetchall()
         upload_data['ts_received'] = time.time()
         upload_data['filename'] = upload.name
-    conn.close()
+    finally:
+        conn.close()
+        if tmp_name is not None:
+            os.unlink(tmp_name)
 
     return dumps(upload_data)
     return JsonResponse(dict(status='success'))
 
+def _open_sqlite_image(data):
+    """Open an sqlite database file image (bytes), in memory if possible.
+
+    Returns (connection, tempfile name or None).  Without
+    sqlite3.deserialize (Python < 3.11), the image is written to a
+    temporary file which the caller must remove.
+    """
+    if hasattr(sqlite3.Connection, 'deserialize'):
+        conn = sqlite3.connect(':memory:')
+        conn.deserialize(data)
+        return conn, None
+    with tempfile.NamedTemporaryFile(prefix='tmp-funf-db-', delete=False) as tfile:
+        tfile.write(data)
+    return sqlite3.connect(tfile.name), tfile.name
+
 config_v1 = """\
         {"@type":"edu.mit.media.funf.pipeline.BasicPipeline",
          "name":"remote_pipeline",
@@ -23,6 +23,7 @@
 
 '''Decrypt one or more files using the provided key
 '''
+import functools
 from optparse import OptionParser
 import shutil
 import os.path
@@ -39,8 +40,13 @@ _salt = b'\xa6\xab\x09\x93\xf4\xcc\xee\x10'
 _key_size = 8
 _block_size = 8
 
+@functools.lru_cache(maxsize=128)
 def key_from_password(password, salt=_salt, iterations=_iterations):
-    '''Imitate java's PBEWithMD5AndDES algorithm to produce a DES key'''
+    '''Imitate java's PBEWithMD5AndDES algorithm to produce a DES key
+
+    The result is cached, since the 135 MD5 rounds are the slowest part
+    of decrypting a small upload.
+    '''
     from Crypto.Hash import MD5
     hasher = MD5.new()
     hasher.update(password)
@@ -54,7 +60,6 @@ def key_from_password(password, salt=_salt, iterations=_iterations):
         #print test
 
     key = result[:8]
-    print(repr(key))
 
     # TODO: Not likely, but may need to adjust for twos complement in java
 
@@ -95,7 +100,7 @@ def iter_has_next(iterable):
 
 def decrypt(file_names, key, extension=None):
     assert key != None
-    decryptor = DES.new(key)
+    decryptor = DES.new(key, DES.MODE_ECB)
     for file_name in file_names:
         
         # Iteratively read 8 byte blocks, decrypt, and write to temp file
@@ -115,11 +120,11 @@ def decrypt(file_names, key, extension=None):
 
 import io
 def decrypt2(data, key, password=None):
+    """Decrypt data in memory, with the key or the key of password."""
     if password is not None:
         key = key_from_password(password)
-    print(repr(key))
     assert key != None
-    decryptor = DES.new(key)
+    decryptor = DES.new(key, DES.MODE_ECB)
 
     #output = [ ]
     #encrypted_file = io.BytesIO(data)
@@ -133,7 +138,7 @@ def decrypt2(data, key, password=None):
     #    output.append(data)
     #output[-1] = remove_padding(output[-1])
 
-    return(decryptor.decrypt(data))
+    return remove_padding(decryptor.decrypt(data))
 
 
 
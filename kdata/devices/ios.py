@@ -15,6 +15,9 @@ class Ios(BaseDevice):
                   converter.IosLocation,
                   converter.IosScreen,
                  ]
+    # Early app versions uploaded unboundedly large JSON arrays.
+    max_packet_size = 2**20
+    packet_splitter = 'json'
     @classmethod
     def configure(cls, device):
         """Special options for configuration
@@ -5,12 +5,14 @@ https://github.com/cbitstech/Purple-Robot
 """
 import hashlib
 import json
+import re
 import textwrap
 
 from django.http import HttpResponseBadRequest, JsonResponse, UnreadablePostError
 from django.urls import reverse_lazy
 
 from .. import converter
+from .. import util
 from ..devices import BaseDevice, register_device
 
 
@@ -55,6 +57,10 @@ class PurpleRobot(BaseDevice):
                   converter.PRMissingData,
                   converter.PRRecentDataCounts,
                   ]
+    @staticmethod
+    def probe_meta(data):
+        """Probes of a packet, see BaseDevice.probe_meta."""
+        return payload_probes(data)
     @classmethod
     def configure(cls, device):
         """Initial device configuration"""
@@ -106,29 +112,37 @@ class PurpleRobot(BaseDevice):
         pass
     @classmethod
     def post(cls, request):
-        request.encoding = ''
         try:
-            data = json.loads(request.POST['json'])
+            envelope, raw_envelope = _upload_envelope(request)
+            Operation = envelope['Operation']
+            UserHash = envelope['UserHash']
+            Payload = envelope['Payload']
         except UnreadablePostError:
             return JsonResponse(dict(error="Data not received"),
                                 status=400, reason="Data not received")
-        Operation = data['Operation']
-        UserHash = data['UserHash']
-        Payload = data['Payload']
-        # Check the hash
-        m = hashlib.md5()
-        # This re-encoding to utf-8 is inefficient, when we originally
-        # got raw binary data, is inefficient.  However, django is
-        # fully unicode aware, and there is no easy way to tell it to
-        # "not decode anything".  So, this is the workaround.
-        m.update((UserHash+Operation+Payload).encode('utf-8'))
-        checksum = m.hexdigest()
-        if checksum != data['Checksum']:
-            return HttpResponseBadRequest("Checksum mismatch",
-                                    content_type="text/plain")
+        except (KeyError, TypeError, ValueError):
+            return HttpResponseBadRequest("Invalid upload",
+                                          content_type="text/plain")
+        # Check the hash.  Clients sign the payload text, which is
+        # what the envelope decodes to.  If that does not match, the
+        # payload bytes as sent (still JSON-escaped) are tried too, so
+        # that the way a client escapes its JSON can't make a valid
+        # upload fail.  The encoded payload is what we store.
+        Payload = Payload.encode('utf-8', 'surrogatepass')
+        prefix = (UserHash+Operation).encode('utf-8')
+        checksum = envelope.get('Checksum')
+        if _md5(prefix, Payload) != checksum:
+            raw_payload = _raw_payload(raw_envelope)
+            if raw_payload is None or _md5(prefix, raw_payload) != checksum:
+                return HttpResponseBadRequest("Checksum mismatch",
+                                              content_type="text/plain")
+        # The only parse of the payload: the probes are found from it.
+        try:
+            readings = json.loads(Payload)
+        except ValueError:
+            readings = None
         #
         #device_id = UserHash
-        #data = json.loads(Payload)
         data = Payload
 
         # Construct HTTP response that will allow PR to recoginze success.
@@ -145,4 +159,69 @@ class PurpleRobot(BaseDevice):
                     # useful to us.  This info must be found some
                     # other way.
                     #device_id=device_id,
+                    probes=readings_probes(readings),
                     response=response)
+
+
+
+def _upload_envelope(request):
+    """The JSON envelope of an upload (the "json" form field).
+
+    Returns (parsed envelope, envelope as bytes).  For urlencoded
+    bodies, the field is taken from the raw body as bytes and parsed
+    from that, instead of going through request.POST (which decodes
+    the whole body to str first).
+    """
+    if request.content_type == 'application/x-www-form-urlencoded':
+        raw = util.parse_urlencoded(request.body, encoding=None)['json']
+    else:
+        raw = request.POST['json'].encode('utf-8')
+    return json.loads(raw), raw
+
+_PAYLOAD_RE = re.compile(rb'"Payload"\s*:\s*"((?:[^"\\]+|\\.)*)"', re.S)
+
+def _raw_payload(raw_envelope):
+    """The Payload string of an envelope as sent, without unescaping.
+
+    None if it can't be found.
+    """
+    m = _PAYLOAD_RE.search(raw_envelope)
+    return m.group(1) if m else None
+
+def _md5(*parts):
+    m = hashlib.md5()
+    for part in parts:
+        m.update(part)
+    return m.hexdigest()
+
+def payload_probes(payload):
+    """The probes with readings in a payload, sorted by name.
+
+    See readings_probes().  Returns [] if the payload can't be parsed.
+    """
+    try:
+        readings = json.loads(payload)
+    except ValueError:
+        return [ ]
+    return readings_probes(readings)
+
+def readings_probes(readings):
+    """The probes in a parsed payload (list of readings), sorted by name.
+
+    A list of dict(probe, ts_min, ts_max, n_rows), with the range of
+    the TIMESTAMPs of the readings.
+    """
+    if not isinstance(readings, list):
+        return [ ]
+    probes = { }
+    for r in readings:
+        if not isinstance(r, dict) or not isinstance(r.get('PROBE'), str):
+            continue
+        probe = probes.setdefault(r['PROBE'], dict(probe=r['PROBE'], ts_min=None,
+                                                   ts_max=None, n_rows=0))
+        probe['n_rows'] += 1
+        ts = r.get('TIMESTAMP')
+        if isinstance(ts, (int, float)):
+            probe['ts_min'] = ts if probe['ts_min'] is None else min(probe['ts_min'], ts)
+            probe['ts_max'] = ts if probe['ts_max'] is None else max(probe['ts_max'], ts)
+    return [ probes[name] for name in sorted(probes) ]
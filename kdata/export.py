@@ -0,0 +1,191 @@
+"""Fast raw data downloads with PostgreSQL COPY.
+
+Downloading a device's raw packets (the Raw converter, csv and
+json-lines formats) normally makes a Python object of every row and
+formats it in Python, which dominates the time for devices with
+gigabytes of data.  On PostgreSQL, raw_export() instead has the
+database format the rows:
+
+    COPY (SELECT ... FROM kdata_data WHERE ...) TO STDOUT
+
+and streams its output as the response body.  The output is the same
+data as the normal download, though not byte for byte: csv lines end
+in '\\n' (not '\\r\\n'), and JSON strings have non-ASCII characters
+as they are, not as \\u escapes.
+
+The COPY runs in a thread with its own database connection, which
+hands chunks of output to the response through a bounded queue, so
+a slow client makes the COPY wait instead of buffering everything.
+Compressed packets (see Data.codec) can't be decompressed in SQL:
+their rows come out as a marker line, which is replaced in Python.
+
+On other databases, raw_export() returns None and the normal
+(keyset-paged, see util.keyset_queryset_iterator) download is used.
+"""
+
+import csv
+import io
+import json
+import queue
+import re
+import threading
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+from django.http import StreamingHttpResponse
+
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+FORMATS = ('csv', 'csv2', 'json-lines', 'json-lines2')
+HEADER = ['packet_time', 'data']
+
+# Rows of compressed packets start with this byte, which no normal
+# line does (they start with a digit or '[').
+MARKER = b'\x03'
+_EPOCH = 'floor(extract(epoch FROM ts))::bigint'
+# codec null or 0 (Data.CODEC_NONE): not compressed.
+_PLAIN = 'COALESCE(codec, 0) = 0'
+_MARKER_LINE = ("CASE WHEN "+_PLAIN+" THEN %s ELSE chr(3) || "+_EPOCH+" || ' ' || codec "
+                "|| ' ' || encode(data_z, 'hex') END")
+_COPY_SQL = {
+    # One column, as csv with a quote and delimiter which never occur
+    # in JSON text, so that the line is written out unchanged.
+    'json-lines': ('COPY (%s) TO STDOUT WITH (FORMAT csv, QUOTE e\'\\x01\', DELIMITER e\'\\x02\')',
+                   [_MARKER_LINE%('json_build_array('+_EPOCH+', data)::text')]),
+    'csv': ('COPY (%s) TO STDOUT WITH (FORMAT csv)',
+            [_MARKER_LINE%(_EPOCH+'::text'),
+             'CASE WHEN '+_PLAIN+' THEN data END']),
+    }
+
+
+def supported(queryset):
+    return connections[queryset.db].vendor == 'postgresql'
+
+def raw_export(queryset, format, filename_base):
+    """StreamingHttpResponse of the (ts, data) of a Data queryset.
+
+    Returns None if this database can't do it, or format is not one
+    of FORMATS.
+    """
+    if format not in FORMATS or not supported(queryset):
+        return None
+    kind = 'csv' if format.startswith('csv') else 'json-lines'
+    copy_sql, columns = _COPY_SQL[kind]
+    queryset = queryset.annotate(**{ 'c%d'%i: RawSQL(col, ())
+                                     for i, col in enumerate(columns) })
+    sql, params = queryset.values_list(*('c%d'%i for i in range(len(columns)))) \
+                          .query.sql_with_params()
+    body = _copy_chunks(queryset.db, copy_sql%sql, params)
+    if kind == 'csv':
+        header = io.StringIO()
+        csv.writer(header).writerow(HEADER)
+        body = _with_header(header.getvalue().encode('utf8'), body)
+    response = StreamingHttpResponse(_decode_markers(body, kind),
+                                     content_type='text/plain')
+    if format.endswith('2'):
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"'%(
+            filename_base, kind)
+    return response
+
+
+def _with_header(header, chunks):
+    yield header
+    yield from chunks
+
+def _decode_markers(chunks, kind):
+    """Replace the marker lines of compressed packets in COPY output."""
+    replace = lambda m: _decode_line(m, kind)
+    pending = b''
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+            pending = b''
+        if MARKER not in chunk:
+            yield chunk
+            continue
+        # Only complete lines can be decoded.
+        end = chunk.rfind(b'\n') + 1
+        chunk, pending = chunk[:end], chunk[end:]
+        yield _MARKER_RE.sub(replace, chunk)
+    if pending:
+        yield _MARKER_RE.sub(replace, pending)
+
+_MARKER_RE = re.compile(rb'^\x03(\d+) (\d+) ([0-9a-f]*),?$', re.M)
+
+def _decode_line(match, kind):
+    """One marker line (ts, codec, hex data_z) as an output line."""
+    ts, codec, data_z = match.groups()
+    data = models.Data.decode('', bytes.fromhex(data_z.decode('ascii')), int(codec))
+    if kind == 'csv':
+        out = io.StringIO()
+        csv.writer(out, lineterminator='').writerow([int(ts), data])
+        return out.getvalue().encode('utf8')
+    return json.dumps([int(ts), data]).encode('utf8')
+
+
+class _Stopped(Exception):
+    pass
+
+def _copy_chunks(alias, sql, params, chunk_size=2**16, max_chunks=16):
+    """Run a COPY ... TO STDOUT in a thread, yield its output in chunks."""
+    chunks = queue.Queue(max_chunks)
+    stop = threading.Event()
+    def put(item):
+        while True:
+            if stop.is_set():
+                raise _Stopped()
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+    class Writer(object):
+        # psycopg2 calls write() once per row.
+        def __init__(self):
+            self.buffer = [ ]
+            self.size = 0
+        def write(self, data):
+            self.buffer.append(data)
+            self.size += len(data)
+            if self.size >= chunk_size:
+                self.flush()
+        def flush(self):
+            if self.buffer:
+                put(b''.join(self.buffer))
+                self.buffer = [ ]
+                self.size = 0
+    def run():
+        connection = connections[alias]
+        try:
+            with connection.cursor() as c:
+                writer = Writer()
+                c.copy_expert(c.mogrify(sql, params).decode('utf8'), writer)
+                writer.flush()
+            put(None)
+        except _Stopped:
+            pass
+        except Exception as e:
+            logger.exception("export: COPY failed")
+            try:
+                put(e)
+            except _Stopped:
+                pass
+        finally:
+            connection.close()
+    thread = threading.Thread(target=run, name='koota-export', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Also when the client went away: make the COPY stop.
+        stop.set()
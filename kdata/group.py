@@ -297,22 +297,15 @@ def iter_group_data(group,
         # filter_queryset callback.)
         if hasattr(converter_class, 'query'):
             queryset = converter_class.query(queryset)
+        queryset = converter_class.select_packets(queryset, device)
         if group.ts_start: queryset = queryset.filter(ts__gte=group.ts_start)
         if group.ts_end:   queryset = queryset.filter(ts__lt=group.ts_end)
         if filter_queryset:
             queryset = filter_queryset(queryset)
 
-        # Apply the converter.
-
-        # If row_limit, we are looking at the HTML pages, and display
-        # is reversed (see above).  In this case, we have to use
-        # optimized_queryset_iterator_1.  It is slower, but it doesn't
-        # matter since we have fewer rows.
-        if row_limit and reverse_html_order:
-            queryset = util.optimized_queryset_iterator_1(queryset)
-        else:
-            queryset = util.optimized_queryset_iterator(queryset)
-        rows = ((x.ts, x.data) for x in queryset)
+        # Apply the converter.  The rows are read in pages, also
+        # when the display is reversed (see above).
+        rows = util.keyset_queryset_iterator(queryset)
         converter = converter_class(rows=rows,
                                     time=time_converter,
                                     hash_seed=hash_seed,
@@ -454,6 +447,7 @@ def group_data_json(request, group_name, converter):
         queryset = models.Data.objects.filter(device_id=device.device_id, ).order_by('ts')
         if hasattr(converter_class, 'query'):
             queryset = converter_class.query(queryset)
+        queryset = converter_class.select_packets(queryset, device)
         if group.ts_start: queryset = queryset.filter(ts__gte=group.ts_start)
         if group.ts_end:   queryset = queryset.filter(ts__lt=group.ts_end)
         # This does start/end time and reversing, not needed here
@@ -689,13 +683,13 @@ def group_stats(request, group_name):
     count = 0
     bytes = 0
 
-    for subject, device in iter_users_devices(group, groupcls, group_converter_class=None):
+    device_ids = [ device.device_id for subject, device
+                   in iter_users_devices(group, groupcls, group_converter_class=None) ]
+    stats = models.DeviceStats.get_many(device_ids)
+    for device_id in device_ids:
         devices += 1
-        #print(device.backend.count())
-        count += device.backend.count()
-        bytes_device = device.backend.bytes_total()
-        if bytes_device:
-            bytes += bytes_device
+        count += stats[device_id].n_packets
+        bytes += stats[device_id].bytes_total
     data = ["devices: %s"%devices,
             "count: %s"%count,
                 "bytes: %s"%util.human_bytes(bytes)]
@@ -0,0 +1,211 @@
+"""Post-ingest hooks.
+
+Device classes can list hooks in .ingest_hooks, to process packets
+after they are received:
+
+    ingest_hooks = [ hooks.Hook(validate_header, inline=True),
+                     hooks.Hook(index_packet, max_attempts=3),
+                   ]
+
+Inline hooks run inside the upload request (views.post, post_batch
+and the upload form), before the packet is saved: func(data,
+device_id=, request=) returns the (maybe modified) data, or raises
+hooks.Rejected to refuse the upload with a 400.  Use these only for
+cheap validation and for changes which must happen before the data
+is stored (like Actiwatch's privacy scrubbing), since the client
+waits.
+
+Asynchronous hooks run later: func(row) with the saved models.Data
+row.  When a packet is saved, one IngestJob row per hook is inserted
+in the same transaction, and the "run_hooks" management command
+runs the queued jobs.  So they only ever see committed data and add
+nothing to upload latency except the job INSERT.  A worker claims a
+batch of jobs for lease seconds in a short transaction, then runs
+each hook outside of it, so a slow hook doesn't block the other
+workers.  A hook which raises is retried after retry_delay,
+2*retry_delay, 4*retry_delay, ... seconds, up to max_attempts times,
+and then marked failed (see the IngestJob table).  A job whose
+worker died is run again when its lease expires.
+
+Device types which are imported lazily (devices.lazy_device_modules)
+must be listed in devices.lazy_ingest_features if they have hooks.
+
+Per-hook call counts, errors and run times are kept per process: the
+stats page shows them for inline hooks, run_hooks prints them.
+"""
+
+import collections
+from datetime import timedelta
+import threading
+import time
+import traceback
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import devices
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    """Raised by inline hooks to refuse an upload."""
+    def __init__(self, message):
+        super(Rejected, self).__init__(message)
+        self.message = message
+
+
+# All hooks by name, for the worker to find them.
+registry = { }
+
+class Hook(object):
+    """One post-ingest hook, see module docstring."""
+    def __init__(self, func, inline=False, max_attempts=5, retry_delay=60,
+                 name=None):
+        self.func = func
+        self.inline = inline
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        if name is None:
+            name = '%s.%s'%(func.__module__, func.__qualname__)
+        self.name = name
+        registry[name] = self
+    def __repr__(self):
+        return '<Hook %s%s>'%(self.name, ' (inline)' if self.inline else '')
+
+
+class HookStats(object):
+    """Per-process call counts and timings of hooks."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(collections.Counter)
+    def add(self, name, seconds, error=False):
+        with self._lock:
+            s = self._stats[name]
+            s['calls'] += 1
+            s['errors'] += int(error)
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+    def stats(self):
+        """{hook_name: dict(calls, errors, seconds, max_seconds)}"""
+        with self._lock:
+            return { name: dict(s) for name, s in self._stats.items() }
+
+stats = HookStats()
+
+def _timed(hook, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        ret = hook.func(*args, **kwargs)
+    except Exception:
+        stats.add(hook.name, time.perf_counter()-start, error=True)
+        raise
+    stats.add(hook.name, time.perf_counter()-start)
+    return ret
+
+
+def inline_hooks(device_class):
+    return [ h for h in getattr(device_class, 'ingest_hooks', ()) if h.inline ]
+
+def async_hooks(device_class):
+    return [ h for h in getattr(device_class, 'ingest_hooks', ()) if not h.inline ]
+
+def any_hooks(inline):
+    """True if any device class has inline (or async) hooks.
+
+    Used to avoid looking up the device class of packets when no class
+    needs it.
+    """
+    feature = 'inline_hooks' if inline else 'async_hooks'
+    if any(feature in features for features in devices.lazy_ingest_features.values()):
+        return True
+    for cls in devices.all_device_classes:
+        for h in getattr(cls, 'ingest_hooks', ()):
+            if h.inline == inline:
+                return True
+    return False
+
+
+def run_inline(device_class, data, device_id, request=None):
+    """Run the inline hooks of device_class on data, return new data.
+
+    Raises Rejected if a hook refuses the data.
+    """
+    for hook in inline_hooks(device_class):
+        data = _timed(hook, data, device_id=device_id, request=request)
+    return data
+
+def enqueue(device_class, rows):
+    """Queue the async hooks of device_class for saved Data rows.
+
+    Call this in the same transaction which inserted the rows.  The
+    rows must have their ids (see ingest.inserted_ids).
+    """
+    hooks = async_hooks(device_class)
+    if not hooks:
+        return
+    if any(row.id is None for row in rows):
+        raise ValueError("hooks.enqueue: rows without ids, can't queue %s"%hooks)
+    jobs = [ models.IngestJob(data_id=row.id, device_id=row.device_id, hook=hook.name)
+             for row in rows
+             for hook in hooks ]
+    models.IngestJob.objects.bulk_create(jobs)
+
+
+def run_pending(batch_size=100, lease=600):
+    """Run queued async hook jobs which are due.  Returns number run.
+
+    The jobs are claimed for lease seconds: they are locked with
+    SELECT ... FOR UPDATE SKIP LOCKED (on databases which support
+    it) and their not_before moved ahead, in a transaction of their
+    own, so several workers can run at once.  The hooks then run
+    outside of that transaction.
+    """
+    with transaction.atomic():
+        jobs = list(models.IngestJob.objects.select_for_update(skip_locked=True)
+                    .filter(failed=False, not_before__lte=timezone.now())
+                    .order_by('id')[:batch_size])
+        if not jobs:
+            return 0
+        models.IngestJob.objects.filter(id__in=[ job.id for job in jobs ]).update(
+            not_before=timezone.now() + timedelta(seconds=lease))
+    rows = models.Data.objects.in_bulk([ job.data_id for job in jobs ])
+    for job in jobs:
+        if _run_job(job, rows.get(job.data_id)):
+            with transaction.atomic():
+                models.IngestJob.objects.filter(id=job.id).delete()
+    return len(jobs)
+
+def _run_job(job, row):
+    """Run one job.  Returns True if it is done (or can never succeed).
+
+    If it failed, the retry (or failure) is saved in the job.
+    """
+    hook = registry.get(job.hook)
+    if hook is None:
+        logger.error("hooks: unknown hook %s, job %d dropped", job.hook, job.id)
+        return True
+    if row is None:
+        logger.warning("hooks: packet %d is gone, job %d dropped", job.data_id, job.id)
+        return True
+    try:
+        # The database changes of a hook are all or nothing.
+        with transaction.atomic():
+            _timed(hook, row)
+        return True
+    except Exception:
+        job.attempts += 1
+        job.last_error = traceback.format_exc()
+        if job.attempts >= hook.max_attempts:
+            job.failed = True
+            logger.error("hooks: %s failed on packet %d, giving up: %s",
+                         hook.name, job.data_id, job.last_error)
+        else:
+            job.not_before = timezone.now() + timedelta(
+                seconds=hook.retry_delay * 2**(job.attempts-1))
+            logger.warning("hooks: %s failed on packet %d (attempt %d)",
+                           hook.name, job.data_id, job.attempts)
+        job.save(update_fields=['attempts', 'last_error', 'failed', 'not_before'])
+        return False
@@ -0,0 +1,160 @@
+"""Saving uploaded packets: the parts shared by the views and the spool.
+
+views.save_data() and save_data_batch() save packets directly, and
+spool.drain() saves spooled ones.  Both build the Data rows, look up
+the device class when it matters, and store the probes of the
+packets with the helpers here.
+"""
+
+from datetime import timedelta
+from hashlib import sha256
+import uuid
+
+from django.utils import timezone
+
+from . import devices
+from . import exceptions
+from . import hooks
+from . import models
+from . import util
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+
+def save_probes(rows, probes):
+    """Insert the DataProbe rows of a saved packet (all its pieces)."""
+    models.DataProbe.objects.bulk_create(models.DataProbe.for_rows(rows, probes))
+
+def inserted_ids(rows):
+    """Set the ids of bulk inserted rows, if the database did not return them.
+
+    This is for sqlite, where the transaction which inserted the rows
+    holds the database write lock, so they have the highest ids.
+    """
+    if rows and rows[0].id is None:
+        ids = models.Data.objects.order_by('-id').values_list('id', flat=True)[:len(rows)]
+        for row, id_ in zip(rows, reversed(list(ids))):
+            row.id = id_
+
+def packet_probes(device_class, data):
+    """Probes of a packet from its device class's probe_meta, if any."""
+    if device_class is None or getattr(device_class, 'probe_meta', None) is None:
+        return None
+    return device_class.probe_meta(data)
+
+def check_device_id(device_id):
+    """Normalize and validate a device_id data is being saved under."""
+    device_id = device_id.lower()
+    if not util.check_checkdigits(device_id):
+        raise exceptions.InvalidDeviceID("Invalid device ID: checkdigits invalid.")
+    return device_id
+
+def remote_ip(request):
+    """Remote IP address to record for data saved from this request."""
+    if request is None:
+        return '127.0.0.1'
+    return request.META['REMOTE_ADDR']
+
+def data_row(data, device_id, remote_ip, received_ts=None, data_ts=None,
+             data_sha256=None):
+    """Create (but do not save) the models.Data row for one packet.
+
+    All timestamps are set here, so that a single INSERT is enough.
+    """
+    if not isinstance(data, (str, bytes)):
+        raise ValueError("save_data data must be str or bytes!")
+    if data_sha256 is None:
+        data_sha256 = sha256(data if isinstance(data, bytes)
+                             else data.encode('utf8')).hexdigest()
+    now = timezone.now()
+    received_ts = to_datetime(received_ts) if received_ts is not None else now
+    data_ts = to_datetime(data_ts) if data_ts is not None else now
+    row = models.Data(device_id=device_id, ip=remote_ip, data=data,
+                      ts=data_ts, ts_received=received_ts,
+                      data_sha256=data_sha256,
+                      codec=models.Data.default_codec(len(data)))
+    row.data_length = len(data)
+    return row
+
+def packet_rows(data, device_id, remote_ip, received_ts=None, data_ts=None,
+                data_sha256=None, device_class=None):
+    """The models.Data rows to store one uploaded packet as.
+
+    Normally this is one row.  If the device class has a
+    max_packet_size and the packet is larger, it is split with the
+    class's packet_splitter.  The pieces share an upload_id and the
+    data_sha256 of the whole upload (so that re-uploads are still
+    found), and get timestamps one microsecond apart, so that they
+    keep their order.
+    """
+    pieces = util.split_packet(data, device_class)
+    if len(pieces) == 1:
+        return [ data_row(data, device_id, remote_ip, received_ts=received_ts,
+                          data_ts=data_ts, data_sha256=data_sha256) ]
+    if data_sha256 is None:
+        data_sha256 = sha256(data if isinstance(data, bytes)
+                             else data.encode('utf8')).hexdigest()
+    now = timezone.now()
+    received_ts = to_datetime(received_ts) if received_ts is not None else now
+    data_ts = to_datetime(data_ts) if data_ts is not None else now
+    upload_id = uuid.uuid4().hex
+    logger.debug("Splitting %d byte packet from device_id=%r into %d",
+                 len(data), device_id, len(pieces))
+    rows = [ ]
+    for i, piece in enumerate(pieces):
+        row = data_row(piece, device_id, remote_ip, received_ts=received_ts,
+                       data_ts=data_ts + timedelta(microseconds=i),
+                       data_sha256=data_sha256)
+        row.upload_id = upload_id
+        rows.append(row)
+    return rows
+
+def lookup_device_class(device_id):
+    """Device class of a device (through the device cache), None if unknown."""
+    try:
+        device = models.Device.get_by_secret_id(device_id)
+    except exceptions.InvalidDeviceID:
+        return None
+    return devices.get_class(device.type)
+
+def saving_device_class(device_id, device_class, length):
+    """Device class for saving a packet of this length, if it matters.
+
+    The class is only looked up if some device class could split a
+    packet this long, has async hooks to queue, or records the probes
+    of packets (probe_meta).
+    """
+    if device_class is None and (length > min_max_packet_size()
+                                 or hooks.any_hooks(inline=False)
+                                 or any_probe_meta()):
+        device_class = lookup_device_class(device_id)
+    return device_class
+
+def any_probe_meta():
+    """True if any device class defines probe_meta.
+
+    The lazily imported device types are known from
+    devices.lazy_ingest_features, whether imported yet or not.
+    """
+    if any('probe_meta' in features for features in devices.lazy_ingest_features.values()):
+        return True
+    return any(getattr(cls, 'probe_meta', None) is not None
+               for cls in devices.all_device_classes)
+
+def min_max_packet_size():
+    """Smallest max_packet_size of any device class (inf if none).
+
+    Packets smaller than this can't need splitting, so we don't have
+    to look up their device class.
+    """
+    sizes = [ cls.max_packet_size for cls in devices.all_device_classes
+              if getattr(cls, 'max_packet_size', None) is not None ]
+    return min(sizes, default=float('inf'))
+
+def to_datetime(ts):
+    """Convert unix timestamps to aware datetimes, pass datetimes through."""
+    if isinstance(ts, (int, float)):
+        ts = timezone.make_aware(timezone.datetime.fromtimestamp(ts))
+    return ts
@@ -0,0 +1,83 @@
+import ast
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from kdata import devices
+from kdata.models import Data, DataProbe, Device, DeviceStats
+
+class Command(BaseCommand):
+    help = ('Fill the DataProbe table for packets stored before it existed, '
+            'so that converters can select packets by probe')
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*',
+                            help="Only these devices (default: all devices whose "
+                                 "class has probe_meta, such as PurpleRobot and Aware).")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Only rows with id greater than this.  The devices "
+                                 "are then not marked as complete.")
+
+    def handle(self, *args, **options):
+        if options['device_id']:
+            device_rows = Device.objects.filter(device_id__in=options['device_id'])
+        else:
+            device_rows = Device.objects.all()
+        device_rows = list(device_rows.order_by('device_id').values_list('device_id', 'type'))
+        if options['device_id'] and len(device_rows) != len(set(options['device_id'])):
+            raise CommandError("Unknown device_id given")
+        n_rows = n_probes = 0
+        for device_id, type_ in device_rows:
+            probe_meta = getattr(devices.get_class(type_), 'probe_meta', None)
+            if probe_meta is None:
+                continue
+            rows, probes = self.backfill(device_id, probe_meta, options)
+            n_rows += rows
+            n_probes += probes
+            # Packets saved meanwhile got their probes at ingest.
+            if not options['start_id']:
+                DeviceStats.get(device_id)
+                DeviceStats.objects.filter(device_id=device_id).update(probes_complete=True)
+            if options['verbosity'] > 1:
+                print("%s: %d rows, %d probes"%(device_id, rows, probes))
+        if options['verbosity'] > 0:
+            print("%d rows, %d probes added"%(n_rows, n_probes))
+
+    def backfill(self, device_id, probe_meta, options):
+        """Fill the probes of one device's packets which don't have them.
+
+        Rows from before DataProbe had device_id are replaced.
+        Returns (packets done, probes added).
+        """
+        qs = Data.objects.filter(device_id=device_id)
+        last_id = options['start_id']
+        n_rows = n_probes = 0
+        while True:
+            ids = list(qs.filter(id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            done = set(DataProbe.objects.filter(data_id__in=ids, device_id__isnull=False)
+                       .values_list('data_id', flat=True))
+            todo = [ id_ for id_ in ids if id_ not in done ]
+            if not todo:
+                continue
+            new = [ ]
+            for row in Data.objects.filter(id__in=todo).only('id', 'device_id', 'data',
+                                                             'data_z', 'codec'):
+                data = row.data
+                # Uploads stored as their bytes repr, see backfill_sha256.
+                if data.startswith("b'") and data.endswith("'"):
+                    try:
+                        data = ast.literal_eval(data)
+                    except (ValueError, SyntaxError):
+                        pass
+                new.extend(DataProbe.for_rows([row], probe_meta(data)))
+            with transaction.atomic():
+                DataProbe.objects.filter(data_id__in=todo).delete()
+                DataProbe.objects.bulk_create(new)
+            n_rows += len(todo)
+            n_probes += len(new)
+        return n_rows, n_probes
@@ -0,0 +1,51 @@
+import ast
+from hashlib import sha256
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata.models import Data
+
+def stored_data_sha256(data):
+    """sha256 of a stored packet, as it was uploaded.
+
+    Uploads which were saved as bytes are stored as their literal
+    repr (b'...'), see the MurataBSN converter.  For these, hash the
+    original bytes so that re-uploads match.
+    """
+    if data.startswith("b'") and data.endswith("'"):
+        try:
+            return sha256(ast.literal_eval(data)).hexdigest()
+        except (ValueError, SyntaxError):
+            pass
+    return sha256(data.encode('utf8')).hexdigest()
+
+class Command(BaseCommand):
+    help = 'Compute Data.data_sha256 for rows which do not have it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Only rows with id greater than this.")
+
+    def handle(self, *args, **options):
+        last_id = options['start_id']
+        n_total = 0
+        while True:
+            # Keyset pagination on the primary key, so that every
+            # batch is an index range scan no matter how far we are.
+            rows = list(Data.objects.filter(id__gt=last_id, data_sha256__isnull=True)
+                        .order_by('id')
+                        .values_list('id', 'data', 'data_z', 'codec')
+                        [:options['batch_size']])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [ Data(id=id_, data_sha256=stored_data_sha256(
+                                Data.decode(data, data_z, codec)))
+                        for id_, data, data_z, codec in rows ]
+            Data.objects.bulk_update(updates, ['data_sha256'])
+            n_total += len(updates)
+            if options['verbosity'] > 1:
+                print("id <= %d: %d rows updated"%(last_id, n_total))
+        if options['verbosity'] > 0:
+            print("%d rows updated"%n_total)
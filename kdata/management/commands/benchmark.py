@@ -0,0 +1,342 @@
+from contextlib import contextmanager
+from datetime import timedelta
+import json
+import random
+import re
+import time
+from urllib.parse import quote_plus
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.utils import timezone
+
+from kdata import converter as kconverter
+from kdata import export
+from kdata import models
+from kdata import partitions
+from kdata import util
+
+
+def _timeit(func, repeat):
+    """Best-of-repeat wall time of func(), in seconds."""
+    times = [ ]
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def aware_accelerometer_body(size=2*2**20):
+    """A urlencoded AWARE accelerometer insert body of about size bytes."""
+    rows = [ ]
+    device_uuid = '2e66087d-4afb-4a64-9316-67d737e21998'
+    ts = 1500000000000
+    body_size = 0
+    while body_size < size:
+        row = dict(timestamp=ts, device_id=device_uuid,
+                   double_values_0=random.uniform(-10, 10),
+                   double_values_1=random.uniform(-10, 10),
+                   double_values_2=random.uniform(-10, 10),
+                   accuracy=3, label='')
+        rows.append(row)
+        ts += 20
+        body_size += len(quote_plus(json.dumps(row))) + 4  # '%2C+' separator
+    return ('data=' + quote_plus(json.dumps(rows))
+            + '&device_id=' + device_uuid).encode('ascii')
+
+
+def bench_aware_parse(options):
+    """Parsing of an AWARE insert body: request.POST vs util.parse_urlencoded"""
+    body = aware_accelerometer_body(options['size'])
+    print("body size: %s"%util.human_bytes(len(body)))
+    assert (QueryDict(body)['data'].encode('utf8')
+            == util.parse_urlencoded(body, encoding=None)['data'])
+    t_querydict = _timeit(lambda: QueryDict(body), options['repeat'])
+    t_fast = _timeit(lambda: util.parse_urlencoded(body, encoding=None),
+                     options['repeat'])
+    print("QueryDict:         %.4f s"%t_querydict)
+    print("parse_urlencoded:  %.4f s"%t_fast)
+    print("speedup:           %.1fx"%(t_querydict/t_fast))
+
+
+def bench_partitions(options):
+    """Flat vs monthly partitioned data table (PostgreSQL): query plans and ingest rate
+
+    Two scratch tables like kdata_data are filled with the same
+    synthetic data of --years years, and dropped afterwards.
+    """
+    if not partitions.supported():
+        raise CommandError("needs PostgreSQL 11 or later")
+    flat, part = 'kdata_bench_flat', 'kdata_bench_part'
+    q = connection.ops.quote_name
+    now = timezone.now()
+    start = partitions.month_start(now - timedelta(days=365*options['years']))
+    n_devices = options['devices']
+    step = 86400. / options['rows_per_day']
+    n_rows = int((now-start).total_seconds() / step) * n_devices
+    c = connection.cursor()
+    try:
+        c.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING INDEXES)'
+                  %(q(flat), q(partitions.TABLE)))
+        c.execute('ALTER TABLE %s ALTER COLUMN id DROP DEFAULT'%q(flat))
+        partitions.create_partitioned_table(part)
+        month = start
+        while month <= now:
+            partitions.create_partition(month, part)
+            month = partitions.next_month(month)
+        print("%d rows of %d devices from %s, %d partitions"%(
+            n_rows, n_devices, start.date(), len(partitions.partitions(part))))
+
+        # Bulk fill, then single-row-batch ingest at the current time.
+        for table in (flat, part):
+            t = time.perf_counter()
+            c.execute("INSERT INTO %s (id, device_id, ts, ts_received, ip, data_length, data) "
+                      "SELECT g, 'bench' || (g %%%% %%s), "
+                      "%%s + (g / %%s) * %%s * interval '1 second', now(), '127.0.0.1', 100, "
+                      "repeat('x', 100) FROM generate_series(1, %%s) AS g"%q(table),
+                      [n_devices, start, n_devices, step, n_rows])
+            c.execute('ANALYZE %s'%q(table))
+            print("%-18s bulk fill %.1f s"%(table, time.perf_counter()-t))
+        n_ingest = options['ingest_rows']
+        for table in (flat, part):
+            rows = [ (n_rows+1+i, 'bench%d'%(i % n_devices), timezone.now(), '127.0.0.1', 100, 'x'*100)
+                     for i in range(n_ingest) ]
+            t = time.perf_counter()
+            for i in range(0, n_ingest, 100):
+                c.executemany("INSERT INTO %s (id, device_id, ts, ip, data_length, data) "
+                              "VALUES (%%s, %%s, %%s, %%s, %%s, %%s)"%q(table), rows[i:i+100])
+            dt = time.perf_counter() - t
+            print("%-18s ingest %d rows/s"%(table, n_ingest/dt))
+
+        queries = [
+            ("device, last week (Backend slice)",
+             "SELECT id, ts FROM {t} WHERE device_id = %s AND ts >= %s AND ts < %s ORDER BY ts",
+             ['bench1', now-timedelta(days=7), now]),
+            ("device, one month a year ago (group ts_start/ts_end)",
+             "SELECT id, ts FROM {t} WHERE device_id = %s AND ts >= %s AND ts < %s ORDER BY ts",
+             ['bench1', now-timedelta(days=365), now-timedelta(days=335)]),
+            ("device, first packet (backend[0])",
+             "SELECT id, ts FROM {t} WHERE device_id = %s ORDER BY ts LIMIT 1",
+             ['bench1']),
+            ("all devices, last day (stats page)",
+             "SELECT count(*), sum(data_length) FROM {t} WHERE ts > %s AND ts <= %s",
+             [now-timedelta(days=1), now]),
+            ]
+        for description, sql, params in queries:
+            print()
+            print(description)
+            for table in (flat, part):
+                query = sql.format(t=q(table))
+                seconds = _timeit(lambda: c.execute(query, params) or c.fetchall(),
+                                  options['repeat'])
+                c.execute('EXPLAIN ' + query, params)
+                plan = '\n'.join(row[0] for row in c.fetchall())
+                scanned = set(re.findall(r'%s_p\d{4}_\d{2}'%part, plan))
+                print("  %-18s %8.2f ms%s"%(table, seconds*1000,
+                      ",  %d partitions scanned"%len(scanned) if table == part else ""))
+                if options['verbosity'] > 1:
+                    print('    ' + plan.replace('\n', '\n    '))
+    finally:
+        c.execute('DROP TABLE IF EXISTS %s, %s'%(q(flat), q(part)))
+        c.close()
+
+
+class _Rollback(Exception):
+    pass
+
+@contextmanager
+def _scratch_data_table(table):
+    """Point models.Data at a new, empty table for the with block.
+
+    The switch is only seen by this process, so live readers and the
+    id sequence of kdata_data are not touched.  The table is dropped
+    at the end.
+    """
+    opts = models.Data._meta
+    real_table = opts.db_table
+    opts.db_table = table
+    try:
+        with connection.schema_editor() as editor:
+            editor.create_model(models.Data)
+        try:
+            yield
+        finally:
+            with connection.schema_editor() as editor:
+                editor.delete_model(models.Data)
+    finally:
+        opts.db_table = real_table
+
+def _count_queries(func):
+    """Run func(), return the number of database queries it made."""
+    n = [0]
+    def wrapper(execute, sql, params, many, context):
+        n[0] += 1
+        return execute(sql, params, many, context)
+    with connection.execute_wrapper(wrapper):
+        func()
+    return n[0]
+
+def bench_data_iter(options):
+    """Reading one device's packets: optimized_queryset_iterator vs keyset_queryset_iterator
+
+    --rows packets of --packet-size bytes are inserted for a scratch
+    device, in a transaction which is rolled back at the end.  Dense:
+    all packets within ten minutes.  Sparse: one packet every six hours.
+    """
+    device_id = 'benchmark-data-iter'
+    n_rows = options['rows']
+    payload = 'x' * options['packet_size']
+    now = timezone.now()
+    iterators = [
+        ('optimized_queryset_iterator',
+         lambda qs: ((x.ts, x.data) for x in util.optimized_queryset_iterator(qs))),
+        ('keyset_queryset_iterator',
+         lambda qs: util.keyset_queryset_iterator(qs, server_side=False)),
+        ]
+    if connection.vendor == 'postgresql':
+        iterators.append(('keyset, server-side cursor',
+                          lambda qs: util.keyset_queryset_iterator(qs, server_side=True)))
+    try:
+        with transaction.atomic():
+            for name, step in [('dense', timedelta(seconds=600./n_rows)),
+                               ('sparse', timedelta(hours=6))]:
+                models.Data.objects.filter(device_id=device_id).delete()
+                models.Data.objects.bulk_create(
+                    (models.Data(device_id=device_id, ip='127.0.0.1', data=payload,
+                                 data_length=len(payload), ts=now-i*step)
+                     for i in range(n_rows)),
+                    batch_size=1000)
+                qs = models.Data.objects.filter(device_id=device_id).order_by('ts')
+                print("%s: %d packets of %s over %s"%(name, n_rows, util.human_bytes(len(payload)),
+                                                      util.human_interval(n_rows*step)))
+                for it_name, iterator in iterators:
+                    assert sum(1 for _ in iterator(qs)) == n_rows, it_name
+                    n_queries = _count_queries(lambda: sum(1 for _ in iterator(qs)))
+                    seconds = _timeit(lambda: sum(1 for _ in iterator(qs)), options['repeat'])
+                    print("  %-30s %8.3f s %7d queries"%(it_name, seconds, n_queries))
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+
+def bench_raw_export(options):
+    """Raw device downloads: converter and csv_iter/json_lines_iter vs export.raw_export (COPY)
+
+    --rows packets of --packet-size bytes are inserted into a scratch
+    table (see _scratch_data_table), not kdata_data.  They have to be
+    committed, since raw_export reads with its own database connection.
+    """
+    device_id = 'benchmark-raw-export'
+    payload = json.dumps([ dict(x=random.random(), y='\u00e4') for _ in range(options['packet_size']//30) ])
+    now = timezone.now()
+    with _scratch_data_table('kdata_bench_raw_export'):
+        models.Data.objects.bulk_create(
+            (models.Data(device_id=device_id, ip='127.0.0.1', data=payload,
+                         data_length=len(payload), ts=now-timedelta(seconds=i))
+             for i in range(options['rows'])),
+            batch_size=1000)
+        qs = models.Data.objects.filter(device_id=device_id).order_by('ts')
+        print("%d packets of %s"%(options['rows'], util.human_bytes(len(payload))))
+        iters = {'csv': util.csv_iter, 'json-lines': util.json_lines_iter}
+        for format in ('csv', 'json-lines'):
+            def converter():
+                conv = kconverter.Raw(util.keyset_queryset_iterator(qs))
+                return sum(len(x.encode('utf8')) for x in
+                           iters[format](conv.run(), converter=conv, header=conv.header2()))
+            def copy():
+                response = export.raw_export(qs, format, 'benchmark')
+                return sum(len(x) for x in response.streaming_content)
+            runs = [('converter', converter)]
+            if export.supported(qs):
+                runs.append(('raw_export (COPY)', copy))
+            for name, func in runs:
+                n_bytes = func()
+                seconds = _timeit(func, options['repeat'])
+                print("  %-10s %-18s %8.3f s %8s/s"%(format, name, seconds,
+                                                     util.human_bytes(n_bytes/seconds)))
+        if not export.supported(qs):
+            print("raw_export needs PostgreSQL, only the converter was run")
+
+
+def bench_select_packets(options):
+    """A converter needing 2% of the packets: all packets vs _Converter.select_packets
+
+    --rows AWARE packets of about --packet-size bytes are inserted for
+    a scratch device, every 50th of the screen table and the rest of
+    accelerometer, in a transaction which is rolled back at the end.
+    """
+    device_id = 'benchmark-select-packets'
+    n_rows = options['rows']
+    now = timezone.now()
+    def packet(table):
+        rows = [ dict(timestamp=1500000000000+i, screen_status=1, double_values_0=random.random())
+                 for i in range(max(1, options['packet_size']//80)) ]
+        return json.dumps(dict(table=table, data=json.dumps(rows), timestamp=0, version=1))
+    tables = [ 'screen' if i % 50 == 0 else 'accelerometer' for i in range(n_rows) ]
+    payloads = {table: packet(table) for table in set(tables)}
+    device = models.Device(device_id=device_id, type='Aware')
+    try:
+        with transaction.atomic():
+            models.Data.objects.bulk_create(
+                (models.Data(device_id=device_id, ip='127.0.0.1', data=payloads[table],
+                             data_length=len(payloads[table]), ts=now-timedelta(seconds=i))
+                 for i, table in enumerate(tables)),
+                batch_size=1000)
+            ids = models.Data.objects.filter(device_id=device_id).order_by('id') \
+                                     .values_list('id', flat=True)
+            models.DataProbe.objects.bulk_create(
+                (models.DataProbe(data_id=id_, device_id=device_id, probe=table, n_rows=1)
+                 for id_, table in zip(ids, tables)),
+                batch_size=1000)
+            models.DeviceStats.objects.create(device_id=device_id, probes_complete=True)
+            qs = models.Data.objects.filter(device_id=device_id).order_by('ts')
+            print("%d packets of %s, %d of the screen table"%(
+                n_rows, util.human_bytes(len(payloads['accelerometer'])), tables.count('screen')))
+            for name, queryset in [('all packets', qs),
+                                   ('select_packets', kconverter.AwareScreen.select_packets(qs, device))]:
+                def run():
+                    conv = kconverter.AwareScreen(util.keyset_queryset_iterator(queryset))
+                    return sum(1 for _ in conv.run())
+                n_out = run()
+                seconds = _timeit(run, options['repeat'])
+                print("  %-16s %8.3f s %7d packets read %7d rows out"%(
+                    name, seconds, queryset.count(), n_out))
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+
+BENCHMARKS = {
+    'aware-parse': bench_aware_parse,
+    'data-iter': bench_data_iter,
+    'raw-export': bench_raw_export,
+    'partitions': bench_partitions,
+    'select-packets': bench_select_packets,
+    }
+
+class Command(BaseCommand):
+    help = 'Run micro-benchmarks of the data handling code'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+        parser.add_argument('--size', type=int, default=2*2**20,
+                            help="Payload size in bytes, where relevant.")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--rows', type=int, default=5000,
+                            help="Packets of the scratch device (data-iter, raw-export, select-packets).")
+        parser.add_argument('--packet-size', type=int, default=2000,
+                            help="Bytes per packet (data-iter, raw-export, select-packets).")
+        parser.add_argument('--years', type=int, default=3,
+                            help="Years of synthetic data (partitions).")
+        parser.add_argument('--devices', type=int, default=50,
+                            help="Devices in the synthetic data (partitions).")
+        parser.add_argument('--rows-per-day', type=int, default=24,
+                            help="Packets per device per day (partitions).")
+        parser.add_argument('--ingest-rows', type=int, default=20000,
+                            help="Packets inserted to measure the ingest rate (partitions).")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least one")
+        BENCHMARKS[options['benchmark']](options)
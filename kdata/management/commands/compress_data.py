@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from kdata import util
+from kdata.models import Data
+
+class Command(BaseCommand):
+    help = 'Compress stored packets in place'
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*',
+                            help="Only these devices (default: all).")
+        parser.add_argument('--codec', default='zlib', choices=sorted(Data.CODECS))
+        parser.add_argument('--min-length', type=int, default=1024,
+                            help="Only packets at least this long.")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Only rows with id greater than this.")
+
+    def handle(self, *args, **options):
+        codec = Data.CODECS[options['codec']]
+        qs = Data.objects.filter(Q(codec__isnull=True) | Q(codec=Data.CODEC_NONE),
+                                 data_length__gte=options['min_length'])
+        if options['device_id']:
+            qs = qs.filter(device_id__in=options['device_id'])
+        last_id = options['start_id']
+        n_rows = bytes_before = bytes_after = 0
+        while True:
+            rows = list(qs.filter(id__gt=last_id).order_by('id')
+                        .values_list('id', 'data')[:options['batch_size']])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # bulk_update writes the values as given (no pre_save), so
+            # set the stored form of the columns directly.
+            updates = [ ]
+            for id_, data in rows:
+                data_z = Data.compress(data, codec)
+                updates.append(Data(id=id_, data='', data_z=data_z, codec=codec))
+                bytes_before += len(data.encode('utf8'))
+                bytes_after += len(data_z)
+            with transaction.atomic():
+                Data.objects.bulk_update(updates, ['data', 'data_z', 'codec'])
+            n_rows += len(updates)
+            if options['verbosity'] > 1:
+                print("id <= %d: %d rows compressed"%(last_id, n_rows))
+        if options['verbosity'] > 0:
+            print("%d rows compressed, %s -> %s"%(
+                n_rows, util.human_bytes(bytes_before), util.human_bytes(bytes_after)))
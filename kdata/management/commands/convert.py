@@ -80,6 +80,7 @@ class Command(BaseCommand):
             # Get the rows of DB objects.
             rows = Data.objects.filter(device_id=device.device_id, )
             rows = rows.order_by('ts')
+            rows = converter_class.select_packets(rows, device)
 
             # Limit to a certain number of days of history.
             if options['history']:
@@ -96,8 +97,7 @@ class Command(BaseCommand):
                 rows = rows.filter(ts__lt=(dt_end))
 
             # Final transformations
-            rows = util.optimized_queryset_iterator(rows)
-            rows = ((d.ts, d.data) for d in rows)
+            rows = util.keyset_queryset_iterator(rows)
             # Two options for error handling: handle with warning at
             # end, or immediately raise exception.
             if options['no_handle_errors']:
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import spool
+
+class Command(BaseCommand):
+    help = 'Move packets from the ingest spool into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Packets per INSERT/transaction.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, draining every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds between drains when looping.")
+
+    def handle(self, *args, **options):
+        if not spool.enabled():
+            raise CommandError("settings.KOOTA_INGEST_SPOOL_DIR is not set")
+        while True:
+            n = spool.drain(batch_size=options['batch_size'])
+            if n and options['verbosity'] > 0:
+                print("Drained %d packets"%n)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
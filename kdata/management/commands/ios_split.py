@@ -13,7 +13,9 @@ class Command(BaseCommand):
     Early versions of the iOS app uploaded data packets with sizes
     that could increase without bound.  This would cause memory
     problems for the server, even when processing them inline.  We
-    solve this by manually splitting them.
+    solve this by manually splitting them.  New uploads are split
+    when they are saved (see Ios.max_packet_size), so this is only
+    needed for packets stored before that.
 
     To run this script you have to manually uncomment a few lines
     before running (for safety).
@@ -79,8 +81,6 @@ class Command(BaseCommand):
                                        data=data2,
                                        data_length=len(data2))
                         new_row.save()
-                        new_row.ts = row.ts
-                        new_row.save()
                 if live_run:
                     row.device_id = row.device_id+'_orig1'
                     row.save()
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import partitions
+
+class Command(BaseCommand):
+    help = 'Monthly partitioning of the data table by time (PostgreSQL), see kdata/partitions.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help="Convert the existing data table into a partitioned one.")
+        parser.add_argument('--ensure', action='store_true',
+                            help="Create the partitions of the coming months.")
+        parser.add_argument('--months-ahead', type=int,
+                            help="Months of partitions to create ahead "
+                                 "(default: settings.KOOTA_DATA_PARTITION_MONTHS_AHEAD).")
+        parser.add_argument('--batch-size', type=int, default=100000,
+                            help="Ids per copy transaction, with --convert.")
+        parser.add_argument('--min-rows', type=int, default=1000,
+                            help="With --convert, months before the first month with this "
+                                 "many rows go to the default partition.")
+        parser.add_argument('--loop', action='store_true',
+                            help="With --ensure, keep running, checking every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=24*3600,
+                            help="Seconds between checks when looping.")
+
+    def handle(self, *args, **options):
+        if not partitions.supported():
+            raise CommandError("Partitioning needs PostgreSQL 11 or later")
+        verbose = options['verbosity'] > 0
+        if options['convert']:
+            try:
+                partitions.convert(batch_size=options['batch_size'],
+                                   min_rows=options['min_rows'],
+                                   months_ahead=options['months_ahead'],
+                                   log=print if verbose else (lambda msg: None))
+            except ValueError as e:
+                raise CommandError(str(e))
+        if options['ensure']:
+            if not partitions.is_partitioned():
+                raise CommandError("%s is not partitioned, use --convert first"%partitions.TABLE)
+            while True:
+                for name in partitions.ensure_partitions(months_ahead=options['months_ahead']):
+                    if verbose:
+                        print("Created %s"%name)
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        if verbose and not options['loop']:
+            for name, bound, rows in partitions.partitions():
+                print("%-28s %10d  %s"%(name, rows, bound))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from kdata.models import Device, DeviceStats
+
+class Command(BaseCommand):
+    help = 'Count the DeviceStats of devices again from the Data table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*',
+                            help="Only these devices (default: all devices).")
+
+    def handle(self, *args, **options):
+        device_ids = options['device_id']
+        if not device_ids:
+            device_ids = sorted(set(Device.objects.values_list('device_id', flat=True))
+                                | set(DeviceStats.objects.values_list('device_id', flat=True)))
+        fields = ('n_packets', 'bytes_total', 'first_ts', 'last_ts')
+        n_changed = 0
+        for device_id in device_ids:
+            old, new = DeviceStats.recount(device_id)
+            if old is None:
+                continue
+            changes = [ '%s %s -> %s'%(f, getattr(old, f), getattr(new, f))
+                        for f in fields if getattr(old, f) != getattr(new, f) ]
+            if changes:
+                n_changed += 1
+                if options['verbosity'] > 0:
+                    print("%s: %s"%(device_id, ', '.join(changes)))
+        if options['verbosity'] > 0:
+            print("%d devices counted, %d had changed"%(len(device_ids), n_changed))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import hooks
+
+class Command(BaseCommand):
+    help = 'Run queued asynchronous post-ingest hooks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Jobs per transaction.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, polling every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Seconds between polls when the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            n = hooks.run_pending(batch_size=options['batch_size'])
+            if n and options['verbosity'] > 1:
+                print("Ran %d jobs"%n)
+            if n:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        if options['verbosity'] > 0:
+            for name, s in sorted(hooks.stats.stats().items()):
+                print("%s: %d calls, %d errors, %.3fs total, %.3fs max"%(
+                    name, s['calls'], s['errors'], s['seconds'], s['max_seconds']))
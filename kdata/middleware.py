@@ -1,9 +1,10 @@
 import urllib
 
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils.deprecation import MiddlewareMixin
 from django.utils.safestring import mark_safe
 
 from . import views as kviews
@@ -105,3 +106,14 @@ class KdataMiddleware(object):
             response.reason_phrase = exception.message
             return response
 
+
+class IngestExceptionMiddleware(MiddlewareMixin):
+    """Error responses for kdata exceptions, in the ingest-only app.
+
+    Like KdataMiddleware.process_exception, but a plain text response
+    without templates or messages, which that app does not have.
+    """
+    def process_exception(self, request, exception):
+        if isinstance(exception, exceptions.BaseMessageKootaException):
+            return HttpResponse(exception.message, content_type='text/plain',
+                                status=exception.status, reason=exception.message)
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0032_attr_length'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='data',
+            name='ts',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Time the data referrs to, defaults to received timestamp.'),
+        ),
+        migrations.AlterField(
+            model_name='data',
+            name='ts_received',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Time packet received (never updated)', null=True),
+        ),
+    ]
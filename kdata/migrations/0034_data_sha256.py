@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0033_data_ts_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='data_sha256',
+            field=models.CharField(blank=True, help_text='sha256 hexdigest of the data as uploaded', max_length=64, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='data',
+            index_together={('device_id', 'ts'), ('device_id', 'data_sha256')},
+        ),
+    ]
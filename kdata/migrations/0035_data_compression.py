@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import kdata.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0034_data_sha256'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='data',
+            name='data',
+            field=kdata.models.PayloadField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='data_z',
+            field=kdata.models.CompressedPayloadField(blank=True, help_text='Compressed data, if codec is set', null=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='codec',
+            field=models.SmallIntegerField(blank=True, help_text='Compression of data_z: null/0=none, 1=zlib', null=True),
+        ),
+    ]
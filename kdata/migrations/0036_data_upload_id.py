@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0035_data_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='upload_id',
+            field=models.CharField(blank=True, help_text='Shared by the packets one oversized upload was split into', max_length=32, null=True),
+        ),
+    ]
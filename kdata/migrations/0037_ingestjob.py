@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0036_data_upload_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_id', models.IntegerField(help_text='Data.id of the packet')),
+                ('device_id', models.CharField(max_length=64)),
+                ('hook', models.CharField(help_text='Name of the hook', max_length=256)),
+                ('ts_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('not_before', models.DateTimeField(default=django.utils.timezone.now, help_text="Don't run before this (retry backoff)")),
+                ('attempts', models.SmallIntegerField(default=0)),
+                ('failed', models.BooleanField(default=False, help_text='Given up after too many attempts')),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'index_together': {('failed', 'not_before')},
+            },
+        ),
+    ]
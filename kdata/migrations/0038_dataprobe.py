@@ -0,0 +1,23 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0037_ingestjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProbe',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('probe', models.CharField(max_length=255)),
+                ('data', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='probes', to='kdata.data')),
+            ],
+            options={
+                'index_together': {('data', 'probe')},
+            },
+        ),
+    ]
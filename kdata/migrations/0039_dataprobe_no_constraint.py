@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0038_dataprobe'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dataprobe',
+            name='data',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='probes', to='kdata.data'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0039_dataprobe_no_constraint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceStats',
+            fields=[
+                ('device_id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('n_packets', models.BigIntegerField(default=0)),
+                ('bytes_total', models.BigIntegerField(default=0)),
+                ('first_ts', models.DateTimeField(blank=True, help_text='Earliest packet ts', null=True)),
+                ('last_ts', models.DateTimeField(blank=True, help_text='Latest packet ts', null=True)),
+                ('last_ingest', models.DateTimeField(blank=True, help_text='When packets were last received', null=True)),
+                ('ts_reconciled', models.DateTimeField(blank=True, help_text='When last counted from the Data table', null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeviceDayStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(max_length=64)),
+                ('day', models.DateField()),
+                ('n_packets', models.BigIntegerField(default=0)),
+                ('bytes_total', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('device_id', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0040_devicestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataprobe',
+            name='device_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataprobe',
+            name='ts_min',
+            field=models.DateTimeField(blank=True, help_text='Earliest reading', null=True),
+        ),
+        migrations.AddField(
+            model_name='dataprobe',
+            name='ts_max',
+            field=models.DateTimeField(blank=True, help_text='Latest reading', null=True),
+        ),
+        migrations.AddField(
+            model_name='dataprobe',
+            name='n_rows',
+            field=models.IntegerField(blank=True, help_text='Number of readings', null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='dataprobe',
+            index_together={('data', 'probe'), ('device_id', 'probe')},
+        ),
+        migrations.AddField(
+            model_name='devicestats',
+            name='probes_complete',
+            field=models.BooleanField(default=False, help_text='All packets have their DataProbe rows (see backfill_probes)'),
+        ),
+    ]
@@ -1,14 +1,19 @@
 from __future__ import unicode_literals
 
+import contextlib
 import datetime
 import hashlib
+import zlib
 
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least, TruncDate
 from django.urls import reverse
 from django.utils import timezone
 
+from . import cache
 from . import devices
 from . import exceptions
 from . import util
@@ -18,22 +23,369 @@ from . import backend
 import logging
 logger = logging.getLogger(__name__)
 
+class PayloadField(models.TextField):
+    """Data.data: the packet payload.
+
+    If the row has a codec set, the payload is stored compressed in
+    Data.data_z and this column is stored empty.  In Python, .data is
+    always the plain payload.
+    """
+    def pre_save(self, model_instance, add):
+        if model_instance.__dict__.get('codec'):
+            return ''
+        return super(PayloadField, self).pre_save(model_instance, add)
+
+class CompressedPayloadField(models.BinaryField):
+    """Data.data_z: compressed payload, computed from .data when saving."""
+    def pre_save(self, model_instance, add):
+        fields = model_instance.__dict__
+        if 'codec' in fields and not fields['codec']:
+            return None
+        if fields.get('codec') and 'data' in fields:
+            text = model_instance._meta.get_field('data').to_python(fields['data'])
+            return Data.compress(text, fields['codec'])
+        return super(CompressedPayloadField, self).pre_save(model_instance, add)
+
 class Data(models.Model):
     class Meta:
         index_together = [
             ["device_id", "ts"],
+            ["device_id", "data_sha256"],
             ]
     id = models.AutoField(primary_key=True)
     device_id = models.CharField(max_length=64)
-    ts = models.DateTimeField(auto_now_add=True,
+    # These are defaults and not auto_now_add, so that views.save_data
+    # can set custom timestamps already in the INSERT.
+    ts = models.DateTimeField(default=timezone.now,
                               help_text="Time the data referrs to, defaults to received timestamp.")
     # Column is nullable since it is added later, remove null=True
     # later.
-    ts_received = models.DateTimeField(auto_now_add=True, null=True,
+    ts_received = models.DateTimeField(default=timezone.now, null=True,
                                        help_text="Time packet received (never updated)")
     ip = models.GenericIPAddressField()
     data_length = models.IntegerField(blank=True, null=True)
-    data = models.TextField(blank=True)
+    data_sha256 = models.CharField(max_length=64, blank=True, null=True,
+                                   help_text="sha256 hexdigest of the data as uploaded")
+    upload_id = models.CharField(max_length=32, blank=True, null=True,
+                                 help_text="Shared by the packets one oversized upload was split into")
+    data = PayloadField(blank=True)
+    # Compressed storage.  Instances loaded from the database always
+    # have the decompressed payload in .data (see from_db), and the
+    # fields above re-compress it when saving.  data_length is always
+    # the uncompressed length.
+    CODEC_NONE = 0
+    CODEC_ZLIB = 1
+    CODECS = {'zlib': CODEC_ZLIB}
+    data_z = CompressedPayloadField(blank=True, null=True,
+                                    help_text="Compressed data, if codec is set")
+    codec = models.SmallIntegerField(blank=True, null=True,
+                                     help_text="Compression of data_z: null/0=none, 1=zlib")
+
+    @classmethod
+    def compress(cls, text, codec):
+        if codec == cls.CODEC_ZLIB:
+            return zlib.compress(text.encode('utf8'))
+        raise ValueError("Unknown Data codec: %r"%codec)
+    @classmethod
+    def decode(cls, data, data_z, codec):
+        """The payload, given the values of the data, data_z and codec columns."""
+        if not codec:
+            return data
+        if codec == cls.CODEC_ZLIB:
+            return zlib.decompress(data_z).decode('utf8')
+        raise ValueError("Unknown Data codec: %r"%codec)
+    @classmethod
+    def default_codec(cls, length):
+        """Codec to store a new packet of this length with, from settings."""
+        codec = getattr(settings, 'KOOTA_DATA_COMPRESSION', None)
+        if codec is None:
+            return None
+        if length < getattr(settings, 'KOOTA_DATA_COMPRESS_MIN_LENGTH', 1024):
+            return None
+        return cls.CODECS[codec]
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Data, cls).from_db(db, field_names, values)
+        fields = instance.__dict__
+        if fields.get('codec') and 'data' in fields and 'data_z' in fields:
+            fields['data'] = cls.decode(fields['data'], fields['data_z'], fields['codec'])
+        return instance
+    def refresh_from_db(self, using=None, fields=None):
+        # Loading a deferred .data needs the compressed columns, too.
+        if fields is not None and 'data' in fields:
+            fields = set(fields) | {'data_z', 'codec'}
+        return super(Data, self).refresh_from_db(using=using, fields=fields)
+
+
+
+class DataProbe(models.Model):
+    """One probe (PurpleRobot) or table (AWARE) with readings in a packet.
+
+    Filled at ingest for device classes which define probe_meta (see
+    BaseDevice), and by the "backfill_probes" command for packets
+    stored before that.  Converters use it to select the packets they
+    need in SQL, without reading the others (see
+    converter._Converter.select_packets).  The sample time range and
+    number of readings are of this probe only; pieces of a split
+    packet each get the values of the whole packet.
+    """
+    class Meta:
+        index_together = [
+            ["data", "probe"],
+            ["device_id", "probe"],
+            ]
+    # No database constraint: a partitioned kdata_data (see
+    # kdata/partitions.py) has no unique index on id alone for it to
+    # reference.  Deletes still cascade, done by Django.
+    data = models.ForeignKey(Data, on_delete=models.CASCADE, db_index=False,
+                             db_constraint=False, related_name='probes')
+    # Null only for rows from before these columns existed.
+    device_id = models.CharField(max_length=64, null=True, blank=True)
+    probe = models.CharField(max_length=255)
+    ts_min = models.DateTimeField(null=True, blank=True, help_text="Earliest reading")
+    ts_max = models.DateTimeField(null=True, blank=True, help_text="Latest reading")
+    n_rows = models.IntegerField(null=True, blank=True, help_text="Number of readings")
+
+    @classmethod
+    def for_rows(cls, rows, probes):
+        """Unsaved rows for some saved Data rows (pieces of one packet).
+
+        probes is a list of dict(probe=, ts_min=, ts_max=, n_rows=),
+        timestamps in unix time, as returned by probe_meta functions.
+        Plain probe names are accepted too.
+        """
+        probes = [ dict(probe=p) if isinstance(p, str) else p for p in probes ]
+        return [ cls(data_id=row.id, device_id=row.device_id, probe=p['probe'],
+                     ts_min=cls._datetime(p.get('ts_min')),
+                     ts_max=cls._datetime(p.get('ts_max')),
+                     n_rows=p.get('n_rows'))
+                 for row in rows if row.id is not None
+                 for p in probes ]
+    @staticmethod
+    def _datetime(unixtime):
+        """Datetime of a unix time, None if missing or out of range."""
+        if unixtime is None:
+            return None
+        try:
+            return datetime.datetime.fromtimestamp(unixtime, datetime.timezone.utc)
+        except (TypeError, ValueError, OverflowError, OSError):
+            return None
+    @classmethod
+    def packets(cls, device_id, probes):
+        """Subquery of the ids of packets of a device with any of these probes."""
+        return cls.objects.filter(device_id=device_id, probe__in=list(probes)).values('data_id')
+
+
+
+class IngestJob(models.Model):
+    """A queued run of an asynchronous post-ingest hook, see kdata/hooks.py."""
+    class Meta:
+        index_together = [
+            ["failed", "not_before"],
+            ]
+    data_id = models.IntegerField(help_text="Data.id of the packet")
+    device_id = models.CharField(max_length=64)
+    hook = models.CharField(max_length=256, help_text="Name of the hook")
+    ts_created = models.DateTimeField(default=timezone.now)
+    not_before = models.DateTimeField(default=timezone.now,
+                                      help_text="Don't run before this (retry backoff)")
+    attempts = models.SmallIntegerField(default=0)
+    failed = models.BooleanField(default=False,
+                                 help_text="Given up after too many attempts")
+    last_error = models.TextField(blank=True, null=True)
+
+
+
+class DeviceStats(models.Model):
+    """Packet count, size and time range of the data of one device.
+
+    Kept up to date by the ingest path: add_rows() is called in the
+    transaction which inserts the packets.  The row of a device is
+    created on first use by counting its packets in the Data table,
+    so devices with data from before this table need nothing special.
+    The "reconcile_stats" management command re-counts, if packets
+    were changed by other means.
+    """
+    device_id = models.CharField(max_length=64, primary_key=True)
+    n_packets = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(default=0)
+    first_ts = models.DateTimeField(null=True, blank=True, help_text="Earliest packet ts")
+    last_ts = models.DateTimeField(null=True, blank=True, help_text="Latest packet ts")
+    last_ingest = models.DateTimeField(null=True, blank=True,
+                                       help_text="When packets were last received")
+    ts_reconciled = models.DateTimeField(null=True, blank=True,
+                                         help_text="When last counted from the Data table")
+    probes_complete = models.BooleanField(
+        default=False, help_text="All packets have their DataProbe rows (see backfill_probes)")
+
+    @classmethod
+    def get(cls, device_id):
+        """Stats of one device, counted from the Data table if not there yet."""
+        return cls.get_many([device_id])[device_id]
+    @classmethod
+    def get_many(cls, device_ids):
+        """{device_id: DeviceStats} for many devices, with one query if all exist."""
+        stats = cls.objects.in_bulk(list(device_ids))
+        for device_id in device_ids:
+            if device_id not in stats:
+                stats[device_id] = cls._create(device_id)
+        return stats
+    @classmethod
+    def _counted(cls, device_id):
+        """A new (unsaved) row, counted from the Data table."""
+        agg = Data.objects.filter(device_id=device_id).aggregate(
+            n=models.Count('id'), bytes=models.Sum('data_length'),
+            first=models.Min('ts'), last=models.Max('ts'), received=models.Max('ts_received'))
+        return cls(device_id=device_id, n_packets=agg['n'], bytes_total=agg['bytes'] or 0,
+                   first_ts=agg['first'], last_ts=agg['last'], last_ingest=agg['received'],
+                   ts_reconciled=timezone.now())
+    @classmethod
+    def _create(cls, device_id, new_packets=None):
+        """Count and insert the row of a device.
+
+        new_packets is given from the ingest path: the number of
+        packets this transaction just inserted.  If the device had no
+        others, all its packets went through the current ingest code,
+        so probes_complete is set.  If another transaction inserted
+        the row meanwhile, return None (that row does not count the
+        uncommitted packets of this one).
+        """
+        stats = cls._counted(device_id)
+        stats.probes_complete = new_packets is not None and stats.n_packets <= new_packets
+        try:
+            with transaction.atomic():
+                stats.save(force_insert=True)
+        except IntegrityError:
+            return None
+        return stats
+
+    @classmethod
+    def add_rows(cls, rows):
+        """Count newly inserted Data rows.
+
+        Call this in the transaction which inserted them.  The device
+        rows are updated (locked) before the day rows, in sorted
+        order, so concurrent uploads don't deadlock.
+        """
+        now = timezone.now()
+        per_device = { }
+        per_day = { }
+        for row in rows:
+            length = row.data_length or 0
+            n, nbytes, first, last = per_device.get(row.device_id, (0, 0, row.ts, row.ts))
+            per_device[row.device_id] = n+1, nbytes+length, min(first, row.ts), max(last, row.ts)
+            key = row.device_id, DeviceDayStats.day_of(row.ts)
+            n, nbytes = per_day.get(key, (0, 0))
+            per_day[key] = n+1, nbytes+length
+        DateTime = models.DateTimeField()
+        for device_id, (n, nbytes, first, last) in sorted(per_device.items()):
+            update = dict(
+                n_packets=models.F('n_packets') + n,
+                bytes_total=models.F('bytes_total') + nbytes,
+                # Coalesce: LEAST(NULL, x) is NULL on some databases.
+                first_ts=Coalesce(Least('first_ts', Value(first, DateTime)), Value(first, DateTime)),
+                last_ts=Coalesce(Greatest('last_ts', Value(last, DateTime)), Value(last, DateTime)),
+                last_ingest=now,
+                # The first packets of a device (row created on read).
+                probes_complete=Case(When(n_packets=0, then=Value(True)),
+                                     default=models.F('probes_complete')))
+            if not cls.objects.filter(device_id=device_id).update(**update):
+                if cls._create(device_id, n) is None:
+                    cls.objects.filter(device_id=device_id).update(**update)
+        for (device_id, day), (n, nbytes) in sorted(per_day.items()):
+            update = dict(n_packets=models.F('n_packets') + n,
+                          bytes_total=models.F('bytes_total') + nbytes)
+            if not DeviceDayStats.objects.filter(device_id=device_id, day=day).update(**update):
+                if not DeviceDayStats._create(device_id, [day]):
+                    DeviceDayStats.objects.filter(device_id=device_id, day=day).update(**update)
+
+    def packets_recent(self, days=7):
+        """Number of packets in the last days calendar days (UTC), today included."""
+        since = DeviceDayStats.day_of(timezone.now()) - datetime.timedelta(days=days-1)
+        if self.last_ts is None or DeviceDayStats.day_of(self.last_ts) < since:
+            return 0
+        wanted = set(since + datetime.timedelta(days=i) for i in range(days))
+        counts = dict(DeviceDayStats.objects.filter(device_id=self.device_id, day__gte=since)
+                      .values_list('day', 'n_packets'))
+        # Days without a row are counted from the Data table, but not
+        # inserted: this is a read, and the rows come from ingest.
+        missing = wanted - set(counts)
+        if missing:
+            counts.update((day, n) for day, (n, nbytes)
+                          in DeviceDayStats._count(self.device_id, missing).items())
+        return sum(n for day, n in counts.items() if day in wanted)
+
+    @classmethod
+    def recount(cls, device_id):
+        """Count the stats of a device from the Data table again.
+
+        The day rows are deleted: reads count those days from the
+        Data table, and the next upload of a day inserts its row.
+        Returns (old stats or None, new stats).
+        """
+        with transaction.atomic():
+            # Wait for, and then block, uploads which are updating
+            # the row, so that the count includes their packets.
+            old = cls.objects.select_for_update().filter(device_id=device_id).first()
+            if old is None:
+                new = cls._create(device_id)
+                if new is None:
+                    return cls.recount(device_id)
+            else:
+                new = cls._counted(device_id)
+                new.probes_complete = old.probes_complete
+                new.save(force_update=True)
+            DeviceDayStats.objects.filter(device_id=device_id).delete()
+        return old, new
+
+
+
+class DeviceDayStats(models.Model):
+    """Packets of one device per (UTC) day of their ts, see DeviceStats.
+
+    Rows are created by the ingest path, by counting the Data table.
+    Days without a row are counted on the fly when read.
+    """
+    class Meta:
+        unique_together = [
+            ("device_id", "day"),
+            ]
+    device_id = models.CharField(max_length=64)
+    day = models.DateField()
+    n_packets = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def day_of(ts):
+        return ts.astimezone(datetime.timezone.utc).date()
+    @classmethod
+    def _count(cls, device_id, days):
+        """{day: (n_packets, bytes_total)} of some days, from the Data table."""
+        days = sorted(days)
+        utc = datetime.timezone.utc
+        start = datetime.datetime.combine(days[0], datetime.time(), tzinfo=utc)
+        end = datetime.datetime.combine(days[-1] + datetime.timedelta(days=1), datetime.time(), tzinfo=utc)
+        counts = dict((day, (n, nbytes or 0)) for day, n, nbytes in
+                      Data.objects.filter(device_id=device_id, ts__gte=start, ts__lt=end)
+                      .annotate(day=TruncDate('ts', tzinfo=utc)).values('day')
+                      .annotate(n=models.Count('id'), bytes=models.Sum('data_length'))
+                      .values_list('day', 'n', 'bytes'))
+        return { day: counts.get(day, (0, 0)) for day in days }
+    @classmethod
+    def _create(cls, device_id, days):
+        """Count and insert the rows of some days, also when they have no packets.
+
+        Returns False if another transaction inserted any of them
+        meanwhile (and then inserts none).
+        """
+        rows = [ cls(device_id=device_id, day=day, n_packets=n, bytes_total=nbytes)
+                 for day, (n, nbytes) in cls._count(device_id, days).items() ]
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(rows)
+        except IntegrityError:
+            return False
+        return True
 
 
 
@@ -60,6 +412,7 @@ class Device(models.Model):
     # null=True to allow transition.
     ts_create = models.DateTimeField(auto_now_add=True, null=True)
     ts_update = models.DateTimeField(auto_now=True, null=True)
+    # Unused, replaced by DeviceStats.
     n_packets_cache = models.IntegerField(null=True, blank=True)
     n_packets_cache_ts = models.DateTimeField(null=True, blank=True)
 
@@ -83,30 +436,15 @@ class Device(models.Model):
             return self._secret_id
         return self.device_id
     @property
-    def n_packets(self, regen=None):
-        """Total number of data packets -- cached
-
-        regen: if None (default), use cache and update it with new
-        values.  If an integer, if cache is older than this value, do a
-        full update (quirky, because it doesn't use time since last full
-        regen).  If True, do a full regeneration.
-        """
-        if self.n_packets_cache is None:
-            self.n_packets_cache = self.backend.count(cache=False)
-        elif regen is not None:
-            if regen is True:
-                self.n_packets_cache = self.backend.count(cache=False)
-            if isinstance(regen, int):
-                last_regen = self.n_packets_cache_ts
-                if (timezone.now() - last_regen).total_seconds() > regen:
-                    self.n_packets_cache = self.backend.count(cache=False)
-        else:
-            n_new = self.backend.count(slc=slice(self.n_packets_cache_ts, None), cache=False)
-            if n_new > 0:
-                self.n_packets_cache += n_new
-        self.n_packets_cache_ts = timezone.now()
-        self.save()
-        return self.n_packets_cache
+    def stats(self):
+        """DeviceStats of this device (loaded once per instance)."""
+        if getattr(self, '_stats', None) is None:
+            self._stats = DeviceStats.get(self.device_id)
+        return self._stats
+    @property
+    def n_packets(self):
+        """Total number of data packets, from DeviceStats."""
+        return self.stats.n_packets
     @classmethod
     def get_by_id(cls, public_id):
         """Get a Device object given its public_id or device_id.
@@ -115,7 +453,7 @@ class Device(models.Model):
         # device that has device_id beginning with public_id.
         if len(public_id) < 6:
             raise exceptions.NoDevicePermission(log="device ID too short")
-        return cls.objects.get(_public_id=public_id)
+        return cache.get_device(cls, '_public_id', public_id)
     @classmethod
     def get_by_id_insecure(cls, public_id):
         """Only for use in admin scripts"""
@@ -124,7 +462,18 @@ class Device(models.Model):
     def get_by_secret_id(cls, secret_id):
         if len(secret_id) < 10:
             raise exceptions.InvalidDeviceID(log="device ID too short")
-        try:                     return cls.objects.get(_secret_id=secret_id)
+        if not cache.known_device_id(secret_id):
+            raise exceptions.InvalidDeviceID(log="Invalid Device ID (device filter)")
+        try:                     return cache.get_device(cls, '_secret_id', secret_id)
+        except cls.DoesNotExist: raise exceptions.InvalidDeviceID(log="Invalid Device ID")
+    @classmethod
+    async def aget_by_secret_id(cls, secret_id):
+        """get_by_secret_id() for async views."""
+        if len(secret_id) < 10:
+            raise exceptions.InvalidDeviceID(log="device ID too short")
+        if not await cache.aknown_device_id(secret_id):
+            raise exceptions.InvalidDeviceID(log="Invalid Device ID (device filter)")
+        try:                     return await cache.aget_device(cls, '_secret_id', secret_id)
         except cls.DoesNotExist: raise exceptions.InvalidDeviceID(log="Invalid Device ID")
     def get_class(self):
         """Return the Python class corresponding to this device."""
@@ -141,11 +490,9 @@ class Device(models.Model):
             return self.type.rsplit('.')[-1]
     def summary_text(self):
         """Provide a text summarizing latest data."""
-        be = backend.Backend(self)
-        mostrecent = be[-1]
+        mostrecent = self.stats.last_ts
         if mostrecent is None:
             return "-"
-        mostrecent = mostrecent.ts
         secs = (timezone.now() - mostrecent).total_seconds()
         if secs > 604800: # 1 week
             self.summary_color, self.summary_char = ('#FF0000', '&#x2297;') # x
@@ -153,7 +500,7 @@ class Device(models.Model):
             self.summary_color, self.summary_char = ('#000000', '&#x29BF;') # bullet-circle
         else:
             self.summary_color, self.summary_char = ('#000000', '&#x25CF;') # circle
-        count = be.count(slc=slice(timezone.now()-datetime.timedelta(days=7), None))
+        count = self.stats.packets_recent(days=7)
         return "%s (%s)"%(util.human_number(count), util.human_interval(mostrecent))
     @property
     def backend(self):
@@ -195,30 +542,161 @@ class AttrInterface(object):
     (and others).  This allows arbitrary metadata on each device
     object.  This is initialized in the __init__ method of each object
     (like Device.__init__).
+
+    All attributes of the object are loaded with one query on first
+    read, and later reads are served from that snapshot.  Writes go
+    to the database immediately and update the snapshot, unless they
+    are inside a "with attrs.buffered():" block, in which case they
+    are all written when the block exits (or on flush()).  Use
+    refresh() to see changes made by other processes.
     """
+    _DELETED = object()
     def __init__(self, attrset):
         self.attrset = attrset
+        self._snapshot = None  # name -> (id, value), None if not loaded
+        self._pending = None   # name -> value or _DELETED, None if not buffering
+    def _load(self):
+        if self._snapshot is None:
+            self._snapshot = {name: (id_, value) for id_, name, value
+                              in self.attrset.values_list('id', 'name', 'value')}
+        return self._snapshot
+    def refresh(self):
+        """Forget the snapshot, so that it is re-read on next access."""
+        self._snapshot = None
+    def _lookup(self, name):
+        if self._pending is not None and name in self._pending:
+            return self._pending[name]
+        if name in self._load():
+            return self._snapshot[name][1]
+        return self._DELETED
     def __contains__(self, name):
-        return self.attrset.filter(name=name).exists()
+        return self._lookup(name) is not self._DELETED
     def __getitem__(self, name):
-        qs = self.attrset.filter(name=name)
-        if qs.exists():
-            return qs.get().value
-        raise KeyError("Device does not have attr %s"%(name))
+        value = self._lookup(name)
+        if value is self._DELETED:
+            raise KeyError("Device does not have attr %s"%(name))
+        return value
     def get(self, name, default=None):
-        qs = self.attrset.filter(name=name)
-        if qs.exists():
-            return qs.get().value
-        return default
+        value = self._lookup(name)
+        if value is self._DELETED:
+            return default
+        return value
+    def _write(self, name, value, now, create_first=False):
+        """Update the row of one attribute, or create it if there is none.
+
+        Names are unique per object, so if another process creates the
+        row first our create fails, and the row is updated instead.
+        Returns the id of a created row, None if the id is not known.
+        """
+        if not create_first and self.attrset.filter(name=name).update(value=value, ts=now):
+            return None
+        try:
+            with transaction.atomic():
+                return self.attrset.create(name=name, value=value).id
+        except IntegrityError:
+            self.attrset.filter(name=name).update(value=value, ts=now)
+            return None
+    def _remember(self, name, value, id_):
+        """Record a written value in the snapshot (if loaded)."""
+        if self._snapshot is None:
+            return
+        if id_ is None and name in self._snapshot:
+            id_ = self._snapshot[name][0]
+        self._snapshot[name] = (id_, value)
+        # Without the id, later buffered updates can't address the row.
+        if id_ is None:
+            self.refresh()
     def __setitem__(self, name, value):
-        qs = self.attrset.filter(name=name)
-        if qs.exists():
-            return qs.update(value=value, ts=timezone.now())
-        return self.attrset.create(name=name, value=value)
+        # The DB column is a CharField, so this is what we would read back.
+        value = str(value)
+        if self._pending is not None:
+            self._pending[name] = value
+            return
+        # Not in the snapshot: most likely new, so try the create first.
+        new = self._snapshot is not None and name not in self._snapshot
+        self._remember(name, value, self._write(name, value, timezone.now(),
+                                                create_first=new))
     def __delitem__(self, name):
-        return self.attrset.filter(name=name).delete()
+        if self._pending is not None:
+            self._pending[name] = self._DELETED
+            return
+        self.attrset.filter(name=name).delete()
+        if self._snapshot is not None:
+            self._snapshot.pop(name, None)
     def items(self):
-        return self.attrset.values_list('name', 'value')
+        return [ (name, self._lookup(name))
+                 for name in sorted(set(self._load()) | set(self._pending or ()))
+                 if self._lookup(name) is not self._DELETED ]
+
+    @contextlib.contextmanager
+    def buffered(self):
+        """Context manager: buffer writes, and flush them at the end.
+
+        If the block raises an exception, the buffered writes are
+        discarded.  Nested use is allowed, the outermost block
+        flushes.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = { }
+        try:
+            yield self
+        except:
+            self._pending = None
+            raise
+        self.flush()
+    def flush(self):
+        """Write all buffered changes, with a few bulk queries.
+
+        Rows deleted or created by other processes since the snapshot
+        are handled one by one, like unbuffered writes.
+        """
+        pending, self._pending = self._pending, None
+        if not pending:
+            return
+        snapshot = self._load()
+        now = timezone.now()
+        deleted = [ name for name, value in pending.items()
+                    if value is self._DELETED and name in snapshot ]
+        changed = { name: value for name, value in pending.items()
+                    if value is not self._DELETED }
+        if deleted:
+            self.attrset.filter(name__in=deleted).delete()
+            for name in deleted:
+                del snapshot[name]
+        model = self.attrset.model
+        updates = [ model(id=snapshot[name][0], name=name, value=value, ts=now)
+                    for name, value in changed.items() if name in snapshot ]
+        creates = [ self.attrset.model(name=name, value=value,
+                                       **self.attrset.core_filters)
+                    for name, value in changed.items() if name not in snapshot ]
+        retry = [ ]
+        if updates:
+            # bulk_update doesn't return row counts, so check which
+            # rows still exist: writes to the others would be lost.
+            model.objects.bulk_update(updates, ['value', 'ts'])
+            found = set(self.attrset.filter(id__in=[row.id for row in updates])
+                        .values_list('id', flat=True))
+            retry.extend(row for row in updates if row.id not in found)
+        if creates:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(creates)
+            except IntegrityError:
+                retry.extend(creates)
+                creates = [ ]
+        for name, value in changed.items():
+            if name in snapshot:
+                snapshot[name] = (snapshot[name][0], value)
+        for row in creates:
+            snapshot[row.name] = (row.id, row.value)
+        for row in retry:
+            snapshot[row.name] = (self._write(row.name, row.value, now), row.value)
+        # Some databases don't return ids from bulk_create.  The ids
+        # are needed for later updates, so re-read next time.
+        if any(id_ is None for id_, value in snapshot.values()):
+            self.refresh()
 
 
 
@@ -0,0 +1,260 @@
+"""Monthly range partitioning of kdata_data by ts (PostgreSQL 11+).
+
+All raw data is in one table, so vacuum, index maintenance and
+aggregates over it get slower as studies accumulate.  Partitioned,
+each calendar month (UTC) of data is its own table: maintenance only
+touches the recent partitions, and queries with a ts range
+(Backend slices, group ts_start/ts_end, the stats page) are pruned to
+the partitions they need.
+
+Layout:
+    kdata_data              partitioned table, PARTITION BY RANGE (ts)
+    kdata_data_p2019_01     ts in [2019-01-01, 2019-02-01)
+    ...
+    kdata_data_default      everything else (device clock errors, ...)
+
+The primary key is (id, ts), since Postgres requires the partition
+key in unique constraints.  Django still uses id as the primary key,
+and ids stay unique since they come from one sequence.  Lookups by id
+alone probe the index of every partition.
+
+Converting an existing table ("manage.py partition_data --convert"):
+a partitioned copy is made and filled in batches of ids while the
+site is running.  Then one transaction locks the old table, copies
+the rows which are not in the copy yet (new ones, and ones whose
+transaction committed after their batch was copied), checks that
+the row counts match and swaps the tables.  Finding the missing rows
+scans the id index of both tables, so uploads wait for that.  Rows
+updated during the copy are not seen, and deleted ones make the
+count check fail, so don't run compress_data or the backfill
+commands at the same time.  The old
+table is kept as kdata_data_unpartitioned, drop it once you are
+satisfied.
+
+Future partitions: "manage.py partition_data --ensure" (from cron,
+or with --loop) creates the partitions of the next
+KOOTA_DATA_PARTITION_MONTHS_AHEAD months.  Until then, new rows go to
+the default partition, and are moved when their partition is created.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TABLE = 'kdata_data'
+
+
+def supported():
+    """True if the database can partition kdata_data."""
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+def _q(name):
+    return connection.ops.quote_name(name)
+
+def month_start(ts):
+    """Start of the (UTC) month of a datetime."""
+    ts = ts.astimezone(dt_timezone.utc)
+    return datetime(ts.year, ts.month, 1, tzinfo=dt_timezone.utc)
+
+def next_month(month):
+    return month_start(month + timedelta(days=32))
+
+def partition_name(month, table=TABLE):
+    return '%s_p%04d_%02d'%(table, month.year, month.month)
+
+def default_partition_name(table=TABLE):
+    return '%s_default'%table
+
+
+def is_partitioned(table=TABLE):
+    with connection.cursor() as c:
+        c.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+        row = c.fetchone()
+    return row is not None and row[0] == 'p'
+
+def partitions(table=TABLE):
+    """[(partition name, bound expression, estimated rows)], by name."""
+    with connection.cursor() as c:
+        c.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples "
+                  "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                  "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname", [table])
+        return [ (name, bound, int(max(rows, 0))) for name, bound, rows in c.fetchall() ]
+
+
+def create_partitioned_table(table, like=TABLE, prefix=None):
+    """Create an empty partitioned table with the columns and indexes of another.
+
+    The id column gets no default, the caller has to set one.  Only
+    plain column indexes are copied, named like the original ones
+    plus '_p'.  The default partition is created too.  Partitions are
+    named after prefix (default: table).
+
+    Returns ({new index name: original index name}, name of the
+    primary key of like).
+    """
+    with connection.cursor() as c:
+        c.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING STORAGE) '
+                  'PARTITION BY RANGE (ts)'%(_q(table), _q(like)))
+        c.execute('ALTER TABLE %s ALTER COLUMN id DROP DEFAULT'%_q(table))
+        c.execute('ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (id, ts)'
+                  %(_q(table), _q('%s_pkey'%table)))
+        indexes = { }
+        like_pkey = None
+        constraints = connection.introspection.get_constraints(c, like)
+        for name, info in sorted(constraints.items()):
+            if info['primary_key']:
+                like_pkey = name
+            if not info['index'] or info['primary_key']:
+                continue
+            if None in info['columns']:
+                logger.warning("partitions: expression index %s skipped", name)
+                continue
+            if info['unique'] and 'ts' not in info['columns']:
+                logger.warning("partitions: unique index %s can't be partitioned, skipped", name)
+                continue
+            new_name = '%s_p'%name[:61]
+            c.execute('CREATE %sINDEX %s ON %s (%s)'%(
+                'UNIQUE ' if info['unique'] else '', _q(new_name), _q(table),
+                ', '.join(_q(col) for col in info['columns'])))
+            indexes[new_name] = name
+        c.execute('CREATE TABLE %s PARTITION OF %s DEFAULT'
+                  %(_q(default_partition_name(prefix or table)), _q(table)))
+    return indexes, like_pkey
+
+def create_partition(month, table=TABLE, prefix=None):
+    """Create the partition of one month.
+
+    Rows of that month in the default partition are moved into it.
+    Returns the partition name.
+    """
+    start, end = month, next_month(month)
+    part = partition_name(month, prefix or table)
+    default = default_partition_name(prefix or table)
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute('SELECT EXISTS (SELECT 1 FROM %s WHERE ts >= %%s AND ts < %%s)'%_q(default),
+                  [start, end])
+        move = c.fetchone()[0]
+        # The default partition may not have rows of a new partition,
+        # so take it out while creating it.
+        if move:
+            c.execute('ALTER TABLE %s DETACH PARTITION %s'%(_q(table), _q(default)))
+        c.execute('CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)'
+                  %(_q(part), _q(table)), [start, end])
+        if move:
+            c.execute('WITH moved AS (DELETE FROM %s WHERE ts >= %%s AND ts < %%s RETURNING *) '
+                      'INSERT INTO %s SELECT * FROM moved'%(_q(default), _q(part)),
+                      [start, end])
+            logger.info("partitions: moved %d rows from %s to %s", c.rowcount, default, part)
+            c.execute('ALTER TABLE %s ATTACH PARTITION %s DEFAULT'%(_q(table), _q(default)))
+    return part
+
+def ensure_partitions(months_ahead=None, table=TABLE, now=None, prefix=None):
+    """Create the missing partitions from this month to months_ahead months ahead.
+
+    Returns the names of the partitions created.
+    """
+    if months_ahead is None:
+        months_ahead = getattr(settings, 'KOOTA_DATA_PARTITION_MONTHS_AHEAD', 3)
+    existing = set(name for name, _, _ in partitions(table))
+    month = month_start(now or datetime.now(dt_timezone.utc))
+    created = [ ]
+    for _ in range(months_ahead + 1):
+        if partition_name(month, prefix or table) not in existing:
+            created.append(create_partition(month, table, prefix=prefix))
+        month = next_month(month)
+    return created
+
+
+def convert(batch_size=100000, min_rows=1000, months_ahead=None, log=logger.info):
+    """Convert kdata_data into a partitioned table, see module docstring.
+
+    There is one partition per month from the first month with at
+    least min_rows rows until months_ahead months from now; earlier
+    rows go to the default partition.
+    """
+    if is_partitioned():
+        raise ValueError("%s is already partitioned"%TABLE)
+    new = '%s_new'%TABLE
+    old = '%s_unpartitioned'%TABLE
+    seq = '%s_p_id_seq'%TABLE
+    with connection.cursor() as c:
+        c.execute("SELECT conname FROM pg_constraint WHERE confrelid = to_regclass(%s)", [TABLE])
+        foreign_keys = [ row[0] for row in c.fetchall() ]
+        if foreign_keys:
+            raise ValueError("Foreign keys reference %s, migrate first: %s"
+                             %(TABLE, ', '.join(foreign_keys)))
+        columns = ', '.join(_q(col.name) for col in
+                            connection.introspection.get_table_description(c, TABLE))
+
+    # Which months get partitions.  The rest of the rows (device
+    # clocks in 1970...) go to the default partition.
+    with connection.cursor() as c:
+        c.execute("SELECT min(month) FROM (SELECT date_trunc('month', ts AT TIME ZONE 'UTC') AS month "
+                  "FROM %s GROUP BY 1 HAVING count(*) >= %%s) AS months"%_q(TABLE), [min_rows])
+        first = c.fetchone()[0]
+    now = datetime.now(dt_timezone.utc)
+    month = month_start(first.replace(tzinfo=dt_timezone.utc) if first else now)
+
+    # The partitions already get their final names.
+    with transaction.atomic():
+        indexes, pkey = create_partitioned_table(new, prefix=TABLE)
+        while month <= now:
+            create_partition(month, new, prefix=TABLE)
+            month = next_month(month)
+        ensure_partitions(months_ahead, table=new, now=now, prefix=TABLE)
+    log("Created %s with %d partitions"%(new, len(partitions(new))))
+
+    # Copy in batches of ids, each in its own transaction.  A batch
+    # only has the rows committed when it runs: the rest are copied
+    # by the swap below.
+    with connection.cursor() as c:
+        c.execute('SELECT COALESCE(max(id), 0) FROM %s'%_q(TABLE))
+        max_id = c.fetchone()[0]
+    batch_start = 0
+    while batch_start < max_id:
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE id > %%s AND id <= %%s'
+                      %(_q(new), columns, columns, _q(TABLE)),
+                      [batch_start, batch_start + batch_size])
+        batch_start += batch_size
+        log("Copied ids up to %d of %d"%(min(batch_start, max_id), max_id))
+
+    # Swap.  Uploads wait for this transaction.
+    missing = ('INSERT INTO %s (%s) SELECT %s FROM %s AS old WHERE NOT EXISTS '
+               '(SELECT 1 FROM %s AS new WHERE new.id = old.id)'
+               %(_q(new), columns, columns, _q(TABLE), _q(new)))
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE'%_q(TABLE))
+        c.execute(missing)
+        log("Copied %d new or late rows"%c.rowcount)
+        c.execute('SELECT (SELECT count(*) FROM %s), (SELECT count(*) FROM %s)'
+                  %(_q(TABLE), _q(new)))
+        n_old, n_new = c.fetchone()
+        if n_old != n_new:
+            # Rolls back the swap, nothing is lost.
+            raise RuntimeError("%s has %d rows but %s has %d, not swapping"
+                               %(TABLE, n_old, new, n_new))
+        c.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        old_seq = c.fetchone()[0]
+        c.execute('CREATE SEQUENCE %s'%_q(seq))
+        c.execute('SELECT setval(%%s, GREATEST((SELECT COALESCE(max(id), 0) FROM %s), %s, 1))'
+                  %(_q(TABLE), '(SELECT last_value FROM %s)'%old_seq if old_seq else '0'),
+                  [seq])
+        c.execute('ALTER TABLE %s RENAME TO %s'%(_q(TABLE), _q(old)))
+        if pkey:
+            c.execute('ALTER TABLE %s RENAME CONSTRAINT %s TO %s'
+                      %(_q(old), _q(pkey), _q('%s_pkey'%old)))
+        for new_index, index in indexes.items():
+            c.execute('ALTER INDEX %s RENAME TO %s'%(_q(index), _q('%s_old'%index[:59])))
+            c.execute('ALTER INDEX %s RENAME TO %s'%(_q(new_index), _q(index)))
+        c.execute('ALTER TABLE %s RENAME TO %s'%(_q(new), _q(TABLE)))
+        c.execute('ALTER TABLE %s RENAME CONSTRAINT %s TO %s'
+                  %(_q(TABLE), _q('%s_pkey'%new), _q('%s_pkey'%TABLE)))
+        c.execute("ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval('%s')"%(_q(TABLE), seq))
+        c.execute('ALTER SEQUENCE %s OWNED BY %s.id'%(_q(seq), _q(TABLE)))
+    log("%s is now partitioned, the old table is %s"%(TABLE, old))
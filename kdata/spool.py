@@ -0,0 +1,287 @@
+"""Durable ingest spool.
+
+If settings.KOOTA_INGEST_SPOOL_DIR is set, the ingest views don't
+write to the database.  Packets are instead appended to a local
+append-only spool file, fsynced, and acknowledged.  The management
+command "drain_spool" later moves the spooled packets into the Data
+table in large batches.  This decouples the latency of uploads from
+the latency of the database.
+
+Spool file format: each record is one line of JSON header (device_id,
+ip, timestamps, sha256, length, ...), followed by exactly `length`
+bytes of payload and a newline.  A record which is cut off at the
+end of a file was never fsynced, thus never acknowledged, and is
+ignored.
+
+Draining: the live spool file is renamed to a unique *.draining name
+(under the same lock the writers use), and then read in batches.
+After each batch is committed, the byte offset is written to a
+*.offset file.  If the drainer crashes, the next run continues from
+the offset, so a crash can at most repeat the one batch which was
+committed but whose offset was not yet written.  The records of the
+first batch of each file are thus skipped if they are already in the
+database.
+
+Note: the device attributes which are given with the packets (like
+the AWARE last timestamp) are only updated once the packets are
+drained.
+"""
+
+import fcntl
+import glob
+from hashlib import sha256
+import json
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from . import hooks
+from . import ingest
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+SPOOL_NAME = 'ingest.spool'
+
+
+def spool_dir():
+    return getattr(settings, 'KOOTA_INGEST_SPOOL_DIR', None)
+
+def enabled():
+    """True if uploads should be spooled instead of saved directly."""
+    return bool(spool_dir())
+
+
+def append(datas, device_id, request=None, attrs=None, data_sha256s=None,
+           probes=None, data_ts=None):
+    """Durably append packets to the spool.
+
+    datas:     list of packets (str or bytes) from one device.
+    device_id: device ID under which to save.  The checksum is
+               checked now, so that invalid IDs are rejected while
+               we can still tell the client.
+    request:   the HttpRequest, used to get the remote IP address.
+    attrs:     dict of device attributes to set once the packets are
+               in the database.
+    data_sha256s: hashes of the data as uploaded, to store in the
+               data_sha256 column, if different from the hash of the
+               data (see views.save_data).
+    probes:    list of the probes of each packet (see
+               views.save_data).
+    data_ts:   list of the data timestamps (unix time or None) of each
+               packet.  Default: the time received.
+
+    Returns the list of sha256 hexdigests of the packets.  When this
+    returns, the packets are on disk.
+    """
+    device_id = ingest.check_device_id(device_id)
+    remote_ip = ingest.remote_ip(request)
+    received_ts = time.time()
+    records = [ ]
+    hashes = [ ]
+    for i, data in enumerate(datas):
+        is_bytes = isinstance(data, bytes)
+        if not is_bytes:
+            if not isinstance(data, str):
+                raise ValueError("save_data data must be str or bytes!")
+            data = data.encode('utf8')
+        data_sha256 = sha256(data).hexdigest()
+        header = dict(device_id=device_id, ip=remote_ip,
+                      ts_received=received_ts, sha256=data_sha256,
+                      length=len(data), bytes=is_bytes)
+        # Attributes are applied after the last packet of the upload.
+        if attrs and i == len(datas) - 1:
+            header['attrs'] = attrs
+        if data_sha256s is not None:
+            header['data_sha256'] = data_sha256s[i]
+        if probes is not None and probes[i]:
+            header['probes'] = probes[i]
+        if data_ts is not None and data_ts[i] is not None:
+            header['ts'] = data_ts[i]
+        records.append(json.dumps(header).encode('utf8') + b'\n')
+        records.append(data)
+        records.append(b'\n')
+        hashes.append(data_sha256)
+    _write_locked(os.path.join(spool_dir(), SPOOL_NAME), b''.join(records))
+    return hashes
+
+def _write_locked(path, buf):
+    """Append buf to path under an exclusive lock and fsync it."""
+    while True:
+        fd = os.open(path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The drainer may have renamed the file between our open
+            # and getting the lock.  If so, retry with the new file.
+            try:
+                same_file = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if not same_file:
+                continue
+            view = memoryview(buf)
+            while view:
+                n = os.write(fd, view)
+                view = view[n:]
+            os.fsync(fd)
+            return
+        finally:
+            os.close(fd)
+
+
+def read_records(f):
+    """Iterate (offset_after, header, data) over the records of a spool file.
+
+    Stops at the first incomplete record.  Records whose sha256 does
+    not match are logged and skipped.
+    """
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        if not line.endswith(b'\n'):
+            logger.warning("spool: incomplete record header in %s", f.name)
+            return
+        header = json.loads(line.decode('utf8'))
+        data = f.read(header['length'])
+        if len(data) != header['length'] or f.read(1) != b'\n':
+            logger.warning("spool: incomplete record in %s", f.name)
+            return
+        if sha256(data).hexdigest() != header['sha256']:
+            logger.error("spool: checksum mismatch in %s, record skipped: %s",
+                         f.name, header)
+            continue
+        if not header['bytes']:
+            data = data.decode('utf8')
+        yield f.tell(), header, data
+
+
+def _rotate():
+    """Move the live spool file aside for draining, if it has data."""
+    path = os.path.join(spool_dir(), SPOOL_NAME)
+    if not os.path.exists(path):
+        return
+    with open(path, 'ab') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        new_path = '%s.%d.%d.draining'%(path, time.time()*1e6, os.getpid())
+        os.rename(path, new_path)
+
+def drain(batch_size=1000):
+    """Move all spooled packets into the database.
+
+    Files left over from an interrupted drain are replayed first.
+    Returns the number of packets saved.
+    """
+    lock = open(os.path.join(spool_dir(), SPOOL_NAME+'.drainlock'), 'w')
+    try:
+        # Only one drainer at a time.
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        _rotate()
+        n = 0
+        for path in sorted(glob.glob(os.path.join(spool_dir(), SPOOL_NAME+'.*.draining'))):
+            n += _drain_file(path, batch_size=batch_size)
+        return n
+    finally:
+        lock.close()
+
+def _drain_file(path, batch_size):
+    offset_path = path + '.offset'
+    offset = 0
+    if os.path.exists(offset_path):
+        offset = int(open(offset_path).read() or 0)
+        logger.info("spool: resuming %s at offset %d", path, offset)
+    n = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        batch = [ ]
+        replay = True
+        for offset, header, data in read_records(f):
+            batch.append((header, data))
+            if len(batch) >= batch_size:
+                n += _save_batch(batch, replay=replay)
+                _write_offset(offset_path, offset)
+                batch = [ ]
+                replay = False
+        if batch:
+            n += _save_batch(batch, replay=replay)
+            _write_offset(offset_path, offset)
+    os.unlink(path)
+    if os.path.exists(offset_path):
+        os.unlink(offset_path)
+    return n
+
+def _write_offset(offset_path, offset):
+    with open(offset_path+'.tmp', 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(offset_path+'.tmp', offset_path)
+
+def _unsaved(batch):
+    """The records of a batch which are not in the database yet.
+
+    A spooled record is identified by its device_id, data_sha256 and
+    time received.
+    """
+    saved = set(models.Data.objects.filter(
+        device_id__in=set(header['device_id'] for header, _ in batch),
+        data_sha256__in=set(header.get('data_sha256', header['sha256']) for header, _ in batch))
+                .values_list('device_id', 'data_sha256', 'ts_received'))
+    return [ (header, data) for header, data in batch
+             if (header['device_id'], header.get('data_sha256', header['sha256']),
+                 ingest.to_datetime(header['ts_received'])) not in saved ]
+
+def _save_batch(batch, replay=False):
+    """Insert one batch of spooled packets, and their attributes, atomically.
+
+    If replay is true, the batch may have been saved before a crash
+    (see module docstring), so the records already saved are skipped.
+    Returns the number of packets saved (not rows: packets may be
+    split).
+    """
+    if replay:
+        n_read = len(batch)
+        batch = _unsaved(batch)
+        if len(batch) < n_read:
+            logger.info("spool: %d replayed packets were already saved", n_read - len(batch))
+        if not batch:
+            return 0
+    packets = [ ]
+    for header, data in batch:
+        device_class = ingest.saving_device_class(header['device_id'], None, len(data))
+        packets.append((header, device_class, ingest.packet_rows(
+            data, header['device_id'], header['ip'],
+            received_ts=header['ts_received'],
+            data_ts=header.get('ts', header['ts_received']),
+            data_sha256=header.get('data_sha256', header['sha256']),
+            device_class=device_class)))
+    rows = [ row for _, _, packet_rows in packets for row in packet_rows ]
+    with transaction.atomic():
+        models.Data.objects.bulk_create(rows)
+        probes = [ header['probes'] if 'probes' in header else ingest.packet_probes(device_class, data)
+                   for (header, data), (_, device_class, _) in zip(batch, packets) ]
+        if any(probes) or any(hooks.async_hooks(device_class) for _, device_class, _ in packets):
+            ingest.inserted_ids(rows)
+        for (header, device_class, packet_rows), packet_probes in zip(packets, probes):
+            if packet_probes:
+                ingest.save_probes(packet_rows, packet_probes)
+            hooks.enqueue(device_class, packet_rows)
+        models.DeviceStats.add_rows(rows)
+        devices = { }
+        for header, data in batch:
+            if not header.get('attrs'):
+                continue
+            device_id = header['device_id']
+            if device_id not in devices:
+                devices[device_id] = models.Device.objects.filter(device_id=device_id).first()
+            if devices[device_id] is None:
+                logger.warning("spool: attrs for unknown device %s", device_id)
+                continue
+            for name, value in header['attrs'].items():
+                devices[device_id].attrs[name] = value
+    return len(batch)
@@ -64,3 +64,633 @@ class BasicTest(TestCase):
         r = c.post('/group/', dict(invite_code='groupinvite', groups='Test Group'))
         models.GroupSubject.objects.filter(user__username='test-user', group__slug='test-group')
         #import IPython ; IPython.embed()
+
+
+class IngestTest(TestCase):
+    def setUp(self):
+        from kdata import devices
+        self.user = models.User.objects.create_user('test-user', 'test@example.com',
+                                                    'test2')
+        self.device = models.Device(user=self.user, name='test-aware', type='Aware')
+        devices.get_class('Aware').create_hook(self.device, user=self.user)
+        self.device.save()
+
+    def test_aware_insert(self):
+        import json
+        from django.urls import reverse
+        rows = [dict(timestamp=1500000000000+i, double_values_0=i) for i in range(2500)]
+        url = reverse('aware-insert', kwargs=dict(secret_id=self.device.secret_id,
+                                                  table='accelerometer'))
+        r = self.client.post(url, dict(data=json.dumps(rows), nonce='abc'))
+        assert r.status_code == 200
+        response = r.json()
+        assert response[0]['timestamp'] == 1500000002499
+        assert response[0]['nonce'] == 'abc'
+        packets = models.Data.objects.filter(device_id=self.device.device_id)
+        assert packets.count() == 3
+        assert sum(len(json.loads(json.loads(x.data)['data'])) for x in packets) == 2500
+        assert float(self.device.attrs['aware-last-ts-accelerometer']) == 1500000002499
+        probes = models.DataProbe.objects.filter(device_id=self.device.device_id).order_by('ts_min')
+        assert [ (p.probe, p.n_rows) for p in probes ] == [('accelerometer', 1000),
+                                                          ('accelerometer', 1000),
+                                                          ('accelerometer', 500)]
+        assert probes[0].ts_min.timestamp() == 1500000000
+        assert probes[2].ts_max.timestamp() == 1500000002.499
+
+    def test_select_packets(self):
+        import json
+        from django.urls import reverse
+        from kdata import converter, views
+        device_id = self.device.device_id
+        def insert(table, n):
+            rows = [dict(timestamp=1500000000000+i, screen_status=1) for i in range(n)]
+            url = reverse('aware-insert', kwargs=dict(secret_id=self.device.secret_id,
+                                                      table=table))
+            assert self.client.post(url, dict(data=json.dumps(rows))).status_code == 200
+        insert('accelerometer', 3000)
+        insert('screen', 2)
+        device = models.Device.objects.get(device_id=device_id)
+        queryset = models.Data.objects.filter(device_id=device_id)
+        assert device.stats.probes_complete
+        assert converter.AwareScreen.select_packets(queryset, device).count() == 1
+        assert converter.AwareUploads.select_packets(queryset, device).count() == 4
+        assert converter.AwareCalls.select_packets(queryset, device).count() == 0
+        # Packets without probes, until backfill_probes has been run.
+        models.DeviceStats.objects.filter(device_id=device_id).update(probes_complete=False)
+        views.save_data(json.dumps(dict(table='screen', data='[]')), device_id)
+        device = models.Device.objects.get(device_id=device_id)
+        assert converter.AwareScreen.select_packets(queryset, device).count() == 5
+        from django.core.management import call_command
+        call_command('backfill_probes', device_id, verbosity=0)
+        device = models.Device.objects.get(device_id=device_id)
+        assert converter.AwareScreen.select_packets(queryset, device).count() == 2
+        self.client.force_login(self.user)
+        r = self.client.get('/devices/%s/AwareScreen.csv'%device.public_id)
+        assert b''.join(r.streaming_content).decode().splitlines()[1:] \
+            == ['1500000000.0,1', '1500000000.001,1']
+
+    def test_save_data_timestamps(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from kdata import views
+        device_id = self.device.device_id
+        def data_writes(queries):
+            return [ q['sql'] for q in queries if '"kdata_data"' in q['sql']
+                     and not q['sql'].startswith('SELECT') ]
+        with CaptureQueriesContext(connection) as queries:
+            rowid = views.save_data('x', device_id, received_ts=1500000000,
+                                    data_ts=1400000000)
+        assert len(data_writes(queries)) == 1
+        row = models.Data.objects.get(id=rowid)
+        assert row.ts.timestamp() == 1400000000
+        assert row.ts_received.timestamp() == 1500000000
+        with CaptureQueriesContext(connection) as queries:
+            views.save_data_batch(['a', 'b'], device_id, data_ts=[1400000001, None])
+        assert len(data_writes(queries)) == 1
+        assert models.Data.objects.filter(device_id=device_id).count() == 3
+
+    def test_device_stats(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from kdata import views
+        device_id = self.device.device_id
+        now = timezone.now()
+        views.save_data('old', device_id, data_ts=now-timedelta(days=30))
+        stats = models.DeviceStats.get(device_id)
+        assert (stats.n_packets, stats.bytes_total) == (1, 3)
+        views.save_data_batch(['a', 'bb'], device_id, data_ts=[now-timedelta(days=1), now])
+        views.save_data('ccc', device_id, data_ts=now-timedelta(days=40))
+        device = models.Device.objects.get(device_id=device_id)
+        with self.assertNumQueries(1):
+            stats = device.stats
+        assert (stats.n_packets, stats.bytes_total) == (4, 9)
+        assert stats.first_ts == now-timedelta(days=40)
+        assert stats.last_ts == now
+        assert device.n_packets == 4
+        assert stats.packets_recent(days=7) == 2
+        # Packets changed behind its back: reconcile_stats counts again.
+        models.Data.objects.filter(device_id=device_id, data='a').delete()
+        call_command('reconcile_stats', device_id, verbosity=0)
+        stats = models.DeviceStats.get(device_id)
+        assert (stats.n_packets, stats.bytes_total) == (3, 8)
+        assert stats.packets_recent(days=7) == 1
+        # Reads count missing days without inserting rows.
+        assert not models.DeviceDayStats.objects.filter(device_id=device_id).exists()
+
+    def test_spool(self):
+        import tempfile
+        from unittest import mock
+        from kdata import spool
+        device_id = self.device.device_id
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.settings(KOOTA_INGEST_SPOOL_DIR=tmpdir):
+            r = self.client.post('/post/%s'%device_id, b'packet-1',
+                                 content_type='application/octet-stream')
+            assert r.status_code == 200
+            spool.append(['packet-2', 'packet-3'], device_id,
+                         attrs={'spool-test': 'x'})
+            assert not models.Data.objects.filter(device_id=device_id).exists()
+            assert spool.drain(batch_size=2) == 3
+            assert spool.drain() == 0
+            # A crash after the INSERT, before the offset is written:
+            # the batch is read again, but not saved twice.
+            spool.append(['packet-4', 'packet-5'], device_id)
+            with mock.patch.object(spool, '_write_offset', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    spool.drain()
+            assert spool.drain() == 0
+        rows = models.Data.objects.filter(device_id=device_id).order_by('id')
+        assert [x.data for x in rows][1:] == ['packet-2', 'packet-3', 'packet-4', 'packet-5']
+        assert self.device.attrs['spool-test'] == 'x'
+
+    def test_device_cache(self):
+        secret_id = self.device.secret_id
+        models.Device.get_by_secret_id(secret_id)
+        with self.assertNumQueries(0):
+            device = models.Device.get_by_secret_id(secret_id)
+        assert device.device_id == self.device.device_id
+        device.name = 'renamed'
+        device.save()
+        assert models.Device.get_by_secret_id(secret_id).name == 'renamed'
+
+    def test_attrs(self):
+        attrs = models.Device.objects.get(device_id=self.device.device_id).attrs
+        attrs['a'] = 1
+        with self.assertNumQueries(1):
+            assert attrs['a'] == '1' and attrs.get('b') is None and 'b' not in attrs
+            assert attrs.get('a') == '1'
+        # Update, check that the rows still exist, create (in a savepoint).
+        with self.assertNumQueries(5):
+            with attrs.buffered():
+                attrs['a'] = 2
+                attrs['b'] = 3
+                del attrs['c']
+                assert attrs['b'] == '3'
+        attrs = models.Device.objects.get(device_id=self.device.device_id).attrs
+        items = dict(attrs.items())
+        assert items['a'] == '2' and items['b'] == '3' and 'c' not in items
+        with attrs.buffered():
+            del attrs['a']
+        assert models.DeviceAttr.objects.filter(name='a').count() == 0
+        # Rows created or deleted by another process since the snapshot.
+        other = models.Device.objects.get(device_id=self.device.device_id).attrs
+        attrs['x'] = 0
+        other['y'] = 1
+        models.DeviceAttr.objects.filter(name='x').delete()
+        with attrs.buffered():
+            attrs['x'] = 2
+            attrs['y'] = 3
+        attrs['z'] = 4
+        other['z'] = 5
+        other['y'] = 6
+        attrs['y'] = 7
+        other.refresh()
+        assert [ other[name] for name in 'bxyz' ] == ['3', '2', '7', '5']
+
+    def test_dedupe(self):
+        from hashlib import sha256
+        device_id = self.device.device_id
+        self.device.attrs['dedupe_uploads'] = '1'
+        with self.settings(KOOTA_DEDUPE_UPLOADS=True):
+            r1 = self.client.post('/post/%s'%device_id, b'packet', HTTP_X_ROWID='1',
+                                  content_type='application/octet-stream').json()
+            r2 = self.client.post('/post/%s'%device_id, b'packet',
+                                  content_type='application/octet-stream').json()
+        assert r2['ok'] and r2['duplicate'] and r2['rowid'] == r1['rowid']
+        row = models.Data.objects.get(device_id=device_id)
+        assert row.data_sha256 == sha256(b'packet').hexdigest()
+
+    def test_keyset_iterator(self):
+        from kdata import util, views
+        device_id = self.device.device_id
+        # Same ts for several packets, one of them compressed.
+        datas = [ str(i)*(i+1) for i in range(10) ]
+        with self.settings(KOOTA_DATA_COMPRESSION='zlib', KOOTA_DATA_COMPRESS_MIN_LENGTH=8):
+            views.save_data_batch(datas, device_id, data_ts=[1500000000 + i//3 for i in range(10)])
+        qs = models.Data.objects.filter(device_id=device_id).order_by('ts')
+        # Pages of 2, 6, 1, 1 and 0 rows.
+        with self.assertNumQueries(5):
+            rows = list(util.keyset_queryset_iterator(qs, byte_budget=10, first_batch=2))
+        assert [ data for ts, data in rows ] == datas
+        assert rows[0][0].timestamp() == 1500000000
+        assert [ data for ts, data in util.keyset_queryset_iterator(qs.reverse()) ] == datas[::-1]
+        assert [ data for ts, data in util.keyset_queryset_iterator(
+                 qs.filter(ts__gt=rows[2][0]).order_by('-ts'), byte_budget=1) ] == datas[:2:-1]
+
+    def test_raw_export_markers(self):
+        import json, zlib
+        from kdata import export
+        data_z = zlib.compress('{"a": "\u00e4,\\n"}'.encode('utf8')).hex().encode()
+        # A compressed packet split across COPY output chunks.
+        chunks = [b'1,x\n\x031500000000 1 ' + data_z[:5], data_z[5:] + b',\n2,"y\n\x03"\n']
+        out = b''.join(export._decode_markers(iter(chunks), 'csv')).decode('utf8')
+        assert out == '1,x\n1500000000,"{""a"": ""\u00e4,\\n""}"\n2,"y\n\x03"\n'
+        out = b''.join(export._decode_markers(iter([b'[1, "x"]\n\x031500000000 1 ' + data_z]),
+                                              'json-lines'))
+        assert [ json.loads(line) for line in out.split(b'\n') ] == [[1, 'x'], [1500000000, '{"a": "\u00e4,\\n"}']]
+        assert export.raw_export(models.Data.objects.all(), 'csv', 'x') is None  # sqlite
+
+    def test_partition_convert(self):
+        from kdata import partitions, views
+        if not partitions.supported():
+            self.skipTest("Partitioning needs PostgreSQL")
+        device_id = self.device.device_id
+        ids = [ views.save_data('row %d'%i, device_id) for i in range(5) ]
+        # A row whose transaction commits after its batch was copied.
+        late = models.Data.objects.get(id=ids[0])
+        late.delete()   # sets late.id to None
+        def log(msg):
+            if (msg.startswith('Copied ids up to') and late.id is None
+                and int(msg.split()[4]) >= ids[0]):
+                late.id = ids[0]
+                late.save(force_insert=True)
+                # A row inserted after the last batch.
+                views.save_data('row 5', device_id)
+        partitions.convert(batch_size=2, min_rows=1, log=log)
+        assert partitions.is_partitioned()
+        assert sorted(models.Data.objects.filter(device_id=device_id)
+                      .values_list('data', flat=True)) == [ 'row %d'%i for i in range(6) ]
+
+    def test_raw_export_codec_none(self):
+        from django.db.models.expressions import RawSQL
+        from kdata import export
+        device_id = self.device.device_id
+        for codec in (None, models.Data.CODEC_NONE, models.Data.CODEC_ZLIB):
+            models.Data.objects.create(device_id=device_id, ip='127.0.0.1',
+                                       data='codec %s'%codec, codec=codec)
+        # The data column of csv exports is portable SQL.
+        data_column = export._COPY_SQL['csv'][1][1]
+        qs = models.Data.objects.filter(device_id=device_id).order_by('id')
+        assert list(qs.annotate(c=RawSQL(data_column, ())).values_list('c', flat=True)) \
+            == ['codec None', 'codec 0', None]
+        if export.supported(qs):
+            out = b''.join(export.raw_export(qs, 'csv', 'x').streaming_content).decode()
+            assert [ line.split(',')[1] for line in out.splitlines()[1:] ] \
+                == ['codec None', 'codec 0', 'codec 1']
+
+    def test_compression(self):
+        from django.core.management import call_command
+        from kdata import views
+        device_id = self.device.device_id
+        data = '{"x": 1}' * 1000
+        assert [ self.device.backend[i] for i in (0, 5, -1, -3) ] == [None]*4
+        with self.settings(KOOTA_DATA_COMPRESSION='zlib'):
+            rowid = views.save_data(data, device_id)
+        rowid2 = views.save_data(data+'2', device_id)
+        call_command('compress_data', verbosity=0)
+        stored = models.Data.objects.filter(id__in=[rowid, rowid2]).values_list('data', 'codec')
+        assert set(stored) == {('', models.Data.CODEC_ZLIB)}
+        assert self.device.backend[-1].data == data+'2'
+        with self.assertRaises(IndexError):
+            self.device.backend[5]
+        row = models.Data.objects.defer('data', 'data_z').get(id=rowid)
+        assert row.data == data
+        row.ip = '127.0.0.2'
+        row.save()
+        assert models.Data.objects.get(id=rowid).data == data
+
+    def test_compressed_body(self):
+        import gzip, zlib
+        from hashlib import sha256
+        device_id = self.device.device_id
+        payload = b'compressed packet' * 100
+        r = self.client.post('/post/%s'%device_id, gzip.compress(payload),
+                             content_type='application/octet-stream',
+                             HTTP_CONTENT_ENCODING='gzip',
+                             HTTP_X_SHA256=sha256(payload).hexdigest())
+        assert r.status_code == 200 and r.json()['bytes'] == len(payload)
+        r = self.client.post('/post/', zlib.compress(b'data=x&device_id='+device_id.encode()),
+                             content_type='application/x-www-form-urlencoded',
+                             HTTP_CONTENT_ENCODING='deflate')
+        assert r.status_code == 200 and r.json()['bytes'] == 1
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=1000, KOOTA_MAX_UPLOAD_SIZE=1000):
+            r = self.client.post('/post/%s'%device_id, gzip.compress(payload),
+                                 content_type='application/octet-stream',
+                                 HTTP_CONTENT_ENCODING='gzip')
+            assert r.status_code == 413
+            # Routes with a device class use its limit.
+            import json
+            from django.test import RequestFactory
+            from kdata import views
+            from kdata.devices.actiwatch import Actiwatch
+            request = RequestFactory().post('/post/%s'%device_id, gzip.compress(payload),
+                                            content_type='application/octet-stream',
+                                            HTTP_CONTENT_ENCODING='gzip')
+            r = views.post(request, device_id=device_id, device_class=Actiwatch)
+            assert r.status_code == 200 and json.loads(r.content)['bytes'] == len(payload)
+
+    def test_admission_control(self):
+        from kdata import admission
+        device_id = self.device.device_id
+        orig = admission.controller
+        admission.controller = admission.AdmissionController(device_rate=0.001, device_burst=1)
+        try:
+            r1 = self.client.post('/post/%s'%device_id, b'x', content_type='text/plain')
+            r2 = self.client.post('/post/%s'%device_id, b'x', content_type='text/plain')
+            stats = admission.controller.stats()
+        finally:
+            admission.controller = orig
+        assert r1.status_code == 200
+        assert r2.status_code == 503 and int(r2['Retry-After']) > 0
+        assert stats == dict(admitted=1, rejected_device_rate=1, in_flight=0)
+
+    def test_upload_size_limit(self):
+        from hashlib import sha256
+        device_id = self.device.device_id
+        payload = b'0123456789' * 1000
+        with self.settings(KOOTA_MAX_UPLOAD_SIZE=len(payload)):
+            r = self.client.post('/post/%s'%device_id, payload,
+                                 content_type='application/octet-stream',
+                                 HTTP_X_SHA256=sha256(payload).hexdigest())
+            assert r.status_code == 200 and r.json()['bytes'] == len(payload)
+            r = self.client.post('/post/%s'%device_id, payload+b'x',
+                                 content_type='application/octet-stream')
+            assert r.status_code == 413
+        assert models.Data.objects.filter(device_id=device_id).count() == 1
+
+    def test_split_packets(self):
+        import json
+        from unittest import mock
+        from kdata import util, views
+        from kdata.devices.ios import Ios
+        assert util.split_lines('a,b\n1,2\n3,4\n', 8) == ['a,b\n1,2\n', '3,4\n']
+        records = [ dict(probe='x', i=i) for i in range(100) ]
+        data = json.dumps(records).encode()
+        pieces = util.split_json_array(data, 500)
+        assert len(pieces) > 1 and all(len(p) <= 500 for p in pieces)
+        assert sum((json.loads(p) for p in pieces), []) == records
+        assert util.split_json_array(b'{"a": 1}', 5) == [b'{"a": 1}']
+        device_id = self.device.device_id
+        with mock.patch.object(Ios, 'max_packet_size', 500):
+            views.save_data(data, device_id, device_class=Ios)
+        rows = models.Data.objects.filter(device_id=device_id).order_by('ts')
+        assert len(rows) == len(pieces)
+        assert len(set(r.upload_id for r in rows)) == 1 and rows[0].upload_id
+        assert [ r.data for r in rows ] == [ str(p) for p in pieces ]
+        # drain() counts packets, not the rows they are split into.
+        import tempfile
+        from kdata import spool
+        from kdata.devices.aware import Aware
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.settings(KOOTA_INGEST_SPOOL_DIR=tmpdir), \
+                mock.patch.object(Aware, 'max_packet_size', 500), \
+                mock.patch.object(Aware, 'packet_splitter', Ios.packet_splitter):
+            spool.append([data], device_id)
+            assert spool.drain() == 1
+        assert models.Data.objects.filter(device_id=device_id).count() == 2*len(pieces)
+
+    def test_device_filter(self):
+        from kdata import cache, util
+        unknown_id = util.add_checkdigits('0123456789abcdef')
+        cache.device_filter.invalidate()
+        with self.settings(KOOTA_DEVICE_FILTER=True):
+            r = self.client.post('/post/%s'%self.device.device_id, b'x', content_type='text/plain')
+            assert r.status_code == 200
+            with self.assertNumQueries(0):
+                r = self.client.post('/post/%s'%unknown_id, b'x', content_type='text/plain')
+            assert r.status_code == 404
+            assert cache.device_filter.stats()['rejected'] == 1
+        assert not models.Data.objects.filter(device_id=unknown_id).exists()
+
+    def test_aware_register(self):
+        from unittest import mock
+        from django.urls import reverse
+        from kdata import util
+        from kdata.devices import aware
+        url = reverse('aware-register', kwargs=dict(secret_id=self.device.secret_id))
+        for i in range(3):
+            r = self.client.post(url, dict(study_check='1', device_id='uuid'))
+            assert r.status_code == 200
+        r = self.client.post(url, dict(study_check='1', device_id='uuid2'))
+        packets = models.Data.objects.filter(device_id=self.device.device_id)
+        assert packets.count() == 2
+        assert self.device.attrs['aware-study-check-count'] == '4'
+        # A new window stores the same metadata again.
+        with mock.patch.object(aware, 'STUDY_CHECK_WINDOW', 0):
+            r = self.client.post(url, dict(study_check='1', device_id='uuid2'))
+        assert packets.count() == 3
+        with mock.patch.object(util, 'hash_mosquitto_password',
+                               wraps=util.hash_mosquitto_password) as hasher:
+            for i in range(2):
+                r = self.client.post(url, dict(device_id='uuid'))
+                assert r.status_code == 200
+        assert hasher.call_count == 1
+        attrs = models.Device.objects.get(device_id=self.device.device_id).attrs
+        assert attrs['aware-device-passwd_pbkdf2'].startswith('PBKDF2$')
+
+    def test_hooks(self):
+        from unittest import mock
+        from kdata import devices, hooks
+        device_id = self.device.device_id
+        seen = [ ]
+        def check(data, device_id, request):
+            if b'bad' in data:
+                raise hooks.Rejected("bad data")
+            return data
+        def index(row):
+            seen.append(row.data)
+            if len(seen) == 1:
+                raise ValueError("try again")
+        cls = devices.get_class(self.device.type)
+        index_hook = hooks.Hook(index, retry_delay=0)
+        with mock.patch.object(cls, 'ingest_hooks',
+                               [hooks.Hook(check, inline=True), index_hook]):
+            r = self.client.post('/post/%s'%device_id, b'bad', content_type='text/plain')
+            assert r.status_code == 400
+            r = self.client.post('/post/%s'%device_id, b'good', content_type='text/plain')
+            assert r.status_code == 200
+            assert models.IngestJob.objects.count() == 1
+            assert hooks.run_pending() == 1
+            job = models.IngestJob.objects.get()
+            assert job.attempts == 1 and 'try again' in job.last_error
+            assert hooks.run_pending() == 1
+            # Bulk inserts queue jobs too (sqlite doesn't return their ids).
+            from kdata import views
+            rowids = views.save_data_batch(['x', 'y'], device_id)
+            assert sorted(models.IngestJob.objects.values_list('data_id', flat=True)) == rowids
+            assert hooks.run_pending() == 2
+        assert seen == ["b'good'", "b'good'", 'x', 'y']
+        assert not models.IngestJob.objects.exists()
+        assert hooks.stats.stats()[index_hook.name]['errors'] == 1
+
+    def test_funf_post(self):
+        import ast, json, sqlite3
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from Crypto.Cipher import DES
+        from kdata.devices import funf_decrypt
+        conn = sqlite3.connect(':memory:')
+        conn.execute('create table data (id integer, name text, value text)')
+        conn.execute('create table android_metadata (locale text)')
+        conn.execute('create table file_info (id text)')
+        conn.execute("insert into data values (1, 'probe', 'x')")
+        conn.commit()
+        image = conn.serialize()
+        image += bytes([8]) * 8    # PKCS5 padding of a full block
+        key = funf_decrypt.key_from_password(b'changeme')
+        encrypted = DES.new(key, DES.MODE_ECB).encrypt(image)
+        upload = SimpleUploadedFile('funf.db', encrypted)
+        r = self.client.post('/funf/post1/%s'%self.device.device_id,
+                             dict(uploadedfile=upload))
+        assert r.status_code == 200
+        row = models.Data.objects.get(device_id=self.device.device_id)
+        # Stored in the b'...' form, as all post()ed bytes are.
+        assert json.loads(ast.literal_eval(row.data))['data'] == [[1, 'probe', 'x']]
+        assert funf_decrypt.key_from_password.cache_info().hits >= 1
+
+    def test_purplerobot_post(self):
+        import hashlib, json
+        from django.core.management import call_command
+        device_id = self.device.device_id
+        readings = [dict(PROBE='a.BatteryProbe', TIMESTAMP=1, level=50),
+                    dict(PROBE='a.ScreenProbe', TIMESTAMP=2),
+                    dict(PROBE='a.BatteryProbe', TIMESTAMP=3, level=49)]
+        payload = json.dumps(readings)
+        envelope = dict(Operation='SubmitProbes', UserHash='x', Payload=payload,
+                        Checksum=hashlib.md5(('x'+'SubmitProbes'+payload).encode()).hexdigest())
+        r = self.client.post('/post/purple/%s'%device_id, dict(json=json.dumps(envelope)))
+        assert r.status_code == 200 and r.json()['Status'] == 'success'
+        row = models.Data.objects.get(device_id=device_id)
+        assert sorted(row.probes.values_list('probe', 'n_rows')) == [('a.BatteryProbe', 2),
+                                                                     ('a.ScreenProbe', 1)]
+        assert row.probes.get(probe='a.BatteryProbe').ts_max.timestamp() == 3
+        envelope['Checksum'] = 'x'
+        r = self.client.post('/post/purple/%s'%device_id, dict(json=json.dumps(envelope)))
+        assert r.status_code == 400
+        assert models.Data.objects.filter(device_id=device_id).count() == 1
+        # A checksum of the payload as sent (JSON-escaped) is accepted too.
+        payload = json.dumps(readings[:1])
+        raw_payload = json.dumps(payload)[1:-1]
+        envelope.update(Payload=payload, Checksum=hashlib.md5(
+            ('x'+'SubmitProbes'+raw_payload).encode()).hexdigest())
+        r = self.client.post('/post/purple/%s'%device_id, dict(json=json.dumps(envelope)))
+        assert r.status_code == 200
+        assert models.Data.objects.filter(device_id=device_id).count() == 2
+        # Backfill of packets saved without probes.
+        models.Device.objects.filter(device_id=device_id).update(type='PurpleRobot')
+        models.DataProbe.objects.all().delete()
+        call_command('backfill_probes', device_id, verbosity=0)
+        assert row.probes.count() == 2
+
+    def test_select_packets_upload_paths(self):
+        import ast, json, tempfile
+        from kdata import converter, spool, util
+        device_id = self.device.device_id
+        self.device.type = 'PurpleRobot'
+        self.device.save()
+        # Reading the stats does not mark the device as complete.
+        assert not models.DeviceStats.get(device_id).probes_complete
+        screen = 'edu.northwestern.cbits.purple_robot_manager.probes.builtin.ScreenProbe'
+        def payload(ts):
+            return json.dumps([dict(PROBE=screen, TIMESTAMP=ts, SCREEN_ACTIVE=1),
+                               dict(PROBE='a.BatteryProbe', TIMESTAMP=ts)]).encode()
+        def post_batch(data):
+            body = json.dumps(dict(length=len(data))).encode() + b'\n' + data + b'\n'
+            r = self.client.post('/post/batch/%s'%device_id, body,
+                                 content_type='application/octet-stream')
+            assert r.status_code == 200
+        post_batch(payload(1))
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                self.settings(KOOTA_INGEST_SPOOL_DIR=tmpdir):
+            post_batch(payload(2))
+            r = self.client.post('/post/%s'%device_id, payload(3),
+                                 content_type='application/octet-stream')
+            assert r.status_code == 200
+            assert spool.drain() == 2
+        models.Data.objects.create(device_id=device_id, ip='127.0.0.1', data='[]')
+        device = models.Device.objects.get(device_id=device_id)
+        assert device.stats.probes_complete
+        queryset = converter.PRScreen.select_packets(
+            models.Data.objects.filter(device_id=device_id).order_by('ts'), device)
+        # Posted bytes are stored as their repr.
+        rows = ((ts, ast.literal_eval(data).decode())
+                for ts, data in util.keyset_queryset_iterator(queryset))
+        assert list(converter.PRScreen(rows).run()) == [(1, 1), (2, 1), (3, 1)]
+
+    def test_post_batch(self):
+        import json
+        from hashlib import sha256
+        def frame(data, **header):
+            header['length'] = len(data)
+            return json.dumps(header).encode() + b'\n' + data + b'\n'
+        device_id = self.device.device_id
+        body = (frame(b'one', data_ts=1400000000, sha256=sha256(b'one').hexdigest(), id=1)
+                + frame(b'two', sha256='0'*64, id=2)
+                + frame(b'\x00three\n', id=3))
+        r = self.client.post('/post/batch/%s'%device_id, body,
+                             content_type='application/octet-stream')
+        assert r.status_code == 200
+        items = r.json()['items']
+        assert [ i['ok'] for i in items ] == [True, False, True]
+        assert items[1]['error'] == 'Checksum mismatch' and items[2]['id'] == 3
+        rows = models.Data.objects.filter(device_id=device_id).order_by('ts')
+        assert len(rows) == 2 and rows[0].ts.timestamp() == 1400000000
+        r = self.client.post('/post/batch/%s'%device_id, body[:-2],
+                             content_type='application/octet-stream')
+        assert r.status_code == 400
+        r = self.client.post('/post/batch/?device_id=not-hex', body,
+                             content_type='application/octet-stream')
+        assert r.status_code == 400 and r.json()['error'] == 'Invalid device_id'
+        # Device code scrubs the raw data, as in post().
+        from kdata import devices
+        device = models.Device(user=self.user, name='test-actiwatch',
+                               type='kdata.devices.Actiwatch')
+        devices.get_class(device.type).create_hook(device, user=self.user)
+        device.save()
+        data = b'"Full.Name","John Smith"\n'
+        r = self.client.post('/post/batch/%s'%device.device_id, frame(data),
+                             content_type='application/octet-stream')
+        assert r.status_code == 200 and r.json()['n_saved'] == 1
+        assert models.Data.objects.get(device_id=device.device_id).data \
+            == str(b'"Full.Name","xxxxx"\n')
+
+    def test_ingest_app(self):
+        from koota_prj import settings_ingest
+        from kdata.devices import base
+        device_id = self.device.device_id
+        with self.settings(ROOT_URLCONF=settings_ingest.ROOT_URLCONF,
+                           MIDDLEWARE=settings_ingest.MIDDLEWARE):
+            r = self.client.post('/post/%s'%device_id, dict(data='ingest'))
+            assert r.status_code == 200
+            assert self.client.get('/devices/').status_code == 404
+            r = self.client.post('/aware/v1/%s/battery/insert'%('0'*14), dict(data='[]'))
+            assert r.status_code == 480
+        assert models.Data.objects.filter(device_id=device_id).count() == 1
+        from kdata import hooks
+        for name, modname in base.lazy_device_modules.items():
+            cls = base.get_class(name)
+            assert cls.__module__ == modname
+            features = set()
+            if hooks.inline_hooks(cls):
+                features.add('inline_hooks')
+            if hooks.async_hooks(cls):
+                features.add('async_hooks')
+            if getattr(cls, 'probe_meta', None) is not None:
+                features.add('probe_meta')
+            assert features == base.lazy_ingest_features.get(name, set()), name
+
+    def test_async_views(self):
+        import json
+        from unittest import mock
+        from asgiref.sync import async_to_sync, sync_to_async
+        from django.test import AsyncRequestFactory
+        from kdata import util, views
+        from kdata.devices import aware
+        # The test transaction is only visible to this thread's connection.
+        patcher = mock.patch.object(util, 'db_sync_to_async', sync_to_async)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        def request(*args, **kwargs):
+            request = AsyncRequestFactory().post(*args, **kwargs)
+            request.body  # received before the view, like the ASGI handler does
+            return request
+        device_id = self.device.device_id
+        r = async_to_sync(views.apost)(
+            request('/post/', b'async data', content_type='application/octet-stream'),
+            device_id=device_id)
+        assert r.status_code == 200 and json.loads(r.content)['bytes'] == 10
+        rows = [dict(timestamp=1500000000000+i) for i in range(10)]
+        r = async_to_sync(aware.ainsert)(request('/', dict(data=json.dumps(rows), nonce='n')),
+                                         secret_id=self.device.secret_id, table='battery')
+        assert json.loads(r.content)[0]['nonce'] == 'n'
+        assert models.Data.objects.filter(device_id=device_id).count() == 2
@@ -7,46 +7,14 @@ from kdata import survey
 from kdata import views as kviews
 from kdata import views_admin
 from kdata import views_data
-from kdata.devices import aware
 from kdata.devices import facebook
 from kdata.devices import funf
 from kdata.devices import instagram
 from kdata.devices import twitter
-from kdata.devices.muratabsn import MurataBSN, murata_calibrate
-from kdata.devices.purplerobot import PurpleRobot
-from kdata.devices.actiwatch import Actiwatch
 
-# These URLs relate to receiving data, and should be usable by the
-# write-only domain (not quite there yet, but...)
-# pylint: disable=invalid-name
-urls_data = [
-    # Purple Robot - different API
-    url(r'^post/purple/?(?P<device_id>\w+)?/?$', kviews.post,
-        dict(device_class=PurpleRobot), name='post-purple'),
-    # Actigraphs - process and remove data
-    url(r'^post/actiwatch/?(?P<device_id>\w+)?/?$', kviews.post,
-        dict(device_class=Actiwatch), name='post-actiwatch'),
-    # Generic POST url.
-    url(r'^post/?(?P<device_id>[A-Fa-f0-9]+)?/?$', kviews.post, name='post'),
-    # Murata sleep sensor: this has a hard-coded POST URL.
-    url(r'^data/push/$', kviews.post, dict(device_class=MurataBSN),
-        name='post-MurataBSN'),
-    # Murata sleep sensor, calibration
-    url(r'^firmware/device/(?P<mac_addr>[^/]+)/?$', murata_calibrate,
-        name='MurataBSN-calibrate'),
-    # Generic config, for our own app (not really used now)
-    url(r'^config$', kviews.config, name='config'),
-    # Funf
-    url(r'^funf/post1/(?P<device_id>[A-Fa-f0-9]+)?/?$', kviews.post,
-        dict(device_class=funf.FunfJournal),
-        name='funf-journal-post'),
-    # AWARE
-    # Note: these do require write-connection
-    url(r'^(?:(?P<indexphp>index\.php)/)?aware/', include(aware.urlpatterns)),
-    url(r'^(?P<indexphp>index\.php)/', include(aware.urlpatterns_fixed)),
-
-    ]
+from kdata.urls_data import urls_data
 
+# pylint: disable=invalid-name
 urls_device = [
     url(r'^$', kviews.DeviceListView.as_view(), name='device-list'),
     # /public_id/config
@@ -0,0 +1,53 @@
+"""URLs for receiving data.
+
+These are mounted by kdata.urls, and also alone by the ingest-only
+application (koota_prj/urls_ingest.py), so this module should import
+only what the data-receiving views need.
+"""
+
+from django.conf import settings
+from django.conf.urls import url, include
+
+from kdata import views as kviews
+from kdata.devices import aware
+from kdata.devices import funf
+from kdata.devices.muratabsn import MurataBSN, murata_calibrate
+from kdata.devices.purplerobot import PurpleRobot
+from kdata.devices.actiwatch import Actiwatch
+
+# In ASGI deployments, the async versions of the views.
+# pylint: disable=invalid-name
+post_view = kviews.apost if getattr(settings, 'KOOTA_ASYNC_INGEST', False) else kviews.post
+
+# These URLs relate to receiving data, and should be usable by the
+# write-only domain (not quite there yet, but...)
+urls_data = [
+    # Purple Robot - different API
+    url(r'^post/purple/?(?P<device_id>\w+)?/?$', post_view,
+        dict(device_class=PurpleRobot), name='post-purple'),
+    # Actigraphs - process and remove data
+    url(r'^post/actiwatch/?(?P<device_id>\w+)?/?$', post_view,
+        dict(device_class=Actiwatch), name='post-actiwatch'),
+    # Many packets in one request.
+    url(r'^post/batch/?(?P<device_id>[A-Fa-f0-9]+)?/?$', kviews.post_batch,
+        name='post-batch'),
+    # Generic POST url.
+    url(r'^post/?(?P<device_id>[A-Fa-f0-9]+)?/?$', post_view, name='post'),
+    # Murata sleep sensor: this has a hard-coded POST URL.
+    url(r'^data/push/$', post_view, dict(device_class=MurataBSN),
+        name='post-MurataBSN'),
+    # Murata sleep sensor, calibration
+    url(r'^firmware/device/(?P<mac_addr>[^/]+)/?$', murata_calibrate,
+        name='MurataBSN-calibrate'),
+    # Generic config, for our own app (not really used now)
+    url(r'^config$', kviews.config, name='config'),
+    # Funf
+    url(r'^funf/post1/(?P<device_id>[A-Fa-f0-9]+)?/?$', post_view,
+        dict(device_class=funf.FunfJournal),
+        name='funf-journal-post'),
+    # AWARE
+    # Note: these do require write-connection
+    url(r'^(?:(?P<indexphp>index\.php)/)?aware/', include(aware.urlpatterns)),
+    url(r'^(?P<indexphp>index\.php)/', include(aware.urlpatterns_fixed)),
+
+    ]
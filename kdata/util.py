@@ -1,11 +1,15 @@
+import asyncio
 from base64 import urlsafe_b64encode
 from calendar import timegm
+import codecs
 import collections
 import csv
 import datetime
 from datetime import timedelta
+import functools
 from hashlib import sha256
 import importlib
+import io
 import itertools
 import json
 from json import dumps, loads
@@ -14,11 +18,13 @@ import os
 import random
 import re
 import time
+import zlib
 
 import six
 from six import StringIO as IO
 import yaml
 
+from asgiref.sync import sync_to_async
 from django.utils import timezone
 import django.db.models
 import django.forms
@@ -227,10 +233,12 @@ def optimized_queryset_iterator_1(queryset):
     data, so has to do it for every row.  This is inefficient.
 
     """
-    return queryset.defer('data').iterator()
+    return queryset.defer('data', 'data_z').iterator()
 def optimized_queryset_iterator(queryset):
     """Queryset wrapper that optimizes lots of data access.
 
+    Superseded by keyset_queryset_iterator, which needs fewer queries.
+
     Reading django queries is a balance.  If we do nothing, django
     reads in all data at once, using all memory.  If we
     .defer('data').iterator(), it will make a new DB query for every
@@ -283,6 +291,75 @@ def optimized_queryset_iterator(queryset):
         ts = ts_next
 
 
+def keyset_queryset_iterator(queryset, byte_budget=None, server_side=None,
+                             first_batch=50, max_batch=10000):
+    """Iterate (ts, data) of the models.Data rows of a queryset.
+
+    Replacement of optimized_queryset_iterator: instead of hourly
+    windows and OFFSET slices, this reads pages of rows after the last
+    (ts, id) seen, which the (device_id, ts) index finds directly, so
+    each page costs the same however dense or sparse the data is.
+    Only the needed columns are read, as tuples, not model instances.
+
+    The queryset must not be sliced.  Rows come in ts order, or
+    reverse ts order if the queryset is ordered by '-ts' (or
+    reversed), with id breaking ties.
+
+    byte_budget: the pages are sized so that one page of payloads is
+    about this many bytes, from the sizes of the previous page
+    (default settings.KOOTA_DATA_ITER_BYTES).  The first page has
+    first_batch rows.
+
+    server_side: after the first page, read the rest with one
+    server-side cursor, fetching byte_budget worth of rows at a time
+    (PostgreSQL only, default settings.KOOTA_DATA_ITER_SERVER_SIDE).
+    This needs no new query per page, but holds a cursor open on the
+    database while the caller consumes the rows, and does not work
+    behind pgbouncer in transaction pooling mode.
+    """
+    if byte_budget is None:
+        byte_budget = getattr(settings, 'KOOTA_DATA_ITER_BYTES', 10*2**20)
+    if server_side is None:
+        server_side = getattr(settings, 'KOOTA_DATA_ITER_SERVER_SIDE', False)
+    server_side = (server_side and
+                   django.db.connections[queryset.db].vendor == 'postgresql')
+    order = queryset.query.order_by
+    keys = ('-ts', '-id') if order and order[0] == '-ts' else ('ts', 'id')
+    descending = (keys[0] == '-ts') == queryset.query.standard_ordering
+    # Explicit order, and reverse() to undo an earlier reverse().
+    queryset = queryset.order_by(*(('-ts', '-id') if descending else ('ts', 'id')))
+    if not queryset.query.standard_ordering:
+        queryset = queryset.reverse()
+    queryset = queryset.values_list('ts', 'id', 'data', 'data_z', 'codec', 'data_length')
+    Q = django.db.models.Q
+    decode = models.Data.decode
+    batch_size = first_batch
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            ts, id_ = last
+            if descending:
+                page = page.filter(Q(ts__lt=ts) | Q(ts=ts, id__lt=id_))
+            else:
+                page = page.filter(Q(ts__gt=ts) | Q(ts=ts, id__gt=id_))
+            if server_side:
+                for ts, _, data, data_z, codec, _ in page.iterator(chunk_size=batch_size):
+                    yield ts, decode(data, data_z, codec)
+                return
+        rows = list(page[:batch_size])
+        n_bytes = 0
+        for ts, _, data, data_z, codec, length in rows:
+            data = decode(data, data_z, codec)
+            n_bytes += length if length is not None else len(data)
+            yield ts, data
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][:2]
+        batch_size = max(1, min(max_batch, int(byte_budget * len(rows) / max(n_bytes, 1))))
+        del rows
+
+
 def time_slice_iterator(it, maxduration):
     """Time iterator ending after a certain number of seconds.
 
@@ -300,6 +377,320 @@ def time_slice_iterator(it, maxduration):
 
 
 
+# Fast parsing of urlencoded POST bodies.  Django's request.POST
+# unquotes using urllib's unquote_to_bytes, which handles one byte
+# at a time in Python and dominates the time of large uploads (AWARE
+# sends its JSON as one big percent-encoded field).
+_HEXTOBYTE = {(a+b).encode(): bytes((int(a+b, 16), ))
+              for a in '0123456789ABCDEFabcdef'
+              for b in '0123456789ABCDEFabcdef'}
+def unquote_plus_bytes(value):
+    """Un-urlquote bytes, including '+' to space.  Returns bytes.
+
+    Gives the same result as urllib.parse.unquote_to_bytes (after
+    replacing '+').  The fast path turns every %XX into a \\xXX
+    escape and lets the C-level escape decoder do the work.  If there
+    is a malformed %-escape, that fails and we fall back to splitting
+    on '%' and using a precomputed hex table, leaving invalid escapes
+    as-is like urllib does.
+    """
+    value = value.replace(b'+', b' ')
+    if b'%' not in value:
+        return value
+    try:
+        return codecs.escape_decode(
+            value.replace(b'\\', b'\\\\').replace(b'%', b'\\x'))[0]
+    except ValueError:
+        pass
+    parts = value.split(b'%')
+    res = [parts[0]]
+    for part in parts[1:]:
+        try:
+            res.append(_HEXTOBYTE[part[:2]])
+            res.append(part[2:])
+        except KeyError:
+            res.append(b'%')
+            res.append(part)
+    return b''.join(res)
+
+def parse_urlencoded(body, encoding='utf-8'):
+    """Parse an application/x-www-form-urlencoded body to a dict.
+
+    This is a replacement for request.POST for large uploads: it
+    doesn't build a QueryDict and unquotes using
+    unquote_plus_bytes().  If a field is repeated, the last value
+    wins.  Values are decoded using encoding, or returned as bytes if
+    encoding is None.  Keys are always str.
+    """
+    if isinstance(body, str):
+        body = body.encode('ascii')
+    result = { }
+    for name_value in body.split(b'&'):
+        if not name_value:
+            continue
+        name, _, value = name_value.partition(b'=')
+        name = unquote_plus_bytes(name).decode('utf-8', 'replace')
+        value = unquote_plus_bytes(value)
+        if encoding is not None:
+            value = value.decode(encoding, 'replace')
+        result[name] = value
+    return result
+
+
+
+# Compressed request bodies (Content-Encoding: gzip or deflate).
+def decompress_request_body(request, max_size=None, chunk_size=65536):
+    """Transparently decompress a gzip/deflate encoded request body.
+
+    The body is read in chunks and decompressed incrementally, never
+    producing more than max_size bytes of output (default:
+    max_upload_size()), to protect against decompression bombs.
+    Afterwards request.body, request.POST and request.read() all give
+    the decompressed data, so checksums are computed on the
+    decompressed payload.
+
+    Returns True if the body was decompressed, False if it was not
+    compressed.  Raises ValueError for invalid compressed data and
+    django's RequestDataTooBig if max_size would be exceeded.
+    """
+    from django.core.exceptions import RequestDataTooBig
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        return False
+    if max_size is None:
+        max_size = max_upload_size()
+    # Same check on the compressed size that request.body would do.
+    if int(request.META.get('CONTENT_LENGTH') or 0) > max_size:
+        raise RequestDataTooBig("Compressed request body is larger than %d bytes"%max_size)
+    decompressor = None
+    out = [ ]
+    size = 0
+    try:
+        while True:
+            chunk = request.read(chunk_size)
+            if not chunk:
+                break
+            if decompressor is None:
+                if encoding == 'deflate' and not _is_zlib_header(chunk):
+                    # Some clients send raw deflate instead of zlib format.
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                elif encoding == 'deflate':
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+                else:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # Asking for at most one byte more than allowed means that
+            # if we get that much, the body is too large.
+            data = decompressor.decompress(chunk, max_size - size + 1)
+            size += len(data)
+            if size > max_size:
+                raise RequestDataTooBig("Decompressed request body is larger than %d bytes"%max_size)
+            out.append(data)
+        if decompressor is not None:
+            data = decompressor.flush()
+            size += len(data)
+            if size > max_size:
+                raise RequestDataTooBig("Decompressed request body is larger than %d bytes"%max_size)
+            out.append(data)
+            if not decompressor.eof:
+                raise ValueError("Truncated %s request body"%encoding)
+    except zlib.error as e:
+        raise ValueError("Invalid %s request body: %s"%(encoding, e))
+    body = b''.join(out)
+    del out
+    # Make the request look like it came uncompressed.
+    request._body = body
+    request._stream = io.BytesIO(body)
+    request.META['CONTENT_LENGTH'] = str(len(body))
+    del request.META['HTTP_CONTENT_ENCODING']
+    for attr in ('_post', '_files'):
+        if hasattr(request, attr):
+            delattr(request, attr)
+    return True
+
+def _is_zlib_header(data):
+    return (len(data) >= 2 and data[0] & 0x0f == 8
+            and (data[0]*256 + data[1]) % 31 == 0)
+
+def accept_compressed_body(view):
+    """View decorator: accept gzip/deflate request bodies.
+
+    See decompress_request_body.  Invalid bodies get a 400 and too
+    large ones a 413 JSON response.  The size limit is
+    max_upload_size() of the view's device_class argument, if the
+    route gives one.
+
+    Works for async views too: the decompression then runs in a
+    worker thread.
+    """
+    from django.core.exceptions import RequestDataTooBig
+    from django.http import JsonResponse
+    def decompress(request, device_class):
+        """None if ok, else the error response."""
+        try:
+            decompress_request_body(request, max_size=max_upload_size(device_class))
+        except RequestDataTooBig as e:
+            logger.warning("Compressed request body too large: %s", e)
+            return JsonResponse(dict(ok=False, error="Request body too large"),
+                                status=413, reason="Request body too large")
+        except ValueError as e:
+            logger.warning("%s", e)
+            return JsonResponse(dict(ok=False, error="Invalid compressed body"),
+                                status=400, reason="Invalid compressed body")
+        return None
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            error = await sync_to_async(decompress, thread_sensitive=False)(
+                request, kwargs.get('device_class'))
+            if error is not None:
+                return error
+            return await view(request, *args, **kwargs)
+        return async_wrapper
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        error = decompress(request, kwargs.get('device_class'))
+        if error is not None:
+            return error
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def db_sync_to_async(func):
+    """sync_to_async() for functions which use the database.
+
+    Unlike the default (thread_sensitive=True), which runs all sync
+    code of the process in one thread, func runs in a thread pool, so
+    several requests can wait for the database at once.  Each pool
+    thread keeps its own connection.  As request_started and
+    request_finished do for sync views, unusable or too old
+    connections of the thread are closed before and after the call.
+    """
+    from django.db import close_old_connections
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+
+def read_hashed(chunks, max_size=None):
+    """Join an iterable of bytes chunks, computing sha256 as we go.
+
+    This is used to read uploads (request.read() chunks, or
+    UploadedFile.chunks()) without first making a copy of the whole
+    body: the only full-size buffer is the returned bytes.  Raises
+    django's RequestDataTooBig as soon as more than max_size bytes
+    have been read.
+
+    Returns (data, sha256 hexdigest).
+    """
+    from django.core.exceptions import RequestDataTooBig
+    hasher = sha256()
+    out = [ ]
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise RequestDataTooBig("Upload is larger than %d bytes"%max_size)
+        hasher.update(chunk)
+        out.append(chunk)
+    return b''.join(out), hasher.hexdigest()
+
+def request_chunks(request, chunk_size=65536):
+    """Iterate over the request body in chunks of chunk_size."""
+    return iter(functools.partial(request.read, chunk_size), b'')
+
+def max_upload_size(device_class=None):
+    """Largest upload (bytes) accepted for a device class.
+
+    Device classes can set .max_upload_size, otherwise
+    settings.KOOTA_MAX_UPLOAD_SIZE (default: the same as
+    DATA_UPLOAD_MAX_MEMORY_SIZE) applies.
+    """
+    size = getattr(device_class, 'max_upload_size', None)
+    if size is None:
+        size = getattr(settings, 'KOOTA_MAX_UPLOAD_SIZE',
+                       settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+    return size
+
+
+def split_lines(data, max_size):
+    """Split a packet at line boundaries into pieces of at most max_size.
+
+    For CSV and other line-based formats.  Single lines longer than
+    max_size are kept whole.  Returns a list of str or bytes, the same
+    type as data.
+    """
+    lines = data.splitlines(True)
+    pieces = [ ]
+    piece = [ ]
+    size = 0
+    for line in lines:
+        if piece and size + len(line) > max_size:
+            pieces.append(data[:0].join(piece))
+            piece = [ ]
+            size = 0
+        piece.append(line)
+        size += len(line)
+    if piece:
+        pieces.append(data[:0].join(piece))
+    return pieces
+
+def split_json_array(data, max_size):
+    """Split a packet which is a JSON array into smaller JSON arrays.
+
+    Each piece is a JSON array of whole records, at most max_size long
+    unless a single record is longer.  Data which is not a JSON array
+    is returned as one piece.  Returns a list of str or bytes, the
+    same type as data.
+    """
+    try:
+        records = loads(data)
+    except ValueError:
+        return [data]
+    if not isinstance(records, list):
+        return [data]
+    pieces = [ ]
+    piece = [ ]
+    size = 2
+    for record in records:
+        record = dumps(record)
+        if piece and size + len(record) + 2 > max_size:
+            pieces.append('[' + ', '.join(piece) + ']')
+            piece = [ ]
+            size = 2
+        piece.append(record)
+        size += len(record) + 2
+    if piece or not pieces:
+        pieces.append('[' + ', '.join(piece) + ']')
+    if isinstance(data, bytes):
+        pieces = [ p.encode('utf8') for p in pieces ]
+    return pieces
+
+# Names which device classes can use as .packet_splitter
+PACKET_SPLITTERS = {
+    'lines': split_lines,
+    'json': split_json_array,
+    }
+
+def split_packet(data, device_class):
+    """Split data by the device class's max_packet_size and packet_splitter.
+
+    Returns a list of pieces, which is [data] if no split is needed.
+    """
+    max_size = getattr(device_class, 'max_packet_size', None)
+    if max_size is None or len(data) <= max_size:
+        return [data]
+    splitter = device_class.packet_splitter
+    if not callable(splitter):
+        splitter = PACKET_SPLITTERS[splitter]
+    return splitter(data, max_size)
+
+
+
 # For Mosquitto server passwords
 from django.contrib.auth.hashers import PBKDF2PasswordHasher
 import base64
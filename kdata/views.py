@@ -5,8 +5,10 @@ import operator
 import six
 import sys
 
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, RequestDataTooBig
+from django.db import transaction
 from django.urls import reverse
 from django.utils import timezone
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404
@@ -15,12 +17,16 @@ from django.views.decorators.http import require_http_methods
 from django.views.generic import CreateView, DetailView, FormView, ListView
 from django.views.generic import TemplateView, UpdateView
 
+from . import cache
 from . import devices
 from . import exceptions
 from . import group
+from . import hooks
+from . import ingest
 from . import logs
 from . import models
 from . import permissions
+from . import spool
 from . import tokens
 from . import util
 
@@ -31,9 +37,56 @@ logger = logging.getLogger(__name__)
 
 # Create your views here.
 
+# Content types for which the payload is the 'data' field of request.POST
+_FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
 @csrf_exempt
+@util.accept_compressed_body
 def post(request, device_id=None, device_class=None):
     #import IPython ; IPython.embed()
+    upload = _post_device(request, device_id, device_class)
+    if isinstance(upload, HttpResponse):
+        return upload
+    # Reject devices which don't exist, if the device filter is on.
+    if not cache.known_device_id(upload['device_id']):
+        return _unknown_device_response(upload['device_id'])
+    upload = _post_data(request, upload)
+    if isinstance(upload, HttpResponse):
+        return upload
+    return _post_save(request, upload)
+
+@util.accept_compressed_body
+async def apost(request, device_id=None, device_class=None):
+    """post() as an async view, for ASGI deployments.
+
+    Under ASGI, the server receives the body before the view is
+    called, without using a worker thread, so slow clients cost
+    nothing until their upload is complete.  Then the parsing runs in
+    a worker thread, and only the final saving (_post_save) uses the
+    database.  Used if settings.KOOTA_ASYNC_INGEST is true, see
+    koota_prj/asgi_ingest.py.
+    """
+    if device_class is not None and hasattr(device_class, 'post'):
+        # Custom device code parses the body.
+        upload = await sync_to_async(_post_device, thread_sensitive=False)(
+            request, device_id, device_class)
+    else:
+        upload = _post_device(request, device_id, device_class)
+    if isinstance(upload, HttpResponse):
+        return upload
+    if not await cache.aknown_device_id(upload['device_id']):
+        return _unknown_device_response(upload['device_id'])
+    upload = await sync_to_async(_post_data, thread_sensitive=False)(request, upload)
+    if isinstance(upload, HttpResponse):
+        return upload
+    return await util.db_sync_to_async(_post_save)(request, upload)
+apost.csrf_exempt = True
+
+def _post_device(request, device_id, device_class):
+    """First part of post(): find the device_id.
+
+    Returns the upload state dict for _post_data, or an error response.
+    """
     if request.method != "POST":
         return JsonResponse(dict(ok=False, message="invalid HTTP method (must POST)"),
                             status=405)
@@ -41,6 +94,9 @@ def post(request, device_id=None, device_class=None):
     results = { }
     if device_class is not None and hasattr(device_class, 'post'):
         results = device_class.post(request)
+        # The device code rejected the upload.
+        if isinstance(results, HttpResponse):
+            return results
 
     # Find device_id.  Try different things until found.
     if device_id is not None:
@@ -74,18 +130,41 @@ def post(request, device_id=None, device_class=None):
         return JsonResponse(dict(ok=False, error='Invalid device_id checkdigits',
                                  device_id=device_id),
                             status=400, reason="Invalid device_id checkdigits")
+    return dict(device_id=device_id, device_class=device_class, results=results)
+
+def _unknown_device_response(device_id):
+    return JsonResponse(dict(ok=False, error='Unknown device_id',
+                             device_id=device_id),
+                        status=404, reason="Unknown device_id")
+
+def _post_data(request, upload):
+    """Second part of post(): read and check the data.  No database use.
 
-    # Find the data to store
+    Returns the upload dict with data, data_sha256 and nonce added, or
+    an error response.
+    """
+    device_id = upload['device_id']
+    device_class = upload['device_class']
+    results = upload['results']
+    # Find the data to store.  A raw body is read in chunks and
+    # hashed as it comes, so that large uploads are never copied
+    # whole in memory before being saved.
+    data_sha256 = None
     if 'data' in results:  # results from custom device code
         data = results['data']
-    elif 'data' in request.POST:
+    elif request.content_type in _FORM_CONTENT_TYPES and 'data' in request.POST:
         data = request.POST['data']
     else:
-        data = request.body
+        try:
+            data, data_sha256 = util.read_hashed(util.request_chunks(request),
+                                                 max_size=util.max_upload_size(device_class))
+        except RequestDataTooBig as e:
+            logger.warning("Upload too large from device_id=%r: %s", device_id, e)
+            return JsonResponse(dict(ok=False, error="Upload too large"),
+                                status=413, reason="Upload too large")
     # Encode everything to utf8.  the body is bytes, but request.POST
     # is decoded.  We need to encode in order to checksum and compute
-    # len() properly.  TODO: make more efficient by not first decoding
-    # the POST data.
+    # len() properly.
     if not isinstance(data, six.binary_type):
         data = data.encode('utf8')
 
@@ -98,7 +177,8 @@ def post(request, device_id=None, device_class=None):
     elif 'nonce' in request.POST:        nonce = request.POST['nonce']
 
     # Check checksum if provided
-    data_sha256 = sha256(data).hexdigest()
+    if data_sha256 is None:
+        data_sha256 = sha256(data).hexdigest()
     if 'HTTP_X_SHA256' in request.META:
         if data_sha256 != request.META['HTTP_X_SHA256'].lower():
             return JsonResponse(dict(ok=False, error="Checksum mismatch"),
@@ -109,10 +189,47 @@ def post(request, device_id=None, device_class=None):
         # hack: this is an instance method.  Eventually define
         # semantics: should this be a class method?
         data = device_class.process_upload(None, data)
+    upload.update(data=data, data_sha256=data_sha256, nonce=nonce)
+    return upload
+
+def _post_save(request, upload):
+    """Last part of post(): hooks, saving and the response."""
+    device_id = upload['device_id']
+    device_class = upload['device_class']
+    results = upload['results']
+    data = upload['data']
+    data_sha256 = upload['data_sha256']
+    # Inline post-ingest hooks (see kdata/hooks.py).
+    if hooks.any_hooks(inline=True):
+        if device_class is None:
+            device_class = ingest.lookup_device_class(device_id)
+        try:
+            data = hooks.run_inline(device_class, data, device_id=device_id,
+                                    request=request)
+        except hooks.Rejected as e:
+            logger.warning("Upload from device_id=%r rejected: %s", device_id, e.message)
+            return JsonResponse(dict(ok=False, error=e.message),
+                                status=400, reason="Rejected")
+
+    # If this is a re-upload of a packet we already have, don't save
+    # it again but reply as if we had.
+    duplicate_rowid = _duplicate_rowid(device_id, data_sha256)
 
     # Store data in DB.  (Uses django models for now, but should
-    # be made more efficient later).
-    rowid = save_data(data=data, device_id=device_id, request=request)
+    # be made more efficient later).  In spool mode, the data is
+    # only durably queued and there is no rowid yet.
+    if duplicate_rowid is not None:
+        rowid = duplicate_rowid
+        logger.debug("Duplicate data from device_id=%r"%device_id)
+    elif spool.enabled():
+        spool.append([data], device_id=device_id, request=request,
+                     data_sha256s=[data_sha256],
+                     probes=[results['probes']] if 'probes' in results else None)
+        rowid = None
+    else:
+        rowid = save_data(data=data, device_id=device_id, request=request,
+                          data_sha256=data_sha256, device_class=device_class,
+                          probes=results.get('probes'))
     logger.debug("Saved data from device_id=%r"%device_id)
 
     # HTTP response
@@ -123,14 +240,174 @@ def post(request, device_id=None, device_class=None):
                     bytes=len(data),
                     #rowid=rowid,
                     )
-    if nonce is not None:
-        response['nonce'] = nonce
-    if 'HTTP_X_ROWID' in request.META:
+    if upload['nonce'] is not None:
+        response['nonce'] = upload['nonce']
+    if 'HTTP_X_ROWID' in request.META or duplicate_rowid is not None:
         response['rowid'] = rowid
+    if duplicate_rowid is not None:
+        response['duplicate'] = True
     return JsonResponse(response)
 
+def _duplicate_rowid(device_id, data_sha256):
+    """Row id of an earlier identical packet, if this device dedupes uploads.
+
+    Deduplication is enabled by settings.KOOTA_DEDUPE_UPLOADS and then
+    per device with the 'dedupe_uploads' device attribute.  It is not
+    done in spool mode, since it needs the database.
+    """
+    return _duplicate_rowids(device_id, [data_sha256]).get(data_sha256)
+
+def _duplicate_rowids(device_id, data_sha256s):
+    """Like _duplicate_rowid, {data_sha256: rowid} for many hashes at once."""
+    if not getattr(settings, 'KOOTA_DEDUPE_UPLOADS', False) or spool.enabled():
+        return { }
+    try:
+        device = models.Device.get_by_secret_id(device_id)
+    except exceptions.InvalidDeviceID:
+        return { }
+    if device.attrs.get('dedupe_uploads', '').lower() not in ('1', 'true', 'yes'):
+        return { }
+    # Ordered so that the first row wins.
+    return dict(models.Data.objects.filter(device_id=device_id, data_sha256__in=data_sha256s)
+                      .order_by('-id').values_list('data_sha256', 'id'))
+
+@csrf_exempt
+@util.accept_compressed_body
+def post_batch(request, device_id=None):
+    """Receive many packets from one device in one request.
+
+    The body is a sequence of frames, each one line of JSON header,
+    then exactly header["length"] bytes of packet, then a newline.
+    This is the same framing as the ingest spool.  Optional header
+    fields:
+
+    data_ts:  unix time the packet refers to (default: now)
+    sha256:   hexdigest of the packet, checked
+    id:       anything, echoed back in the item's status
+
+    All valid packets are saved with one bulk INSERT.  The response
+    has one status dict per frame, in order, in "items".  Invalid
+    frames don't prevent the valid ones from being saved.  A body
+    which can't be split into frames is rejected as a whole (400).
+    """
+    if request.method != "POST":
+        return JsonResponse(dict(ok=False, message="invalid HTTP method (must POST)"),
+                            status=405)
+    if device_id is None:
+        device_id = request.META.get('HTTP_DEVICE_ID', request.GET.get('device_id'))
+    if device_id is None:
+        return JsonResponse(dict(ok=False, error="No device_id provided"),
+                            status=400, reason="No device_id provided")
+    try:
+        int(device_id, 16)
+    except ValueError:
+        logger.warning("Invalid device_id: %r"%device_id)
+        return JsonResponse(dict(ok=False, error="Invalid device_id",
+                                 device_id=device_id),
+                            status=400, reason="Invalid device_id")
+    device_id = device_id.lower()
+    if not util.check_checkdigits(device_id):
+        logger.warning("Invalid device_id checkdigits: %r"%device_id)
+        return JsonResponse(dict(ok=False, error='Invalid device_id checkdigits',
+                                 device_id=device_id),
+                            status=400, reason="Invalid device_id checkdigits")
+    if not cache.known_device_id(device_id):
+        return JsonResponse(dict(ok=False, error='Unknown device_id',
+                                 device_id=device_id),
+                            status=404, reason="Unknown device_id")
+    # The class is needed for process_upload and inline hooks (like
+    # privacy scrubbing of the raw data), async hooks and probes.
+    device_class = ingest.lookup_device_class(device_id)
+    try:
+        body, _ = util.read_hashed(util.request_chunks(request),
+                                   max_size=util.max_upload_size(device_class))
+    except RequestDataTooBig as e:
+        logger.warning("Batch too large from device_id=%r: %s", device_id, e)
+        return JsonResponse(dict(ok=False, error="Upload too large"),
+                            status=413, reason="Upload too large")
+    try:
+        frames = _parse_frames(body)
+    except ValueError as e:
+        return JsonResponse(dict(ok=False, error="Invalid batch: %s"%e),
+                            status=400, reason="Invalid batch")
+    del body
+
+    items = [ ]
+    valid = [ ]     # (item, data, data_ts, data_sha256)
+    for header, data in frames:
+        item = dict(ok=False)
+        if 'id' in header:
+            item['id'] = header['id']
+        items.append(item)
+        data_sha256 = sha256(data).hexdigest()
+        if 'sha256' in header and str(header['sha256']).lower() != data_sha256:
+            item['error'] = "Checksum mismatch"
+            continue
+        data_ts = header.get('data_ts')
+        if data_ts is not None and not isinstance(data_ts, (int, float)):
+            item['error'] = "Invalid data_ts"
+            continue
+        # Like post(): the checksum is of the data as sent.
+        if device_class is not None and hasattr(device_class, 'process_upload'):
+            data = device_class.process_upload(None, data)
+        try:
+            data = hooks.run_inline(device_class, data, device_id=device_id,
+                                    request=request)
+        except hooks.Rejected as e:
+            item['error'] = e.message
+            continue
+        item.update(ok=True, data_sha256=data_sha256, bytes=len(data))
+        valid.append((item, data, data_ts, data_sha256))
+
+    duplicates = _duplicate_rowids(device_id, [ v[3] for v in valid ])
+    for item, _, _, data_sha256 in valid:
+        if data_sha256 in duplicates:
+            item.update(duplicate=True, rowid=duplicates[data_sha256])
+    new = [ v for v in valid if v[3] not in duplicates ]
+    if new and spool.enabled():
+        spool.append([ v[1] for v in new ], device_id=device_id, request=request,
+                     data_sha256s=[ v[3] for v in new ],
+                     data_ts=[ v[2] for v in new ],
+                     probes=[ ingest.packet_probes(device_class, v[1]) for v in new ])
+    elif new:
+        rowids = save_data_batch([ v[1] for v in new ], device_id=device_id,
+                                 request=request,
+                                 data_ts=[ v[2] for v in new ],
+                                 data_sha256s=[ v[3] for v in new ],
+                                 device_class=device_class)
+        for (item, _, _, _), rowid in zip(new, rowids):
+            if rowid is not None:
+                item['rowid'] = rowid
+    logger.debug("Saved batch of %d/%d packets from device_id=%r",
+                 len(new), len(items), device_id)
+    return JsonResponse(dict(ok=True, n_saved=len(new), items=items))
+
+def _parse_frames(body):
+    """Split a framed body (see post_batch) into [(header, data), ...].
+
+    Raises ValueError if the framing is broken.
+    """
+    frames = [ ]
+    pos = 0
+    while pos < len(body):
+        end = body.find(b'\n', pos)
+        if end == -1:
+            raise ValueError("incomplete header at byte %d"%pos)
+        header = json.loads(body[pos:end].decode('utf8'))
+        if (not isinstance(header, dict) or not isinstance(header.get('length'), int)
+            or header['length'] < 0):
+            raise ValueError("header without length at byte %d"%pos)
+        start = end + 1
+        end = start + header['length']
+        if end >= len(body) or body[end:end+1] != b'\n':
+            raise ValueError("incomplete packet at byte %d"%start)
+        frames.append((header, body[start:end]))
+        pos = end + 1
+    return frames
+
 def save_data(data, device_id, request=None,
-              received_ts=None, data_ts=None):
+              received_ts=None, data_ts=None, data_sha256=None,
+              device_class=None, probes=None):
     """Save data which our server receives.
 
     This is the master "save data in DB" function.
@@ -145,37 +422,120 @@ def save_data(data, device_id, request=None,
                  received" timestamp
     data_ts:     If given, this is used as the timestamp to index by,
                  and represents the time the data was actually received.
+    data_sha256: sha256 hexdigest of the data as uploaded, if the data
+                 was modified before saving.  Default: hash of data.
+    device_class: the device class, if known.  Used to split oversized
+                 packets (see BaseDevice.max_packet_size) and to queue
+                 post-ingest hooks, otherwise looked up when needed.
+    probes:      the probes (or tables) with readings in the packet,
+                 stored in the DataProbe table for selecting packets
+                 by probe: a list of dict(probe=, ts_min=, ts_max=,
+                 n_rows=) or of probe names.  Default: from
+                 device_class.probe_meta, if the class is given.
+
+    Timestamps may be datetimes or unix times.  They are set before
+    the row is inserted, so each packet is written exactly once.  The
+    DeviceStats of the device are updated in the same transaction.
+
+    If the packet is split, all pieces are inserted together and the
+    row_id of the first one is returned.
     """
-    if not isinstance(data, (str, bytes)):
-        raise ValueError("save_data data must be str or bytes!")
-    device_id = device_id.lower()
-    if not util.check_checkdigits(device_id):
-        raise exceptions.InvalidDeviceID("Invalid device ID: checkdigits invalid.")
-    remote_ip = '127.0.0.1'
-    if request is not None:
-        remote_ip = request.META['REMOTE_ADDR']
+    device_id = ingest.check_device_id(device_id)
+    remote_ip = ingest.remote_ip(request)
+    device_class = ingest.saving_device_class(device_id, device_class, len(data))
+    if probes is None:
+        probes = ingest.packet_probes(device_class, data)
     # Actual saving process.
-    row = models.Data(device_id=device_id, ip=remote_ip, data=data)
-    row.data_length = len(data)
-    row.save()
-    # If necessary, set custom timestamps on the data.  It's unlikely
-    # that we get both, so save twice.
-    if received_ts is not None:
-        if isinstance(received_ts, int):
-            received_ts = timezone.make_aware(timezone.datetime.fromtimestamp(received_ts))
-        row.ts_received = received_ts
-        row.save()
-    if data_ts is not None:
-        if isinstance(data_ts, int):
-            data_ts = timezone.make_aware(timezone.datetime.fromtimestamp(data_ts))
-        row.ts = data_ts
-        row.save()
+    rows = ingest.packet_rows(data, device_id, remote_ip,
+                              received_ts=received_ts, data_ts=data_ts,
+                              data_sha256=data_sha256, device_class=device_class)
+    with transaction.atomic():
+        if len(rows) == 1:
+            rows[0].save(force_insert=True)
+        else:
+            models.Data.objects.bulk_create(rows)
+            if probes or hooks.async_hooks(device_class):
+                ingest.inserted_ids(rows)
+        if probes:
+            ingest.save_probes(rows, probes)
+        hooks.enqueue(device_class, rows)
+        models.DeviceStats.add_rows(rows)
     # Return row_id of inserted data.
-    row_id = row.id
-    del row, data
+    row_id = rows[0].id
+    del rows, data
     return row_id
 
+def save_data_batch(datas, device_id, request=None,
+                    received_ts=None, data_ts=None, device_class=None,
+                    data_sha256s=None, probes=None):
+    """Save many data packets from one device using one INSERT.
+
+    This is the bulk version of save_data(), for when one upload gets
+    stored as several packets.  All packets are validated before
+    anything is written, and all are written by one multi-row INSERT
+    statement, together with the DeviceStats update.  Callers which
+    need the packets to be stored together with other state should
+    wrap this in transaction.atomic().
 
+    Arguments:
+    datas:       list of data packets (str or bytes)
+    device_id:   device ID under which to save.  The checksum is
+                 checked.
+    request:     the HttpRequest object.  Used to get remote IP
+                 address.
+    received_ts: If given, override the "data packet received"
+                 timestamp of all packets.
+    data_ts:     If given, the timestamp to index by.  Either one
+                 timestamp for all packets, or a list with one
+                 timestamp (or None) per packet.
+    device_class: the device class, if known (see save_data).
+    data_sha256s: list of the sha256 hexdigests of the packets, if
+                 already known (see save_data).
+    probes:      list of the probes of each packet (see save_data).
+
+    Returns a list of the row_ids of the inserted data (of the first
+    piece, for packets which were split).  On databases which can't
+    return ids from a bulk insert (sqlite), the ids are None, unless
+    they were needed for saving probes or queueing hooks.
+    """
+    device_id = ingest.check_device_id(device_id)
+    remote_ip = ingest.remote_ip(request)
+    if not isinstance(data_ts, (list, tuple)):
+        data_ts = [data_ts] * len(datas)
+    elif len(data_ts) != len(datas):
+        raise ValueError("save_data_batch needs one data_ts per packet")
+    if data_sha256s is None:
+        data_sha256s = [None] * len(datas)
+    elif len(data_sha256s) != len(datas):
+        raise ValueError("save_data_batch needs one data_sha256 per packet")
+    if probes is None:
+        probes = [None] * len(datas)
+    elif len(probes) != len(datas):
+        raise ValueError("save_data_batch needs probes for each packet")
+    device_class = ingest.saving_device_class(device_id, device_class,
+                                              max((len(data) for data in datas), default=0))
+    probes = [ ingest.packet_probes(device_class, data) if packet_probes is None else packet_probes
+               for data, packet_probes in zip(datas, probes) ]
+    packets = [ ingest.packet_rows(data, device_id, remote_ip,
+                                   received_ts=received_ts, data_ts=ts,
+                                   data_sha256=data_sha256, device_class=device_class)
+                for data, ts, data_sha256 in zip(datas, data_ts, data_sha256s) ]
+    all_rows = [row for rows in packets for row in rows]
+    with transaction.atomic():
+        models.Data.objects.bulk_create(all_rows)
+        if any(probes) or hooks.async_hooks(device_class):
+            ingest.inserted_ids(all_rows)
+        for rows, packet_probes in zip(packets, probes):
+            if packet_probes:
+                ingest.save_probes(rows, packet_probes)
+        hooks.enqueue(device_class, all_rows)
+        models.DeviceStats.add_rows(all_rows)
+    return [ rows[0].id for rows in packets ]
+
+# save_data() and save_data_batch() for async views.  These run in a
+# worker thread, see util.db_sync_to_async().
+asave_data = util.db_sync_to_async(save_data)
+asave_data_batch = util.db_sync_to_async(save_data_batch)
 
 @csrf_exempt
 def log(request, device_id=None, device_class=None):
@@ -267,13 +627,13 @@ class DeviceConfig(UpdateView):
             import traceback
             exc_type, exc_value, exc_traceback = sys.exc_info()
             context['config_error'] = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-        be = self.object.backend
-        data_exists = be.exists()
-        if data_exists:
-            context['data_earliest'] = be[0].ts
-            context['data_latest'] = be[-1].ts
-            context['data_latest_data'] = be[-1].data
-            context['data_number'] = self.object.n_packets
+        stats = self.object.stats
+        if stats.n_packets:
+            context['data_earliest'] = stats.first_ts
+            context['data_latest'] = stats.last_ts
+            latest = self.object.backend[-1]
+            context['data_latest_data'] = latest.data if latest is not None else None
+            context['data_number'] = stats.n_packets
         # Handle the instructions template
         #
         return context
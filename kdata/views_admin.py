@@ -24,6 +24,7 @@ from . import models
 from . import devices
 from . import exceptions
 from . import group
+from . import hooks
 from . import logs
 from . import permissions
 from . import util
@@ -374,6 +375,33 @@ def stats(request):
 
         stats.append('')
 
+    # Ingest admission control counters.  These are only for the
+    # worker process which happens to answer this request.
+    from . import admission
+    stats.append('='*40)
+    stats.append('Ingest admission control (this worker only)')
+    stats.append('')
+    for name, value in sorted(admission.controller.stats().items()):
+        stats.append('    %-24s: %s'%(name, value))
+
+    from . import cache
+    stats.append('')
+    stats.append('Device ID filter (this worker only)')
+    stats.append('')
+    for name, value in sorted(cache.device_filter.stats().items()):
+        stats.append('    %-24s: %s'%(name, value))
+
+    # Post-ingest hooks: the queue is global, timings are of the
+    # inline hooks run by this worker.
+    stats.append('')
+    stats.append('Post-ingest hooks')
+    stats.append('')
+    stats.append('    %-24s: %s'%('queued jobs', models.IngestJob.objects.filter(failed=False).count()))
+    stats.append('    %-24s: %s'%('failed jobs', models.IngestJob.objects.filter(failed=True).count()))
+    for name, s in sorted(hooks.stats.stats().items()):
+        stats.append('    %s: %d calls, %d errors, %.3fs total, %.3fs max'%(
+            name, s['calls'], s['errors'], s['seconds'], s['max_seconds']))
+
     return HttpResponse('\n'.join(stats), content_type='text/plain')
 
 
@@ -406,22 +434,32 @@ def upload(request, public_id, device_class=None,
     c['device'] = device
 
     device_class = device.get_class()
-    if hasattr(device_class, 'process_upload'):
+    if hasattr(device_class, 'process_upload') or hooks.inline_hooks(device_class):
         c['processor'] = True  # user is informed
 
     if request.method == "POST":
         file = request.FILES['file0']
-        if file.size > 2 * 2**20:
-            raise exceptions.BaseMessageKootaException(message="File too large (2 MiB limit)")
-        data = file.read()
+        max_size = util.max_upload_size(device_class)
+        if file.size > max_size:
+            raise exceptions.BaseMessageKootaException(
+                message="File too large (%s limit)"%human_bytes(max_size))
+        # Large files are spooled to disk by django, so read them in
+        # chunks and hash as we go instead of reading a copy.
+        data, data_sha256 = util.read_hashed(file.chunks(), max_size=max_size)
         # Do we do extra processing?
-        if c['processor']:
-            data = device_class.process_upload(data)
+        if hasattr(device_class, 'process_upload'):
+            data = device_class.process_upload(None, data)
+        try:
+            data = hooks.run_inline(device_class, data, device_id=device.device_id,
+                                    request=request)
+        except hooks.Rejected as e:
+            raise exceptions.BaseMessageKootaException(message=e.message)
         #
         c['success'] = True
         c['bytes'] = len(data)
-        c['sha256'] = hashlib.sha256(data).hexdigest()
+        c['sha256'] = data_sha256
         # Save
-        rowid = views.save_data(data=data, device_id=device.secret_id, request=request)
+        rowid = views.save_data(data=data, device_id=device.secret_id, request=request,
+                                data_sha256=data_sha256, device_class=device_class)
         c['rowid'] = rowid
     return TemplateResponse(request, 'koota/upload.html', context)
@@ -16,8 +16,10 @@ from django.template.response import TemplateResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, FormView
 
+from . import converter as kconverter
 from . import devices
 from . import exceptions
+from . import export
 from . import logs
 from . import models
 from . import permissions
@@ -53,13 +55,13 @@ class DeviceDetail(DetailView):
         context = super(DeviceDetail, self).get_context_data(**kwargs)
         device_class = context['device_class'] = self.object.get_class()
         context.update(device_class.configure(device=self.object))
-        be = self.object.backend
-        data_exists = be.exists()
-        if data_exists:
-            context['data_earliest'] = be[0].ts
-            context['data_latest'] = be[-1].ts
-            context['data_latest_data'] = be[-1].data
-            context['data_number'] = self.object.n_packets
+        stats = self.object.stats
+        if stats.n_packets:
+            context['data_earliest'] = stats.first_ts
+            context['data_latest'] = stats.last_ts
+            latest = self.object.backend[-1]
+            context['data_latest_data'] = latest.data if latest is not None else None
+            context['data_number'] = stats.n_packets
 
         return context
 
@@ -72,13 +74,13 @@ def device_detail_json(request, **kwargs):
     device = models.Device.get_by_id(public_id=kwargs['public_id'])
     if not permissions.has_device_permission(request, device):
         raise exceptions.NoDevicePermission()
-    be = device.backend
+    stats = device.stats
 
     data = { }
-    data['data_exists'] = be.exists()
+    data['data_exists'] = stats.n_packets > 0
     if data['data_exists']:
-        data['data_earliest'] = be[0].ts.timestamp()
-        data['data_latest'] = be[-1].ts.timestamp()
+        data['data_earliest'] = stats.first_ts.timestamp()
+        data['data_latest'] = stats.last_ts.timestamp()
     else:
         data['data_earliest'] = data['data_latest'] = None
     return JsonResponse(data)
@@ -146,6 +148,7 @@ def device_data(request, public_id, converter, format):
     queryset = models.Data.objects.filter(device_id=device.device_id, ).order_by('ts')
     if hasattr(converter_class, 'query'):
         queryset = converter_class.query(queryset)
+    queryset = converter_class.select_packets(queryset, device)
 
     # Process the form and apply options
     form = c['select_form'] = DataListForm(request.GET)
@@ -160,6 +163,20 @@ def device_data(request, public_id, converter, format):
         # Bad data, return early and make the user fix the form
         return TemplateResponse(request, 'koota/device_data.html', context)
 
+    filename_base = '%s_%s_%s_%s-%s'%(
+        device.public_id,
+        device.type,
+        converter_class.name(),
+        form.cleaned_data['start'].strftime('%Y-%m-%d-%H:%M:%S') if form.cleaned_data['start'] else '',
+        form.cleaned_data['end'].strftime('%Y-%m-%d-%H:%M:%S') if form.cleaned_data['end'] else ''
+    )
+    # Raw downloads: formatted by the database, if it can.
+    if (format and converter_class is kconverter.Raw
+            and not request.GET.get('textdate', False)):
+        response = export.raw_export(queryset, format, filename_base)
+        if response is not None:
+            return response
+
     # Paginate, if needed
     if converter_class.per_page is not None and not format:
         page_number = request.GET.get('page', 'last')
@@ -216,18 +233,18 @@ def device_data(request, public_id, converter, format):
     else:
         time_converter = lambda ts: ts
 
-    if format:
-        # More efficient for bulk downloads
-        data = util.optimized_queryset_iterator(data)
+    if data.query.is_sliced:
+        # One page of the HTML paging.  It can't be read by keyset,
+        # but it is small.
+        data = ((x.ts, x.data) for x in util.optimized_queryset_iterator_1(data))
     else:
-        # Can be paged, less efficient.  This must be done in the case
-        # that we are using the HTML paging.
-        data = util.optimized_queryset_iterator_1(data)
+        # Bulk downloads: (ts, data) tuples, in pages.
+        data = util.keyset_queryset_iterator(data)
     # Make our table object by passing raw data through the converter.
     catch_errors = 1
     if catch_errors:
         converter = c['converter'] \
-                = converter_class(((x.ts, x.data) for x in data),
+                = converter_class(data,
                                    time=time_converter,
                                    params=request.GET,
                                    device=device)
@@ -235,7 +252,7 @@ def device_data(request, public_id, converter, format):
                 converter.run()
     else:
         converter = c['converter'] = converter_class()
-        table = c['table'] = converter.convert(((x.ts, x.data) for x in data),
+        table = c['table'] = converter.convert(data,
                                                time=time_converter,
                                                device=device)
 
@@ -246,13 +263,6 @@ def device_data(request, public_id, converter, format):
 
     # Convert to custom formats if it was requested.
     context['download_formats'] = DOWNLOAD_FORMATS
-    filename_base = '%s_%s_%s_%s-%s'%(
-        device.public_id,
-        device.type,
-        converter.name(),
-        form.cleaned_data['start'].strftime('%Y-%m-%d-%H:%M:%S') if form.cleaned_data['start'] else '',
-        form.cleaned_data['end'].strftime('%Y-%m-%d-%H:%M:%S') if form.cleaned_data['end'] else ''
-    )
     if format:
         return handle_format_downloads(table,
                                        format,
@@ -0,0 +1,14 @@
+"""
+ASGI config for the ingest-only application, see
+koota_prj/settings_ingest_asgi.py.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "koota_prj.settings_ingest_asgi")
+
+application = get_asgi_application()
@@ -58,11 +58,49 @@ LOGIN_REDIRECT_URL = 'device-list'
 LOGOUT_REDIRECT_URL = 'main'
 DATA_UPLOAD_MAX_MEMORY_SIZE = 15 * 2**20
 FILE_UPLOAD_MAX_MEMORY_SIZE = 15 * 2**20
+# Default upload size limit of data posts and the upload form.
+# Device classes can override it with .max_upload_size.
+KOOTA_MAX_UPLOAD_SIZE = DATA_UPLOAD_MAX_MEMORY_SIZE
 WEB_COMPONENTS = set(('ui', 'data', 'admin'))
 SITE_PRIVACY_URL = 'https://github.com/CxAalto/koota-server/wiki/PrivacyPolicy'
 GENERAL_LOG = os.path.join(BASE_DIR, 'log.txt')
 DATA_ACCESS_LOG = GENERAL_LOG
 CONN_MAX_AGE = 60    # database connenction timeout (s)
+# If set, uploads are appended to a spool file in this directory and
+# acknowledged without touching the database.  Run "manage.py
+# drain_spool --loop" to move them into the database.  AWARE's last
+# timestamps lag until the packets are drained.
+KOOTA_INGEST_SPOOL_DIR = None
+# Per-process cache of device lookups, see kdata/cache.py.
+KOOTA_DEVICE_CACHE_TTL = 60
+KOOTA_DEVICE_CACHE_NEGATIVE_TTL = 0
+# Allow deduplication of re-uploaded packets in views.post, for devices
+# with the attribute dedupe_uploads=1.  Not done in spool mode.
+KOOTA_DEDUPE_UPLOADS = False
+# Keep all device ids in memory and reject uploads to unknown ids
+# without a database query (see kdata/cache.py).
+KOOTA_DEVICE_FILTER = False
+KOOTA_DEVICE_FILTER_REFRESH = 10     # seconds between rebuilds on misses
+# Store new packets compressed ('zlib') if at least this long.  Use
+# "manage.py compress_data" for existing packets.
+KOOTA_DATA_COMPRESSION = None
+KOOTA_DATA_COMPRESS_MIN_LENGTH = 1024
+# Monthly partitions of the data table to keep created ahead, when it
+# is partitioned (see kdata/partitions.py, "manage.py partition_data").
+KOOTA_DATA_PARTITION_MONTHS_AHEAD = 3
+# Reading raw data (util.keyset_queryset_iterator): bytes of payload
+# per query, and whether to use server-side cursors (PostgreSQL, not
+# with pgbouncer transaction pooling).
+KOOTA_DATA_ITER_BYTES = 10*2**20
+KOOTA_DATA_ITER_SERVER_SIDE = False
+# Admission control of the data-receiving views, see kdata/admission.py.
+KOOTA_INGEST_MAX_CONCURRENT = None   # per worker
+KOOTA_INGEST_DEVICE_RATE = None      # requests/second per device
+KOOTA_INGEST_DEVICE_BURST = 10
+KOOTA_INGEST_RETRY_AFTER = 60        # seconds
+# Use the async versions of the data-receiving views (kdata.views.apost,
+# aware.ainsert).  Set by koota_prj/settings_ingest_asgi.py.
+KOOTA_ASYNC_INGEST = False
 
 #### The following settings should go into settings_local.py, NOT here.
 # Make a random salt using this and paste it here.  By default we have
@@ -130,6 +168,7 @@ INSTALLED_APPS = [
 # TODO: django 1.10, middleware change
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'kdata.admission.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
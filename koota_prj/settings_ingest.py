@@ -0,0 +1,41 @@
+"""Settings for the ingest-only application (koota_prj/wsgi_ingest.py).
+
+This is the normal settings, with only what receiving data needs: the
+kdata.urls_data routes, a minimal middleware stack and no admin, UI,
+survey or social media modules.  Run it as its own worker pool behind
+POST_DOMAIN, for example:
+
+    uwsgi --module koota_prj.wsgi_ingest ...
+
+Workers then use less memory, start faster, and each upload passes
+through fewer middlewares.  Device modules not imported here are
+imported on first use by kdata.devices.get_class().
+"""
+
+from .settings import *
+
+WEB_COMPONENTS = set(('data', ))
+ROOT_URLCONF = 'koota_prj.urls_ingest'
+WSGI_APPLICATION = 'koota_prj.wsgi_ingest.application'
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'kdata',
+]
+
+# No sessions or authentication: the ingest views identify devices by
+# their secret ids.  Views which need a logged in user (e.g. the AWARE
+# QR code) must be served by the main application.
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'kdata.admission.AdmissionControlMiddleware',
+    'kdata.middleware.IngestExceptionMiddleware',
+]
+
+# Device modules imported at startup, besides those the kdata.urls_data
+# routes need.  Classes with .ingest_hooks or .max_packet_size must be
+# listed here: only registered classes are checked for these.
+KOOTA_INGEST_DEVICE_MODULES = [
+    'kdata.devices.ios',
+]
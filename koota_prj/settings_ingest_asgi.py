@@ -0,0 +1,15 @@
+"""Settings for the ASGI ingest-only application (koota_prj/asgi_ingest.py).
+
+Like koota_prj/settings_ingest.py, but with the async versions of the
+upload views.  With an ASGI server, the request body of slow clients
+is received without tying up a worker, and a worker thread and
+database connection are only used once it has all arrived:
+
+    uvicorn koota_prj.asgi_ingest:application ...
+
+Compare with the WSGI application using kdata/bin/load_test.py.
+"""
+
+from .settings_ingest import *
+
+KOOTA_ASYNC_INGEST = True
@@ -0,0 +1,14 @@
+"""URL configuration of the ingest-only application.
+
+See koota_prj/settings_ingest.py.
+"""
+import importlib
+
+from django.conf import settings
+
+from kdata.urls_data import urls_data
+
+for _modname in getattr(settings, 'KOOTA_INGEST_DEVICE_MODULES', ()):
+    importlib.import_module(_modname)
+
+urlpatterns = list(urls_data)
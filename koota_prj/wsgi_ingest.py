@@ -0,0 +1,14 @@
+"""
+WSGI config for the ingest-only application, see
+koota_prj/settings_ingest.py.
+
+It exposes the WSGI callable as a module-level variable named ``application``.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "koota_prj.settings_ingest")
+
+application = get_wsgi_application()